@@ -0,0 +1,175 @@
+'''
+Created in October 2026
+
+@description: Benchmark of the options of OutputFromPickle.writeFile on a synthetic day: write
+              time, file size and time to read the time series of some pixels, for different
+              compression levels, chunk shapes and types of cprec and nb
+'''
+
+import argparse
+import bz2
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from netCDF4 import Dataset as nc
+from output_from_pickle import OutputFromPickle
+
+
+# name and options of writeFile of each configuration, chunks are (48, 32, 32) unless
+# chunksizes is given
+CONFIGURATIONS = [
+    ('float32 deflate 9', {'complevel': 9, 'chunksizes': None}),
+    ('float32 deflate 4', {'complevel': 4, 'chunksizes': None}),
+    ('float32 deflate 1', {'complevel': 1, 'chunksizes': None}),
+    ('float32 deflate 4 chunks', {'complevel': 4}),
+    ('float32 deflate 1 chunks', {'complevel': 1}),
+    ('int16 deflate 1 chunks', {'complevel': 1, 'pack_precip': True, 'nb_type': 'u2'}),
+    ('int16 deflate 4 chunks', {'complevel': 4, 'pack_precip': True, 'nb_type': 'u2'}),
+    ('int16 deflate 4 no shuffle', {'complevel': 4, 'shuffle': False, 'pack_precip': True, \
+                                    'nb_type': 'u2'}),
+]
+
+
+def createDay(filename, shape, seed=1234):
+    """
+    Write a synthetic CMORPH-like daily file with moving rain systems
+    @param filename: name of the .nc.bz2 file
+    @param shape: (time, lat, lon)
+    @param seed: seed of the random numbers
+    @return precipitation, ids of the systems (0 outside)
+    """
+    nt, nlat, nlon = shape
+    rs = np.random.RandomState(seed)
+    num = max(1, nlat*nlon // 2000)
+    pos = rs.rand(num, 2) * [nlat, nlon]
+    vel = rs.randn(num, 2)
+    amp = rs.rand(num) * 10 + 1
+    sig = rs.rand(num) * 4 + 2
+    precip = np.zeros(shape, np.float32)
+    ids = np.zeros(shape, np.int32)
+    for t in range(nt):
+        for n in range(num):
+            i0, i1 = int(max(pos[n, 0] - 3*sig[n], 0)), int(min(pos[n, 0] + 3*sig[n] + 1, nlat))
+            j0, j1 = int(max(pos[n, 1] - 3*sig[n], 0)), int(min(pos[n, 1] + 3*sig[n] + 1, nlon))
+            ii, jj = np.mgrid[i0:i1, j0:j1]
+            p = amp[n] * np.exp(-((ii - pos[n, 0])**2 + (jj - pos[n, 1])**2) / (2*sig[n]**2))
+            precip[t, i0:i1, j0:j1] += p * (1 + 0.3*rs.rand(*p.shape))
+            ids[t, i0:i1, j0:j1][p > 0.5] = n + 1
+        pos += vel
+        pos %= [nlat, nlon]
+    precip[precip < 0.1] = 0
+    precip = np.around(precip, 2)
+    writeDay(filename, precip)
+    return precip, ids
+
+
+def writeDay(filename, precip):
+    """
+    Write precipitation as a CMORPH-like daily file, time steps are every half hour from
+    2010-02-19
+    @param filename: name of the .nc.bz2 file
+    @param precip: precipitation (time, lat, lon)
+    """
+    nt, nlat, nlon = precip.shape
+    nc_filename = filename[:-4]
+    f = nc(nc_filename, 'w')
+    f.createDimension('time', size=None)
+    f.createDimension('lat', size=nlat)
+    f.createDimension('lon', size=nlon)
+    var = f.createVariable('time', 'f', ('time',))
+    var.units = 'hours since 2010-02-19 00:00'
+    var[:] = np.arange(nt) * 0.5
+    f.createVariable('lat', 'f', ('lat',))[:] = np.linspace(-60, 60, nlat)
+    f.createVariable('lon', 'f', ('lon',))[:] = np.linspace(0, 360, nlon, endpoint=False)
+    f.createVariable('CMORPH', 'f', ('time', 'lat', 'lon'), zlib=True)[:] = precip
+    f.close()
+    with open(nc_filename, 'rb') as fh:
+        data = fh.read()
+    os.remove(nc_filename)
+    zipfile = bz2.BZ2File(filename, 'wb')
+    zipfile.write(data)
+    zipfile.close()
+
+
+def readPixels(filename, pixels):
+    """
+    Read the time series of cprec and nb at some pixels
+    @param filename: output file
+    @param pixels: list of (i, j)
+    @return time in seconds
+    """
+    time0 = time.time()
+    f = nc(filename)
+    for i, j in pixels:
+        f.variables['cprec'][:, i, j]
+        f.variables['nb'][:, i, j]
+    f.close()
+    return time.time() - time0
+
+
+def benchmarkOutput(shape=(48, 400, 800), configurations=CONFIGURATIONS, num_pixels=20, \
+                    tmpdir=None):
+    """
+    Write the same day with each configuration
+    @param shape: (time, lat, lon)
+    @param configurations: list of (name, options of writeFile)
+    @param num_pixels: number of pixel time series read
+    @param tmpdir: directory of the files, a temporary directory by default
+    @return list of dictionaries with name, write time, size, read time and maximum
+            precipitation error
+    """
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        filename = os.path.join(workdir, 'Cmorph-2010_02_19.nc.bz2')
+        precip, ids = createDay(filename, shape)
+        expected = precip * (ids != 0)
+        lat, lon = np.arange(shape[1]), np.arange(shape[2])
+        rs = np.random.RandomState(0)
+        pixels = zip(rs.randint(0, shape[1], num_pixels), rs.randint(0, shape[2], num_pixels))
+        results = []
+        for n, (name, options) in enumerate(configurations):
+            outputdir = os.path.join(workdir, 'output%d' % n) + '/'
+            os.makedirs(outputdir)
+            ofp = OutputFromPickle(0, lat, lon, workdir, outputdir, ['bench'], None, {}, 0)
+            ofp.clusters = ids
+            time0 = time.time()
+            ofp.writeFile('bench', filename, [0, 0, 0, 0], **options)
+            write_time = time.time() - time0
+            output = os.path.join(outputdir, os.listdir(outputdir)[0])
+            read_time = readPixels(output, pixels)
+            f = nc(output)
+            error = np.abs(f.variables['cprec'][:] - expected).max()
+            assert(np.array_equal(f.variables['nb'][:], ids))
+            f.close()
+            results.append({'name': name, 'write_time': write_time, \
+                            'size': os.path.getsize(output), 'read_time': read_time, \
+                            'max_error': float(error)})
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def printResults(results):
+    """
+    @param results: list of dictionaries returned by benchmarkOutput
+    """
+    print '%-26s %10s %10s %12s %10s' % ('configuration', 'write (s)', 'size (MB)', \
+                                         'pixels (s)', 'max error')
+    for res in results:
+        print '%-26s %10.2f %10.2f %12.3f %10.4f' % (res['name'], res['write_time'], \
+                                                     res['size'] / 1024.**2, \
+                                                     res['read_time'], res['max_error'])
+
+
+#############################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the netcdf output')
+    parser.add_argument('-shape', default='48,400,800', help='time,lat,lon of the day')
+    parser.add_argument('-pixels', type=int, default=20, help='Number of pixel time \
+                         series read')
+    parser.add_argument('-tmpdir', default=None, help='Directory of the temporary files')
+    args = parser.parse_args()
+    shape = tuple(int(n) for n in args.shape.split(','))
+    printResults(benchmarkOutput(shape, num_pixels=args.pixels, tmpdir=args.tmpdir))
@@ -0,0 +1,288 @@
+'''
+Created in October 2026
+
+@description: Benchmark of the stages of the tracking on synthetic data, no CMORPH file or
+              land-sea mask is needed. Rain fields are made of moving gaussian blobs, some of
+              them merging or splitting in the middle of the day, and the land-sea mask of
+              random islands. CoastalMapping, FeatureExtractor, the construction of the
+              clusters, TimeConnectedClusters.addTime and harvestTracks, and OutputFromPickle
+              are timed for several grid sizes and densities of rain systems. The results are
+              written as json, and compared with the results of a previous run
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from netCDF4 import Dataset as nc
+from benchmark_output import writeDay
+from coastal_mapping import CoastalMapping
+from feature_extractor import FeatureExtractor
+from output_from_pickle import OutputFromPickle, createTxt
+from pickle_cache import PickleCache
+from time_connected_clusters import TimeConnectedClusters
+
+# increase when the cases or the stages change, results of different versions are not compared
+VERSION = 1
+
+# stages timed, in the order they run
+STAGES = ['coastal_mapping', 'feature_extractor', 'clusters', 'add_time', 'harvest_tracks', \
+          'output_from_pickle']
+
+# (lat, lon) of the grids
+GRIDS = [(120, 200), (240, 400), (480, 800)]
+
+# number of rain systems per 10000 cells
+DENSITIES = [2, 8]
+
+# number of time steps of the synthetic day, OutputFromPickle writes days of 48 time steps
+NUM_TIMES = 48
+
+# parameters of config.cfg
+PARAMETERS = {'min_prec': 0., 'max_prec': 3.0, 'szone': 8, 'lzone': 50, 'frac_mask': 1.0, \
+              'frac_ellipse': 1.0, 'min_axis': 6, 'min_size': 0, 'max_size': 800000, \
+              'max_cells': 4400, 't_life': 5, 't_life_lim': 2, 'frac_decrease': 0.95, \
+              'tile_size': 0}
+
+
+def createRain(shape, density, seed=1234):
+    """
+    Synthetic precipitation made of moving gaussian blobs. Every third blob has a partner
+    that merges with it in the middle of the day, and every third one a partner that splits
+    from it
+    @param shape: (time, lat, lon)
+    @param density: number of blobs per 10000 cells
+    @param seed: seed of the random numbers
+    @return precipitation
+    """
+    nt, nlat, nlon = shape
+    rs = np.random.RandomState(seed)
+    num = max(1, int(round(density * nlat * nlon / 10000.)))
+    pos = rs.rand(num, 2) * [nlat, nlon]
+    vel = rs.randn(num, 2) * 0.5
+    t_mid = nt // 2
+
+    # blobs: index of the blob followed, velocity relative to it, first and last time step
+    parent = list(range(num))
+    rel_vel = [np.zeros(2)] * num
+    times = [(0, nt - 1)] * num
+    for n in range(num):
+        if n % 3 == 1:
+            parent.append(n)
+            rel_vel.append(rs.randn(2))
+            times.append((0, t_mid))
+        elif n % 3 == 2:
+            parent.append(n)
+            rel_vel.append(rs.randn(2))
+            times.append((t_mid, nt - 1))
+    num_blobs = len(parent)
+    amp = rs.rand(num_blobs) * 10 + 2
+    sig = rs.rand(num_blobs) * 3 + 2
+
+    precip = np.zeros(shape, np.float32)
+    for t in range(nt):
+        for n in range(num_blobs):
+            if not times[n][0] <= t <= times[n][1]:
+                continue
+            i, j = (pos[parent[n]] + vel[parent[n]]*t + rel_vel[n]*(t - t_mid)) % [nlat, nlon]
+            i0, i1 = int(max(i - 3*sig[n], 0)), int(min(i + 3*sig[n] + 1, nlat))
+            j0, j1 = int(max(j - 3*sig[n], 0)), int(min(j + 3*sig[n] + 1, nlon))
+            ii, jj = np.mgrid[i0:i1, j0:j1]
+            p = amp[n] * np.exp(-((ii - i)**2 + (jj - j)**2) / (2*sig[n]**2))
+            precip[t, i0:i1, j0:j1] += p * (1 + 0.3*rs.rand(*p.shape))
+    precip[precip < 0.1] = 0
+    return np.around(precip, 2)
+
+
+def createLsm(filename, shape, seed=1234):
+    """
+    Write a synthetic land-sea mask (1 over sea, 0 over land) with random rectangular islands
+    @param filename: name of the netcdf file
+    @param shape: (lat, lon)
+    @param seed: seed of the random numbers
+    """
+    rs = np.random.RandomState(seed)
+    slm = np.ones(shape)
+    for n in range(max(1, shape[0] * shape[1] // 4000)):
+        i, j = rs.randint(0, shape[0]), rs.randint(0, shape[1])
+        size_i, size_j = rs.randint(1, 30, 2)
+        slm[i:i+size_i, j:j+size_j] = 0
+    f = nc(filename, 'w')
+    f.createDimension('lat', size=shape[0])
+    f.createDimension('lon', size=shape[1])
+    f.createVariable('lsm', 'f', ('lat', 'lon'))[:] = slm
+    f.close()
+
+
+def benchmarkCase(grid, density, workdir, seed=1234):
+    """
+    Run the stages of the tracking and of the post-processing on one synthetic day
+    @param grid: (lat, lon)
+    @param density: number of rain systems per 10000 cells
+    @param workdir: directory of the files, emptied before
+    @param seed: seed of the random numbers
+    @return dictionary with the time of each stage and the numbers of clusters and tracks
+    """
+    P = PARAMETERS
+    nlat, nlon = grid
+    num_times = NUM_TIMES
+    for name in os.listdir(workdir):
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    inputdir = os.path.join(workdir, 'pickles') + '/'
+    outputdir = os.path.join(workdir, 'output') + '/'
+    os.makedirs(inputdir)
+    os.makedirs(outputdir)
+    createTxt(inputdir + 'lat-lon_bench.txt', [0, nlat, 0, nlon])
+    lsm = os.path.join(workdir, 'lsm.nc')
+    createLsm(lsm, grid, seed)
+    rain = createRain((num_times, nlat, nlon), density, seed)
+    filename = os.path.join(workdir, 'Cmorph-2010_02_19.nc.bz2')
+    writeDay(filename, rain)
+    times = {}
+
+    time0 = time.time()
+    cm = CoastalMapping(lsm, 8, slice(0, nlat), slice(0, nlon), P['szone'], P['lzone'], \
+                        P['min_size'], P['max_size'])
+    times['coastal_mapping'] = time.time() - time0
+    l_area = np.flipud(cm.lArea)
+    s_area = np.flipud(cm.sArea)
+
+    time0 = time.time()
+    all_fe = [FeatureExtractor(rain[t], P['min_prec'], P['max_prec'], l_area, P['frac_mask'], \
+                               tile_size=P['tile_size']) for t in range(num_times)]
+    times['feature_extractor'] = time.time() - time0
+
+    time0 = time.time()
+    all_clusters = [fe.getClusters(P['min_axis']) for fe in all_fe]
+    times['clusters'] = time.time() - time0
+    num_clusters = sum(len(clusters) for clusters in all_clusters)
+
+    # the dead tracks are harvested in the middle of the day, all the tracks at the end
+    tcc = TimeConnectedClusters()
+    prefix = inputdir + 'bench'
+    harvest_args = ((0, nlat), (0, nlon), s_area, P['frac_mask'], P['max_cells'], \
+                    P['t_life']*num_times, P['t_life_lim']*num_times, [0, nlat], 0)
+    times['add_time'] = times['harvest_tracks'] = 0.
+    for t, clusters in enumerate(all_clusters):
+        time0 = time.time()
+        tcc.addTime(clusters, P['frac_ellipse'], P['frac_decrease'])
+        times['add_time'] += time.time() - time0
+        if t + 1 == num_times // 2:
+            time0 = time.time()
+            tcc.harvestTracks(prefix, *harvest_args, dead_only=True)
+            times['harvest_tracks'] += time.time() - time0
+    num_tracks = tcc.getNumberOfTracks()
+    time0 = time.time()
+    tcc.harvestTracks(prefix, *harvest_args, dead_only=False)
+    times['harvest_tracks'] += time.time() - time0
+
+    time0 = time.time()
+    lat, lon = list(np.linspace(-60, 60, nlat)), list(np.linspace(0, 360, nlon, endpoint=False))
+    ofp = OutputFromPickle(0, lat, lon, inputdir, outputdir, ['bench'], PickleCache(), {}, 0)
+    ofp.extractTracks(sorted(ofp.selectPickles()))
+    ofp.writeFile('bench', filename, [0, nlat, 0, nlon])
+    times['output_from_pickle'] = time.time() - time0
+
+    return {'grid': list(grid), 'density': density, 'num_times': num_times, \
+            'clusters': num_clusters, 'tracks': num_tracks, 'times': times}
+
+
+def benchmarkTracking(grids=GRIDS, densities=DENSITIES, repeat=1, tmpdir=None):
+    """
+    Run every case, the time of each stage is the best of several runs
+    @param grids: list of (lat, lon)
+    @param densities: list of numbers of rain systems per 10000 cells
+    @param repeat: number of runs of each case
+    @param tmpdir: directory of the files, a temporary directory by default
+    @return dictionary with the version, date, machine and the results of each case
+    """
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    cases = []
+    try:
+        for grid in grids:
+            for density in densities:
+                res = None
+                for n in range(repeat):
+                    new = benchmarkCase(grid, density, workdir)
+                    if res is None:
+                        res = new
+                    for stage in STAGES:
+                        res['times'][stage] = min(res['times'][stage], new['times'][stage])
+                cases.append(res)
+    finally:
+        shutil.rmtree(workdir)
+    return {'version': VERSION, 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), \
+            'machine': platform.node(), 'python': platform.python_version(), \
+            'numpy': np.__version__, 'cases': cases}
+
+
+def getKey(case):
+    """
+    @param case: result of a case
+    @return key used to match the cases of two runs
+    """
+    return (tuple(case['grid']), case['density'], case['num_times'])
+
+
+def printResults(results, reference=None):
+    """
+    Print the time of each stage, and the ratio to the reference if given
+    @param results: dictionary returned by benchmarkTracking
+    @param reference: results of a previous run, None for no comparison
+    """
+    ref_cases = {}
+    if reference is not None:
+        if reference['version'] != results['version']:
+            print 'Reference has version %d, expected %d: not compared' % \
+                  (reference['version'], results['version'])
+        else:
+            ref_cases = dict((getKey(case), case) for case in reference['cases'])
+    print '%-10s %7s %8s %7s' % ('grid', 'density', 'clusters', 'tracks') + \
+          ''.join(' %18s' % stage for stage in STAGES)
+    for case in results['cases']:
+        line = '%-10s %7g %8d %7d' % ('%dx%d' % tuple(case['grid']), case['density'], \
+                                      case['clusters'], case['tracks'])
+        ref = ref_cases.get(getKey(case))
+        for stage in STAGES:
+            value = '%.3f' % case['times'][stage]
+            if ref is not None and ref['times'][stage] > 0:
+                value += ' (x%.2f)' % (case['times'][stage] / ref['times'][stage])
+            line += ' %18s' % value
+        print line
+
+
+#############################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the tracking on synthetic data')
+    parser.add_argument('-grids', default=','.join('%dx%d' % grid for grid in GRIDS), \
+                        help='lat x lon of the grids, separated by commas')
+    parser.add_argument('-densities', default=','.join(str(d) for d in DENSITIES), \
+                        help='Numbers of rain systems per 10000 cells, separated by commas')
+    parser.add_argument('-repeat', type=int, default=1, help='Number of runs of each case, \
+                         the best time is kept')
+    parser.add_argument('-o', dest='output', default=None, help='Write the results to this \
+                         json file')
+    parser.add_argument('-compare', default=None, help='json file of a previous run, the \
+                         ratio of the times to this run is printed')
+    parser.add_argument('-tmpdir', default=None, help='Directory of the temporary files')
+    args = parser.parse_args()
+    grids = [tuple(int(n) for n in grid.split('x')) for grid in args.grids.split(',')]
+    densities = [float(d) for d in args.densities.split(',')]
+    results = benchmarkTracking(grids, densities, args.repeat, args.tmpdir)
+    reference = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            reference = json.load(f)
+    printResults(results, reference)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
@@ -0,0 +1,351 @@
+'''
+Created in October 2026
+
+@description: A Class that writes the restart files of the tracking incrementally. The first
+              file (base) holds the whole state, the next ones (deltas) only hold what changed
+              since the previous file: new tracks, new or modified time steps of the live
+              tracks, new daily files, the pickle index and the next date. Each file is
+              written under a temporary name, synced and renamed, so that an interrupted
+              write leaves the previous files usable. A new base is written when the deltas
+              get bigger than the last base
+'''
+
+import cPickle
+import glob
+import gzip
+import os
+from time_connected_clusters import TimeConnectedClusters
+
+
+class Checkpoint:
+
+    # increase when the content of the files changes
+    VERSION = 1
+
+    def __init__(self, dirname):
+        """
+        Constructor
+        @param dirname: directory of the restart files
+        """
+        self.dirname = dirname
+
+        # number of the next file
+        self.seq = 0
+
+        # serial number of the tracks written, with id of the track dictionary as key.
+        # The tracks are kept in self.tracks so that their ids are not reused
+        self.serials = {}
+
+        # track dictionaries, with serial number as key
+        self.tracks = {}
+
+        # what was written of each track, with serial number as key. Each value is a dictionary
+        # with the time index as key and (entry, clusters, number of clusters, area) as value
+        self.written = {}
+
+        # next serial number
+        self.next_serial = 0
+
+        # number of daily files written
+        self.num_filenames = 0
+
+        # size of the last base and of the deltas written after it
+        self.base_size = 0
+        self.delta_size = 0
+
+
+    def getFiles(self):
+        """
+        @return names of the files of the last base and of the deltas written after it
+        """
+        files = sorted(glob.glob(os.path.join(self.dirname, '[0-9]*.pkl.gz')))
+        bases = [i for i in range(len(files)) if files[i].endswith('_base.pkl.gz')]
+        if not bases:
+            return []
+        return files[bases[-1]:]
+
+
+    def exists(self):
+        """
+        @return True if there is a restart
+        """
+        return len(self.getFiles()) > 0
+
+
+    def load(self):
+        """
+        Replay the base and the deltas
+        @return dictionary with tcc, minmax_lons, minmax_lats, fyear, list_filename and
+                pickle_index
+        """
+        files = self.getFiles()
+        if not files:
+            raise IOError('No restart file in %s' % self.dirname)
+        list_filename = []
+        for filename in files:
+            with gzip.GzipFile(filename) as gzf:
+                record = cPickle.load(gzf)
+            if record['version'] != self.VERSION:
+                raise RuntimeError('Restart file %s has version %d, expected %d' % \
+                                   (filename, record['version'], self.VERSION))
+            size = os.path.getsize(filename)
+            if record['base']:
+                self.written = {}
+                self.base_size = size
+                self.delta_size = 0
+            else:
+                self.delta_size += size
+
+            # apply the changes
+            for serial, entries in record['tracks'].items():
+                track = self.written.setdefault(serial, {})
+                track.update(entries)
+            for serial, t_indices in record['deleted'].items():
+                for t_index in t_indices:
+                    del self.written[serial][t_index]
+            self.written = dict((serial, self.written[serial]) for serial in record['order'])
+            list_filename += record['filenames']
+            order = record['order']
+            last = record
+
+        # rebuild the time connected clusters
+        tcc = TimeConnectedClusters()
+        tcc.t_index = last['t_index']
+        tcc.num_clusters = last['num_clusters']
+        tcc.cluster_connect = [self.written[serial] for serial in order]
+
+        # the next files are written relative to the state that was loaded
+        self.seq = int(os.path.basename(files[-1]).split('_')[0]) + 1
+        self.next_serial = last['next_serial']
+        self.num_filenames = len(list_filename)
+        self.tracks = {}
+        self.serials = {}
+        for serial in order:
+            self.setWritten(serial, self.written[serial])
+
+        return {'tcc': tcc, 'minmax_lons': last['minmax_lons'], \
+                'minmax_lats': last['minmax_lats'], 'fyear': last['fyear'], \
+                'list_filename': list_filename, 'pickle_index': last['pickle_index']}
+
+
+    def setWritten(self, serial, track):
+        """
+        Remember what was written of a track
+        @param serial: serial number of the track
+        @param track: track dictionary
+        """
+        self.serials[id(track)] = serial
+        self.tracks[serial] = track
+        self.written[serial] = dict((t_index, (entry, entry['clusters'], \
+                                    len(entry['clusters']), entry['area'])) \
+                                    for t_index, entry in track.items())
+
+
+    def isModified(self, written, entry):
+        """
+        Check if a time step of a track changed since it was written. The tracking replaces
+        the entries and the lists of clusters when tracks are fused, and appends clusters to
+        the list of the current time step
+        @param written: (entry, clusters, number of clusters, area) when it was written
+        @param entry: dictionary with area and clusters
+        @return True if modified
+        """
+        return written[0] is not entry or written[1] is not entry['clusters'] or \
+               written[2] != len(entry['clusters']) or written[3] != entry['area']
+
+
+    def write(self, restart_data):
+        """
+        Write the changes since the last file
+        @param restart_data: dictionary with tcc, minmax_lons, minmax_lats, fyear,
+                             list_filename and pickle_index
+        """
+        # write the whole state again once the deltas are bigger than the last base
+        base = self.seq == 0 or self.delta_size > self.base_size
+        if base:
+            self.serials = {}
+            self.tracks = {}
+            self.written = {}
+            self.num_filenames = 0
+
+        tcc = restart_data['tcc']
+        tracks = {}
+        deleted = {}
+        order = []
+        for track in tcc.cluster_connect:
+            serial = self.serials.get(id(track))
+            if serial is None:
+                # new track
+                serial = self.next_serial
+                self.next_serial += 1
+                tracks[serial] = track
+            else:
+                # new or modified time steps of a known track
+                written = self.written[serial]
+                entries = {}
+                for t_index, entry in track.items():
+                    if t_index not in written or self.isModified(written[t_index], entry):
+                        entries[t_index] = entry
+                if entries:
+                    tracks[serial] = entries
+                removed = [t_index for t_index in written if t_index not in track]
+                if removed:
+                    deleted[serial] = removed
+            order.append(serial)
+
+        list_filename = list(restart_data['list_filename'])
+        record = {'version': self.VERSION, 'base': base, 'tracks': tracks, 'deleted': deleted, \
+                  'order': order, 'next_serial': self.next_serial, 't_index': tcc.t_index, \
+                  'num_clusters': tcc.num_clusters, \
+                  'filenames': list_filename[self.num_filenames:], \
+                  'minmax_lons': restart_data['minmax_lons'], \
+                  'minmax_lats': restart_data['minmax_lats'], \
+                  'fyear': restart_data['fyear'], 'pickle_index': restart_data['pickle_index']}
+
+        filename = os.path.join(self.dirname, '%06d_%s.pkl.gz' % \
+                                (self.seq, 'base' if base else 'delta'))
+        size = self.writeFile(filename, record)
+        self.seq += 1
+        self.num_filenames = len(list_filename)
+
+        # remember the state that was written, tracks that are gone are forgotten
+        serials = set(order)
+        for serial in self.tracks.keys():
+            if serial not in serials:
+                del self.serials[id(self.tracks[serial])]
+                del self.tracks[serial]
+                del self.written[serial]
+        for track, serial in zip(tcc.cluster_connect, order):
+            self.setWritten(serial, track)
+
+        if base:
+            self.base_size = size
+            self.delta_size = 0
+            self.removeOldFiles()
+        else:
+            self.delta_size += size
+
+
+    def writeFile(self, filename, record):
+        """
+        Write a file atomically: the data is synced under a temporary name before the file
+        is renamed
+        @param filename: file name
+        @param record: data to write
+        @return size of the file
+        """
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gzf:
+                cPickle.dump(record, gzf, cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, filename)
+        fd = os.open(self.dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return os.path.getsize(filename)
+
+
+    def removeOldFiles(self):
+        """
+        Remove the files written before the last base
+        """
+        files = sorted(glob.glob(os.path.join(self.dirname, '[0-9]*.pkl.gz*')))
+        last_base = self.getFiles()[0]
+        for filename in files:
+            if filename < last_base:
+                os.remove(filename)
+
+
+#############################################################################################
+
+def compareTracks(tracks1, tracks2):
+    assert(len(tracks1) == len(tracks2))
+    for track1, track2 in zip(tracks1, tracks2):
+        assert(sorted(track1.keys()) == sorted(track2.keys()))
+        for t_index in track1:
+            assert(track1[t_index]['area'] == track2[t_index]['area'])
+            cls1 = track1[t_index]['clusters']
+            cls2 = track2[t_index]['clusters']
+            assert(len(cls1) == len(cls2))
+            for cl1, cl2 in zip(cls1, cls2):
+                assert(cl1.getNumberOfCells() == cl2.getNumberOfCells())
+                assert(cl1.getNumberOfCommonCells(cl2) == cl1.getNumberOfCells())
+
+def testCheckpoint():
+    import shutil
+    import tempfile
+    import numpy as np
+    from datetime import datetime, timedelta as td
+    from cluster import Cluster
+
+    np.random.seed(42)
+    pos = np.random.random((30, 2)) * 200
+    vel = np.random.randn(30, 2)
+    def step(tcc):
+        clusters = []
+        for p in pos[np.random.random(len(pos)) < 0.8]:
+            n = np.random.randint(5, 40)
+            iis = (p[0] + np.random.randn(n) * 3).astype(np.int32)
+            jjs = (p[1] + np.random.randn(n) * 3).astype(np.int32)
+            clusters.append(Cluster((iis, jjs), min_ellipse_axis=6))
+        tcc.addTime(clusters, 1.0, 0.9)
+        pos[:] += vel
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dirname = os.path.join(tmpdir, 'restart')
+        checkpoint = Checkpoint(dirname)
+        tcc = TimeConnectedClusters()
+        list_filename = []
+        sizes = []
+        for day in range(12):
+            for t in range(4):
+                step(tcc)
+            # remove some old tracks, as a harvest does
+            for track_id in reversed(range(tcc.getNumberOfTracks())):
+                if max(tcc.cluster_connect[track_id]) < tcc.t_index - 3:
+                    tcc.removeTrack(track_id)
+            list_filename.append('Cmorph-2010_02_%02d.nc.bz2' % (day + 1))
+            restart_data = {'tcc': tcc, 'minmax_lons': [10, 20], 'minmax_lats': [0, 30], \
+                            'fyear': datetime(2010, 2, day + 2), \
+                            'list_filename': list_filename, 'pickle_index': day}
+            checkpoint.write(restart_data)
+            sizes.append((checkpoint.base_size, checkpoint.delta_size))
+
+            # a new writer replays the same state
+            res = Checkpoint(dirname).load()
+            compareTracks(res['tcc'].cluster_connect, tcc.cluster_connect)
+            assert(res['tcc'].t_index == tcc.t_index)
+            assert(res['list_filename'] == list_filename)
+            assert(res['pickle_index'] == day)
+            assert(res['fyear'] == datetime(2010, 2, day + 2))
+
+        # deltas were written and a new base was written at some point
+        files = os.listdir(dirname)
+        assert(any(f.endswith('_delta.pkl.gz') for f in files))
+        assert(not os.path.exists(os.path.join(dirname, '000000_base.pkl.gz')))
+
+        # continue from a loaded state, and ignore an interrupted write
+        checkpoint = Checkpoint(dirname)
+        res = checkpoint.load()
+        tcc = res['tcc']
+        step(tcc)
+        res['list_filename'].append('Cmorph-2010_02_13.nc.bz2')
+        checkpoint.write(res)
+        open(os.path.join(dirname, '%06d_delta.pkl.gz.tmp' % checkpoint.seq), 'w').write('xx')
+        res2 = Checkpoint(dirname).load()
+        compareTracks(res2['tcc'].cluster_connect, tcc.cluster_connect)
+        assert(len(res2['list_filename']) == 13)
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testCheckpoint OK'
+
+
+if __name__ == '__main__':
+    testCheckpoint()
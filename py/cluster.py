@@ -7,22 +7,141 @@ Created in May 2018
 '''
 import numpy
 import math
-from ellipse import Ellipse
-
-class Cluster:
+from ellipse import Ellipse, cellMoments, labelMoments, fitMoments, NUM_MOMENTS
+
+# cells are compared as int64 keys i*KEY_SHIFT + j, which are sorted in the same
+# order as the (i, j) pairs
+KEY_SHIFT = 2**32
+
+
+def cellsToKeys(iis, jjs):
+    """
+    Encode cell indices as keys
+    @param iis: i indices
+    @param jjs: j indices
+    @return int64 array
+    """
+    return numpy.asarray(iis, numpy.int64) * KEY_SHIFT + numpy.asarray(jjs, numpy.int64)
+
+
+def keysToCells(keys):
+    """
+    Decode keys into cell indices
+    @param keys: int64 array
+    @return i indices, j indices as int32 arrays
+    """
+    iis = (keys + KEY_SHIFT // 2) // KEY_SHIFT
+    jjs = keys - iis * KEY_SHIFT
+    return iis.astype(numpy.int32), jjs.astype(numpy.int32)
+
+
+def sortedCells(cells):
+    """
+    Get sorted cell indices without duplicates
+    @param cells: set of (i,j) tuples or tuple of i and j index arrays
+    @return i indices, j indices as int32 arrays
+    """
+    if isinstance(cells, tuple) and len(cells) == 2 and isinstance(cells[0], numpy.ndarray):
+        iis, jjs = cells
+    else:
+        n = len(cells)
+        iis = numpy.fromiter((c[0] for c in cells), numpy.int64, n)
+        jjs = numpy.fromiter((c[1] for c in cells), numpy.int64, n)
+    return keysToCells(numpy.unique(cellsToKeys(iis, jjs)))
+
+
+def clustersFromGroups(iis, jjs, groups, min_ellipse_axis=1):
+    """
+    Build the clusters of several groups of cells at once, the ellipses and boxes of all
+    the groups are computed together from the moments of their cells
+    @param iis: i indices of the cells, sorted by group then i then j, without duplicates
+    @param jjs: j indices of the cells
+    @param groups: group of each cell (non negative integers), in increasing order
+    @param min_ellipse_axis: minimum axis length used in isCentreInsideOfExt
+    @return list of clusters, one per group with cells in increasing order
+    """
+    iis = numpy.asarray(iis, numpy.int32)
+    jjs = numpy.asarray(jjs, numpy.int32)
+    num_cells = numpy.bincount(groups)
+    used = numpy.flatnonzero(num_cells)
+    ends = numpy.cumsum(num_cells)[used]
+    starts = ends - num_cells[used]
+    moments = labelMoments(groups, iis, jjs, len(num_cells))[used]
+    fitted = fitMoments(moments, min_ellipse_axis)
+
+    # the cells of a group are sorted by i
+    i_min, i_max = iis[starts], iis[ends - 1]
+    j_min = numpy.minimum.reduceat(jjs, starts) if len(starts) else starts
+    j_max = numpy.maximum.reduceat(jjs, starts) if len(starts) else starts
+
+    res = []
+    for n in range(len(used)):
+        cl = Cluster.__new__(Cluster)
+        cl.iis = iis[starts[n]:ends[n]]
+        cl.jjs = jjs[starts[n]:ends[n]]
+        cl.min_ellipse_axis = min_ellipse_axis
+        cl.moments = moments[n]
+        cl.ellipse = Ellipse(None, min_ellipse_axis, fitted=(fitted, n))
+        cl.box = [[int(i_min[n]), int(j_min[n])], [int(i_max[n]), int(j_max[n])]]
+        res.append(cl)
+    return res
+
+
+def countCommonCells(clusters0, clusters1):
+    """
+    Count the common cells of all the pairs of clusters of two lists in one pass, instead of
+    intersecting the cells of each pair. The cells of each list are encoded as keys with the
+    index of their cluster, the common keys are found by a search in the sorted keys of the
+    second list and the pairs of indices are counted at once. Clusters of the same list may
+    share cells
+    @param clusters0: list of clusters
+    @param clusters1: list of clusters
+    @return dictionary with (index in clusters0, index in clusters1) as key and the number of
+            common cells as value, only for the pairs that share cells
+    """
+    if not clusters0 or not clusters1:
+        return {}
+    num1 = len(clusters1)
+    keys0 = numpy.concatenate([cl.getKeys() for cl in clusters0])
+    owners0 = numpy.repeat(numpy.arange(len(clusters0)), \
+                           [cl.getNumberOfCells() for cl in clusters0])
+    keys1 = numpy.concatenate([cl.getKeys() for cl in clusters1])
+    owners1 = numpy.repeat(numpy.arange(num1), [cl.getNumberOfCells() for cl in clusters1])
+    order = numpy.argsort(keys1, kind='mergesort')
+    keys1 = keys1[order]
+    owners1 = owners1[order]
+
+    # range of equal keys of the second list for each key of the first one
+    first = numpy.searchsorted(keys1, keys0, 'left')
+    num = numpy.searchsorted(keys1, keys0, 'right') - first
+    total = num.sum()
+    if total == 0:
+        return {}
+    offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(num) - num, num)
+    pairs = numpy.repeat(owners0, num) * num1 + owners1[numpy.repeat(first, num) + offsets]
+    pairs, counts = numpy.unique(pairs, return_counts=True)
+    return dict(((int(p // num1), int(p % num1)), int(c)) for p, c in zip(pairs, counts))
+
+
+class Cluster(object):
+
+    __slots__ = ('iis', 'jjs', 'min_ellipse_axis', 'moments', 'ellipse', 'box')
 
     def __init__(self, cells={}, min_ellipse_axis=1):
         """
         Constructor
-        @param cells: set of (i,j) tuples
+        @param cells: set of (i,j) tuples or tuple of i and j index arrays
         @param min_ellipse_axis: minimum axis length used in isCentreInsideOfExt
         """
-        # set of i,j cells
-        self.cells = cells
+        # i and j indices of the cells, sorted by i then j
+        self.iis, self.jjs = sortedCells(cells)
 
         # want the ellipse axes to scale to at least this area
         self.min_ellipse_axis = min_ellipse_axis
 
+        # moments of the cells, from which the ellipse is computed (see cellMoments)
+        self.moments = None
+
         # ellipse representing the "average" distribution
         # of cells
         self.ellipse = None
@@ -34,20 +153,75 @@ class Cluster:
         self.update()
 
 
+    @property
+    def cells(self):
+        """
+        Set of (i,j) tuples, built from the index arrays
+        """
+        return set(zip(self.iis.tolist(), self.jjs.tolist()))
+
+
+    @cells.setter
+    def cells(self, cells):
+        self.iis, self.jjs = sortedCells(cells)
+
+
+    def getKeys(self):
+        """
+        Get the cells as sorted keys
+        @return int64 array
+        """
+        return cellsToKeys(self.iis, self.jjs)
+
+
     def getNumberOfCells(self):
         """
         Get the number of cells
         @return number
         """
-        return len(self.cells)
+        return len(self.iis)
 
 
-    def update(self):
-        if len(self.cells) > 0:
-            self.ellipse = Ellipse(self.cells, min_ellipse_axis=self.min_ellipse_axis)
-            for dim in range(0, 2):
-                self.box[0][dim] = numpy.min([c[dim] for c in self.cells])
-                self.box[1][dim] = numpy.max([c[dim] for c in self.cells])
+    def update(self, moments=None):
+        """
+        Compute the ellipse and the box of the cells
+        @param moments: moments of the cells if they are known, computed otherwise
+        """
+        if moments is None:
+            moments = cellMoments(self.iis, self.jjs)
+        self.moments = moments
+        if len(self.iis) > 0:
+            self.ellipse = Ellipse(None, min_ellipse_axis=self.min_ellipse_axis, moments=moments)
+            self.box[0][0] = int(self.iis[0])
+            self.box[1][0] = int(self.iis[-1])
+            self.box[0][1] = int(self.jjs.min())
+            self.box[1][1] = int(self.jjs.max())
+
+
+    def isBoxOverlapping(self, otherCluster):
+        """
+        Check if the boxes of the two clusters overlap
+        @param otherCluster: other cluster
+        @return True if overlap
+        """
+        if self.getNumberOfCells() == 0 or otherCluster.getNumberOfCells() == 0:
+            return False
+        for dim in range(0, 2):
+            if self.box[0][dim] > otherCluster.box[1][dim] or \
+                    otherCluster.box[0][dim] > self.box[1][dim]:
+                return False
+        return True
+
+
+    def getNumberOfCommonCells(self, otherCluster):
+        """
+        Get the number of cells shared with another cluster
+        @param otherCluster: other cluster
+        @return number
+        """
+        if not self.isBoxOverlapping(otherCluster):
+            return 0
+        return len(numpy.intersect1d(self.getKeys(), otherCluster.getKeys(), assume_unique=True))
 
 
     def isCentreInsideOf(self, otherCluster):
@@ -75,8 +249,8 @@ class Cluster:
         @param frac: fraction of min area of self
         @return True if at least frac is inside
         """
-        min_area = min(len(self.cells), len(otherCluster.cells))
-        return len(self.cells.intersection(otherCluster.cells)) >= frac * min_area
+        min_area = min(self.getNumberOfCells(), otherCluster.getNumberOfCells())
+        return self.getNumberOfCommonCells(otherCluster) >= frac * min_area
 
 
     def getCentre(self):
@@ -104,16 +278,25 @@ class Cluster:
         @param otherCluster
         @return intersection of self with otherCluster
         """
-        return Cluster(self.cells.intersection(otherCluster.cells))
+        keys = numpy.intersect1d(self.getKeys(), otherCluster.getKeys(), assume_unique=True)
+        return Cluster(keysToCells(keys))
 
 
     def __iadd__(self, otherCluster):
         """
-        Overload of += operator, add othercluster cells to self
+        Overload of += operator, add othercluster cells to self. The moments of the union
+        are the sum of the moments minus the moments of the common cells
         @param otherCluster: other cluster
         """
-        self.cells = self.cells.union(otherCluster.cells)
-        self.update()
+        keys = numpy.concatenate((self.getKeys(), otherCluster.getKeys()))
+        keys.sort(kind='mergesort')
+        duplicate = keys[1:] == keys[:-1]
+        moments = self.moments + otherCluster.moments
+        if duplicate.any():
+            moments -= cellMoments(*keysToCells(keys[1:][duplicate]))
+            keys = keys[numpy.concatenate(([True], ~duplicate))]
+        self.iis, self.jjs = keysToCells(keys)
+        self.update(moments)
         return self
 
 
@@ -142,7 +325,7 @@ class Cluster:
         @param bounds: [[iMin, jMin], [iMax, jMax]]
         @return array of coordinates, array of zeros and ones
         """
-        if len(self.cells) <= 0:
+        if self.getNumberOfCells() <= 0:
             return numpy.array([]), numpy.array([]), numpy.array([])
 
         if not bounds:
@@ -151,19 +334,41 @@ class Cluster:
         jCoords = numpy.arange(bounds[0][1], bounds[1][1] + 1)
         ijValues = numpy.zeros((len(iCoords), len(jCoords)), numpy.int32)
         iMin, jMin = bounds[0]
-        for c in self.cells:
-            ijValues[c[0] - iMin, c[1] - jMin] = 1
+        ijValues[self.iis - iMin, self.jjs - jMin] = 1
 
         return iCoords, jCoords, ijValues
 
 
+    def __getstate__(self):
+        """
+        Needed to pickle a class with __slots__, the moments are computed again when the
+        cluster is read
+        """
+        return {'iis': self.iis, 'jjs': self.jjs, 'min_ellipse_axis': self.min_ellipse_axis,
+                'ellipse': self.ellipse, 'box': self.box}
+
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled cluster, also the ones pickled with a set of (i,j) tuples
+        """
+        if 'cells' in state:
+            self.iis, self.jjs = sortedCells(state['cells'])
+        else:
+            self.iis, self.jjs = state['iis'], state['jjs']
+        self.min_ellipse_axis = state['min_ellipse_axis']
+        self.moments = cellMoments(self.iis, self.jjs)
+        self.ellipse = state['ellipse']
+        self.box = state['box']
+
+
     def __repr__(self):
         """
         Print object
         """
         res = """
         Cluster: num cells = {} box = {} ellipse centre = {} a = {} b = {} transf = {} angle = {}
-        """.format(len(self.cells), self.box, \
+        """.format(self.getNumberOfCells(), self.box, \
             self.ellipse.centre, self.ellipse.a, self.ellipse.b, \
             self.ellipse.ij2AxesTransf, self.ellipse.angle)
         return res
@@ -210,6 +415,87 @@ def testTimes():
     assert(c2.getNumberOfCells() == 1)
     print 'testTimes intersection: ', c2
 
+def testSetOperations():
+    # compare with the same operations on sets of (i,j) tuples
+    import random
+    random.seed(1234)
+    for n in range(20):
+        s0 = {(random.randint(-20, 20), random.randint(-20, 20)) for i in range(150)}
+        s1 = {(random.randint(-20, 20), random.randint(-20, 20)) for i in range(100)}
+        c0 = Cluster(s0)
+        c1 = Cluster((numpy.array([c[0] for c in s1]), numpy.array([c[1] for c in s1])))
+        assert(c0.cells == s0 and c1.cells == s1)
+        assert((c0 * c1).cells == s0.intersection(s1))
+        assert(c0.getNumberOfCommonCells(c1) == len(s0.intersection(s1)))
+        assert(c0.isClusterInsideOf(c1, 0.) and not c0.isClusterInsideOf(c1, 1.))
+        c0 += c1
+        assert(c0.cells == s0.union(s1))
+        assert(c0.box == [[min(c[0] for c in c0.cells), min(c[1] for c in c0.cells)],
+                          [max(c[0] for c in c0.cells), max(c[1] for c in c0.cells)]])
+        i_index, j_index, mat = c0.toArray()
+        assert(mat.sum() == c0.getNumberOfCells())
+    print 'testSetOperations OK'
+
+def testClustersFromGroups():
+    # same clusters and ellipses as building each cluster from its cells
+    import random
+    random.seed(1234)
+    cells = sorted({(random.randint(-5, 40), random.randint(0, 60), random.randint(1, 6)) \
+                    for i in range(800)}, key=lambda c: (c[2], c[0], c[1]))
+    iis, jjs, groups = [numpy.array(x) for x in zip(*cells)]
+    res = clustersFromGroups(iis, jjs, groups, min_ellipse_axis=3)
+    assert(len(res) == 6)
+    for cl, num in zip(res, range(1, 7)):
+        ref = Cluster((iis[groups == num], jjs[groups == num]), min_ellipse_axis=3)
+        assert(cl.cells == ref.cells and cl.box == ref.box and cl.iis.dtype == ref.iis.dtype)
+        assert(numpy.array_equal(cl.moments, ref.moments))
+        for name in 'centre', 'a', 'b', 'aExt', 'bExt', 'angle', 'ij2AxesTransf':
+            assert(numpy.allclose(getattr(cl.ellipse, name), getattr(ref.ellipse, name)))
+
+        # the moments of a merge are the moments of the union of the cells
+        other = Cluster({(i, 0) for i in range(-10, 10)})
+        cl += other
+        ref = Cluster(ref.cells.union(other.cells), min_ellipse_axis=3)
+        assert(numpy.array_equal(cl.moments, ref.moments))
+        assert(numpy.allclose(cl.ellipse.centre, ref.ellipse.centre))
+        assert(numpy.allclose(cl.ellipse.a, ref.ellipse.a))
+    assert(clustersFromGroups(iis[:0], jjs[:0], groups[:0]) == [])
+    print 'testClustersFromGroups OK'
+
+def testCountCommonCells():
+    # same as intersecting each pair, with clusters sharing cells in the same list
+    import random
+    random.seed(1234)
+    for n in range(10):
+        clusters = []
+        for k in range(12):
+            i0, j0 = random.randint(0, 30), random.randint(0, 30)
+            clusters.append(Cluster({(i0 + random.randint(0, 8), j0 + random.randint(0, 8)) \
+                                     for i in range(40)}))
+        clusters0, clusters1 = clusters[:5], clusters[5:]
+        res = countCommonCells(clusters0, clusters1)
+        for n0, cl0 in enumerate(clusters0):
+            for n1, cl1 in enumerate(clusters1):
+                assert(res.get((n0, n1), 0) == cl0.getNumberOfCommonCells(cl1))
+        assert(all(num > 0 for num in res.values()))
+    assert(countCommonCells(clusters0, []) == {})
+    assert(countCommonCells([Cluster({(0, 0)})], [Cluster({(0, 1)})]) == {})
+    print 'testCountCommonCells OK'
+
+def testPickle():
+    import cPickle
+    c0 = Cluster({(1, 1), (2, 1), (2, 2)}, min_ellipse_axis=6)
+    c1 = cPickle.loads(cPickle.dumps(c0))
+    assert(c1.cells == c0.cells and c1.box == c0.box and c1.min_ellipse_axis == 6)
+    assert(numpy.array_equal(c1.ellipse.centre, c0.ellipse.centre))
+
+    # clusters pickled when cells were stored as a set
+    c2 = Cluster()
+    c2.__setstate__({'cells': {(2, 2), (1, 1), (2, 1)}, 'min_ellipse_axis': 6,
+                     'ellipse': c0.ellipse, 'box': c0.box})
+    assert(numpy.array_equal(c2.iis, c0.iis) and numpy.array_equal(c2.jjs, c0.jjs))
+    print 'testPickle OK'
+
 def testInsideEllipse():
     rect0 = {(2, 2), (3, 2), (6, 2), (7, 2), (8, 2),
              (2, 3), (3, 3), (6, 3), (7, 3), (8, 3),
@@ -275,5 +561,9 @@ if __name__ == '__main__':
     testRandom()
     testPlusEqual()
     testTimes()
+    testSetOperations()
+    testClustersFromGroups()
+    testCountCommonCells()
+    testPickle()
     testInsideEllipse()
     testAngle()
@@ -10,10 +10,17 @@ from scipy import ndimage
 import cv2
 from netCDF4 import Dataset as nc
 import argparse
+import copy
+import hashlib
+import os
 
 class CoastalMapping:
 
-    def __init__(self, dataname, reso, lat_slice, lon_slice, szone, lzone, min_size, max_size):
+    # increase when the way masks are built changes, to invalidate the cached masks
+    CACHE_VERSION = 1
+
+    def __init__(self, dataname, reso, lat_slice, lon_slice, szone, lzone, min_size, max_size,
+                 cache_dir=None):
         """
         Extract clusters from an image data
         @param dataname: land-sea mask
@@ -24,12 +31,39 @@ class CoastalMapping:
         @param lzone: number of pixels to define large coastal area where clusters are tracked
         @param min_size: minimal size of island below which islands are removed from mask
         @param max_size: maximal size of island that should be filled
+        @param cache_dir: directory where the masks are cached between runs (None for no cache)
         @return mask of the two coastal areas
         """
         # load parameters and land-sea mask
         self.reso = reso
         self.min_size = min_size
         self.max_size = max_size
+
+        # reuse the masks of a previous run with the same land-sea mask and parameters
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = self.getCacheFile(cache_dir, dataname, lat_slice, lon_slice, szone, lzone)
+            if os.path.isfile(cache_file):
+                print 'Loading coastal masks from', cache_file
+                self.loadMasks(cache_file)
+                return
+
+        self.createMasks(dataname, lat_slice, lon_slice, szone, lzone)
+
+        if cache_file is not None:
+            print 'Saving coastal masks to', cache_file
+            self.saveMasks(cache_file)
+
+
+    def createMasks(self, dataname, lat_slice, lon_slice, szone, lzone):
+        """
+        Create the filled land-sea mask and the two coastal areas
+        @param dataname: land-sea mask
+        @param lat_slice
+        @param lon_slice
+        @param szone: number of pixels to define area close to islands
+        @param lzone: number of pixels to define large coastal area where clusters are tracked
+        """
         if self.reso==8:
             print dataname
             if lon_slice.start < lon_slice.stop:
@@ -39,7 +73,7 @@ class CoastalMapping:
                 slm2 = nc(dataname).variables['lsm'][lat_slice,:lon_slice.stop]
                 slm = np.concatenate((slm1, slm2), axis=1)
         else :
-            print 'prob reso', reso, self.reso
+            print 'prob reso', self.reso
             slm_3d = nc(dataname).variables['lsmask'][:,:,:]
             len_lat = np.shape(slm_3d)[1]
             slm_short = slm_3d[:,len_lat/6:len_lat-len_lat/6,:] # remove first and last 30 degres
@@ -50,6 +84,7 @@ class CoastalMapping:
         slm_fill = self.fillIslands(new_slm.copy())
         land_fill = (1-new_slm)+slm_fill
         land_fill[np.where(land_fill>=1)] = 1
+        self.slmFill = slm_fill
 
         # remove islands whose area is smaller than min_size
         slm_nosmall = self.eraseIslands(land_fill,new_slm)
@@ -72,6 +107,70 @@ class CoastalMapping:
             self.lArea[slat_box:elat_box,slon_box:elon_box]=1
 
 
+    def getCacheFile(self, cache_dir, dataname, lat_slice, lon_slice, szone, lzone):
+        """
+        Get the name of the cache file, built from the content of the land-sea mask and
+        from all the parameters used to create the masks
+        @param cache_dir: directory of the cache
+        @param dataname: land-sea mask
+        @param lat_slice
+        @param lon_slice
+        @param szone: number of pixels to define area close to islands
+        @param lzone: number of pixels to define large coastal area where clusters are tracked
+        @return file name
+        """
+        key = hashlib.sha1()
+        with open(dataname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+        params = (self.CACHE_VERSION, self.reso, lat_slice.start, lat_slice.stop, \
+                  lon_slice.start, lon_slice.stop, szone, lzone, self.min_size, self.max_size)
+        key.update(repr(tuple(int(p) for p in params)))
+        return os.path.join(cache_dir, 'coastal_mapping_' + key.hexdigest() + '.npz')
+
+
+    def saveMasks(self, filename):
+        """
+        Save the masks in a compressed file. The file is written under a temporary name
+        and renamed so that an interrupted run never leaves a truncated cache
+        @param filename: file name
+        """
+        cache_dir = os.path.dirname(filename)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_filename = filename + '.tmp%d' % os.getpid()
+        with open(tmp_filename, 'wb') as f:
+            np.savez_compressed(f, lArea=self.lArea.astype(np.uint8), \
+                                sArea=self.sArea.astype(np.uint8), slmFill=self.slmFill)
+        os.rename(tmp_filename, filename)
+
+
+    def loadMasks(self, filename):
+        """
+        Load the masks written by saveMasks
+        @param filename: file name
+        """
+        with np.load(filename) as cache:
+            self.lArea = cache['lArea'].astype(np.float64)
+            self.sArea = cache['sArea'].astype(np.float64)
+            self.slmFill = cache['slmFill']
+
+
+    def getLonBand(self, j_start, j_stop):
+        """
+        Get the masks of a band of longitudes of the region, the same as in the masks of the
+        whole region (the masks of a smaller region differ near its sides)
+        @param j_start: first longitude index, relative to the region
+        @param j_stop: last longitude index + 1, relative to the region
+        @return CoastalMapping instance with the masks of the band
+        """
+        band = copy.copy(self)
+        band.lArea = self.lArea[:, j_start:j_stop].copy()
+        band.sArea = self.sArea[:, j_start:j_stop].copy()
+        band.slmFill = self.slmFill[:, j_start:j_stop].copy()
+        return band
+
+
     def findCoastline(self,data,smooth_radius=2.5):
         """
         Finds coastlines in a slm-array
@@ -96,19 +195,21 @@ class CoastalMapping:
         """
         slm = np.ma.masked_where(slm==0,slm).filled(255)
         slm = np.ma.masked_where(slm==1,slm).filled(0)
-        tmp = slm.astype(np.uint8)
-        result = cv2.findContours(tmp,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-        cnt = result[-2]
-        hir = result[-1]
-        hir = hir[0]
+        land = slm.astype(np.uint8) != 0
 
         # km2 in one grid point
         A = self.reso*self.reso*1.
         # size in grid points
         size = self.max_size/A
-        for i,c in zip(hir,cnt):
-            if cv2.contourArea(c) > size:
-                cv2.drawContours(slm,[c],-1,0,-1)
+
+        # islands whose contour is larger than size are removed with their lakes, one lookup
+        # table per level of islands in lakes (see fillIslandsContours)
+        big = np.zeros(land.shape, bool)
+        for labels, areas in islandLevels(land):
+            lut = areas > size
+            lut[0] = False
+            big |= lut[labels]
+        slm[big] = 0
         slm = np.ma.masked_where(slm==255,slm).filled(1)
         return slm.astype(np.int8)
 
@@ -120,23 +221,14 @@ class CoastalMapping:
         @param slm: array to get good coastline detection on side of domain
         @return new_mask: the new land-sea mask (without islands smaller than min_size)
         """
-        Tmp = land.astype(np.uint8)
-        result = cv2.findContours(Tmp,cv2.RETR_TREE,cv2.CHAIN_APPROX_NONE)
-        cnts = result[-2]
-        tmpary = np.zeros(land.shape)
-        new_mask = np.zeros(land.shape)
-        for index,cnt in enumerate(cnts):
-            cimg = np.zeros_like(land)
-
-            # draw contours of cluster
-            cv2.drawContours(cimg, cnts, index, color=255, thickness=-1)
-
-            # calculate the area covered by the contour km**2
-            Area = max(self.reso**2*cv2.contourArea(cnt), self.reso*self.reso)
-            if Area > self.min_size:
-                cv2.drawContours(tmpary,[cnt],-1,1,-1)
-
-        new_mask=1-tmpary
+        # islands with their lakes whose contour is larger than min_size, one lookup table
+        # per level of islands in lakes (see eraseIslandsContours)
+        keep = np.zeros(land.shape, bool)
+        for labels, areas in islandLevels(np.asarray(land.astype(np.uint8)) != 0):
+            lut = np.maximum(self.reso**2*areas, self.reso*self.reso) > self.min_size
+            lut[0] = False
+            keep |= lut[labels]
+        new_mask = 1-keep.astype(np.float64)
         return new_mask
 
 
@@ -160,18 +252,165 @@ class CoastalMapping:
         @param val: value of lands in mask
         @return new_mask: array with coastal areas
         """
-        nY,nX = data.shape
-        new_data = np.zeros((nY,nX))
+        return coastalZone(data, radius, val)
+
 
-        # create circle mask around each coastal point
-        for i in xrange(nY):
-            for j in xrange(nX):
-                if data[i,j] == val:
-                    y,x = np.ogrid[-i:nY-i, -j:nX-j]
-                    zone = x*x + y*y <= (2*radius+1)*(2*radius+1)
-                    new_data[zone] = 1
+def coastalZone(data, radius, val):
+    """
+    Mark every point whose distance to the nearest coastal point is at most 2*radius+1,
+    using one Euclidean distance transform instead of one circle per coastal point
+    @param data: array of the islands
+    @param radius: size of the zone around islands
+    @param val: value of lands in mask
+    @return new_data: array with coastal areas
+    """
+    coast = (data == val)
+    new_data = np.zeros(data.shape)
+    if not coast.any():
         return new_data
 
+    # distance of each point to the closest coastal point. The squared distances are
+    # integers, rounding makes the comparison exact
+    dist = ndimage.distance_transform_edt(~coast)
+    dist2 = np.rint(dist*dist)
+    new_data[dist2 <= (2*radius+1)*(2*radius+1)] = 1
+    return new_data
+
+
+def fillLakes(land):
+    """
+    Fill the lakes of the islands
+    @param land: boolean array, True over land
+    @return land with the lakes, the 4-connected groups of water cells that do not touch the
+            sides of the array, filled
+    """
+    water, num = ndimage.label(~land)
+    lakes = np.ones(num + 1, bool)
+    lakes[0] = False
+    for side in water[0], water[-1], water[:, 0], water[:, -1]:
+        lakes[side] = False
+    return land | lakes[water]
+
+
+def contourAreas(filled, labels, num):
+    """
+    Compute the area of the contour of each island as cv2.contourArea does. The contour goes
+    through the centres of the cells on the side of the island, so each square of 2 x 2
+    cells adds 1 when its 4 cells are in the island and 1/2 when 3 are (it is cut along its
+    diagonal), and nothing otherwise
+    @param filled: boolean array of the islands with their lakes filled
+    @param labels: labels of the islands with their lakes filled
+    @param num: number of labels
+    @return area of each label, 0 for label 0
+    """
+    cells = filled.astype(np.uint8)
+    count = cells[:-1, :-1] + cells[:-1, 1:] + cells[1:, :-1] + cells[1:, 1:]
+    iis, jjs = np.nonzero(count >= 3)
+    # a square with 3 cells has its top left or its bottom right cell, all in the same island
+    nums = np.maximum(labels[iis, jjs], labels[iis + 1, jjs + 1])
+    return np.bincount(nums, weights=(count[iis, jjs] - 2) * 0.5, minlength=num + 1)
+
+
+def islandLevels(land):
+    """
+    Find the islands, the 8-connected groups of land cells which are the outer contours of
+    cv2.findContours, level by level: the islands in the sea first, then the islands in
+    their lakes, and so on. The islands of a level are labelled with their lakes filled,
+    which is the inside of their contour
+    @param land: boolean array, True over land
+    @return list of (labels of the filled islands of a level, area of the contour of each
+            label as given by cv2.contourArea, 0 for label 0)
+    """
+    land = land.copy()
+    islands, num_islands = ndimage.label(land, structure=np.ones((3, 3)))
+    levels = []
+    while land.any():
+        filled = fillLakes(land)
+        labels, num = ndimage.label(filled, structure=np.ones((3, 3)))
+        levels.append((labels, contourAreas(filled, labels, num)))
+
+        # labels are numbered in the order of their first cell, which is on the contour and
+        # so in the island of the level, the other islands of the label are in its lakes
+        inds = np.flatnonzero(labels)
+        nums = labels.ravel()[inds]
+        first = np.ones(len(nums), bool)
+        first[1:] = nums[1:] > np.maximum.accumulate(nums)[:-1]
+        outer = np.zeros(num_islands + 1, bool)
+        outer[islands.ravel()[inds[first]]] = True
+        land &= ~outer[islands]
+    return levels
+
+
+def fillIslandsContours(slm, reso, max_size):
+    """
+    Original implementation of CoastalMapping.fillIslands, drawing the contours of the big
+    islands one by one. Only kept to check fillIslands
+    @param slm: land-sea mask
+    @param reso: resolution in km
+    @param max_size: maximal size of island that should be filled
+    @return array with big islands filled with 1
+    """
+    slm = np.ma.masked_where(slm==0,slm).filled(255)
+    slm = np.ma.masked_where(slm==1,slm).filled(0)
+    tmp = slm.astype(np.uint8)
+    result = cv2.findContours(tmp,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
+    cnt = result[-2]
+
+    # km2 in one grid point
+    A = reso*reso*1.
+    # size in grid points
+    size = max_size/A
+    for c in cnt:
+        if cv2.contourArea(c) > size:
+            cv2.drawContours(slm,[c],-1,0,-1)
+    slm = np.ma.masked_where(slm==255,slm).filled(1)
+    return slm.astype(np.int8)
+
+
+def eraseIslandsContours(land, reso, min_size):
+    """
+    Original implementation of CoastalMapping.eraseIslands, drawing the contours of the
+    islands one by one (without the drawing of each contour in an unused image). Only kept
+    to check eraseIslands
+    @param land: array with islands filled and coastline.
+    @param reso: resolution in km
+    @param min_size: minimal size of island below which islands are removed from mask
+    @return new_mask: the new land-sea mask (without islands smaller than min_size)
+    """
+    Tmp = land.astype(np.uint8)
+    result = cv2.findContours(Tmp,cv2.RETR_TREE,cv2.CHAIN_APPROX_NONE)
+    cnts = result[-2]
+    tmpary = np.zeros(land.shape)
+    for cnt in cnts:
+        # calculate the area covered by the contour km**2
+        Area = max(reso**2*cv2.contourArea(cnt), reso*reso)
+        if Area > min_size:
+            cv2.drawContours(tmpary,[cnt],-1,1,-1)
+    new_mask=1-tmpary
+    return new_mask
+
+
+def coastalZoneLoop(data, radius, val):
+    """
+    Original implementation of coastalZone, stamping a circle around each coastal point.
+    Very slow on large domains, only kept to check coastalZone
+    @param data: array of the islands
+    @param radius: size of the zone around islands
+    @param val: value of lands in mask
+    @return new_data: array with coastal areas
+    """
+    nY,nX = data.shape
+    new_data = np.zeros((nY,nX))
+
+    # create circle mask around each coastal point
+    for i in xrange(nY):
+        for j in xrange(nX):
+            if data[i,j] == val:
+                y,x = np.ogrid[-i:nY-i, -j:nX-j]
+                zone = x*x + y*y <= (2*radius+1)*(2*radius+1)
+                new_data[zone] = 1
+    return new_data
+
 
 #############################################################################################
 def testCoastalArea(data, reso, minmax_lats, minmax_lons, szone, lzone, min_size, max_size):
@@ -180,9 +419,87 @@ def testCoastalArea(data, reso, minmax_lats, minmax_lons, szone, lzone, min_size
     cm = CoastalMapping(data, np.int(reso), lat_slice, lon_slice, np.int(szone), np.int(lzone),
                          np.int(min_size), np.int(max_size))
 
+def testCoastalZone():
+    # compare with the original circle stamping on small random tiles
+    np.random.seed(1234)
+    for shape, radius in [((40, 60), 0), ((40, 60), 2), ((75, 50), 3), ((64, 64), 8)]:
+        for density in [0., 0.001, 0.01, 0.2]:
+            data = (np.random.random(shape) < density).astype(np.int)
+            res = coastalZone(data, radius, 1)
+            ref = coastalZoneLoop(data, radius, 1)
+            assert(res.dtype == ref.dtype)
+            assert(np.array_equal(res, ref))
+    print 'testCoastalZone OK'
+
+def testIslands():
+    import new
+    # compare with drawing the contours on small random land-sea masks: blobs, noise and
+    # nested rings of islands and lakes
+    rs = np.random.RandomState(1234)
+    for n in range(60):
+        shape = tuple(rs.randint(3, 60, 2))
+        if n % 3 == 0:
+            img = ndimage.gaussian_filter(rs.random_sample(shape), rs.choice([0.5, 1., 2.]))
+            land = img > np.percentile(img, rs.randint(20, 80))
+        elif n % 3 == 1:
+            land = rs.random_sample(shape) < rs.random_sample()
+        else:
+            ii, jj = np.mgrid[0:shape[0], 0:shape[1]]
+            dist = np.maximum(abs(ii - shape[0] / 2), abs(jj - shape[1] / 2))
+            land = (dist // rs.randint(1, 4)) % 2 == 0
+        # instance without a land-sea mask file, only the methods on islands are used
+        cm = new.instance(CoastalMapping, {'reso': 8})
+        slm = np.where(land, 0., 1.)
+        for size in 0, 64, 160, 640, 6400:
+            cm.min_size = cm.max_size = size
+            res = cm.fillIslands(slm.copy())
+            ref = fillIslandsContours(slm.copy(), cm.reso, size)
+            assert(np.array_equal(res, ref) and res.dtype == ref.dtype)
+            res = cm.eraseIslands(1. - slm, slm)
+            ref = eraseIslandsContours(1. - slm, cm.reso, size)
+            assert(np.array_equal(res, ref) and res.dtype == ref.dtype)
+    print 'testIslands OK'
+
+def createTestLsm(filename, shape=(120, 200)):
+    # synthetic land-sea mask (1 over sea, 0 over land) with a few square islands
+    slm = np.ones(shape)
+    for i, j, size in [(20, 30, 15), (60, 100, 30), (90, 20, 4), (40, 160, 1)]:
+        slm[i:i+size, j:j+size] = 0
+    f = nc(filename, 'w')
+    f.createDimension('lat', size=shape[0])
+    f.createDimension('lon', size=shape[1])
+    f.createVariable('lsm', 'f', ('lat', 'lon'))[:] = slm
+    f.close()
+
+def testMaskCache():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lsm = os.path.join(tmpdir, 'lsm.nc')
+        createTestLsm(lsm)
+        cache_dir = os.path.join(tmpdir, 'cache')
+        args = (lsm, 8, slice(0, 120), slice(0, 200), 2, 5, 0, 800000)
+        ref = CoastalMapping(*args)
+        cm0 = CoastalMapping(*args, cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 1)
+        cm1 = CoastalMapping(*args, cache_dir=cache_dir)
+        for cm in cm0, cm1:
+            assert(np.array_equal(cm.lArea, ref.lArea) and cm.lArea.dtype == ref.lArea.dtype)
+            assert(np.array_equal(cm.sArea, ref.sArea) and cm.sArea.dtype == ref.sArea.dtype)
+            assert(np.array_equal(cm.slmFill, ref.slmFill))
+
+        # a different parameter gives a different cache file
+        CoastalMapping(lsm, 8, slice(0, 120), slice(0, 200), 3, 5, 0, 800000, cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 2)
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testMaskCache OK'
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Test Coastal Area')
     parser.add_argument('-w', action='store_true', help='Print copyright')
+    parser.add_argument('-t', dest='test', action='store_true', help='Only run the tests on \
+                           synthetic tiles')
     parser.add_argument('-d', dest='data', default='Data/LSM/Cmorph_slm_8km.nc')
     parser.add_argument('-r', dest='reso', default='8', help='resolution of the land-sea mask in km')
     parser.add_argument('-lons', dest='lons', default='1200:2200', help='Min and max longitude indices LONMIN,LONMAX')
@@ -192,6 +509,11 @@ if __name__ == '__main__':
     parser.add_argument('-smin', dest='min_size', default='0', help='area below which islands are deleted in km2')
     parser.add_argument('-smax', dest='max_size', default='800000', help='max area of filled islands in km2')
     args = parser.parse_args()
+    if args.test:
+        testCoastalZone()
+        testIslands()
+        testMaskCache()
+        raise SystemExit
     try:
         minmax_lons = np.array(args.lons.split(':')).astype(np.int)
     except:
@@ -15,42 +15,160 @@ from shapely import affinity
 from matplotlib.patches import Polygon
 
 
+# moments of a set of cells: number of cells and sums of i, j, i*i, i*j and j*j. They are
+# integers, exact as float64 up to 2**53, and the moments of a union of cells are sums
+NUM_MOMENTS = 6
+
+
+def cellMoments(iis, jjs):
+    """
+    Compute the moments of a set of cells
+    @param iis: i indices
+    @param jjs: j indices
+    @return int64 array of NUM_MOMENTS values
+    """
+    fi = np.asarray(iis, np.float64)
+    fj = np.asarray(jjs, np.float64)
+    return np.array([len(fi), fi.sum(), fj.sum(), fi.dot(fi), fi.dot(fj), fj.dot(fj)], np.int64)
+
+
+def labelMoments(labels, iis, jjs, num_labels):
+    """
+    Compute the moments of the cells of each label in one pass
+    @param labels: label of each cell
+    @param iis: i indices
+    @param jjs: j indices
+    @param num_labels: number of labels (larger than the largest label)
+    @return int64 array (num_labels, NUM_MOMENTS)
+    """
+    fi = np.asarray(iis, np.float64)
+    fj = np.asarray(jjs, np.float64)
+    res = np.empty((num_labels, NUM_MOMENTS), np.int64)
+    res[:, 0] = np.bincount(labels, minlength=num_labels)
+    for k, weights in enumerate((fi, fj, fi*fi, fi*fj, fj*fj)):
+        res[:, k + 1] = np.bincount(labels, weights=weights, minlength=num_labels)
+    return res
+
+
+def fitMoments(moments, min_ellipse_axis=10):
+    """
+    Compute the ellipses of several sets of cells from their moments, as Ellipse does for
+    one set
+    @param moments: array (number of sets, NUM_MOMENTS)
+    @param min_ellipse_axis min axis length
+    @return dictionary of arrays with centre, a, b, aExt, bExt, angle, axes2ijTransf and
+            ij2AxesTransf, one entry per set
+    """
+    m = np.asarray(moments, np.float64).reshape(-1, NUM_MOMENTS)
+    area = m[:, 0]
+
+    # centre and inertia tensor (symmetric) around the centre
+    with np.errstate(invalid='ignore'):
+        centre = m[:, 1:3] / area[:, np.newaxis]
+    inertia = np.empty((len(m), 2, 2), np.float64)
+    inertia[:, 0, 0] = m[:, 3] - m[:, 1] * centre[:, 0]
+    inertia[:, 0, 1] = m[:, 4] - m[:, 1] * centre[:, 1]
+    inertia[:, 1, 0] = inertia[:, 0, 1]
+    inertia[:, 1, 1] = m[:, 5] - m[:, 2] * centre[:, 1]
+
+    # no cell: the centre is not defined, the axes are 0
+    inertia[area == 0] = 0.
+
+    # the set of eigenvectors is the rotation matrix from ij space to the
+    # inertial tensor's principal axes
+    if len(m) > 0:
+        eigenvals, axes2ijTransf = np.linalg.eig(inertia)
+    else:
+        eigenvals, axes2ijTransf = np.empty((0, 2)), np.empty((0, 2, 2))
+    ij2AxesTransf = np.ascontiguousarray(np.transpose(axes2ijTransf, (0, 2, 1)))
+
+    # angle between the principal axes and the i, j directions
+    angle = np.arctan2(ij2AxesTransf[:, 0, 1], ij2AxesTransf[:, 0, 0])*180./np.pi
+
+    # average radii from the centre, at least 0.5
+    with np.errstate(invalid='ignore'):
+        a, b = np.sqrt(eigenvals).T
+        aa = np.where(a > 0.5, a, 0.5)
+        bb = np.where(b > 0.5, b, 0.5)
+
+        # extend the axis to match the cluster's area
+        const = np.sqrt(area / (np.pi * aa * bb))
+        a = a * const
+        b = b * const
+        aa *= const
+        bb *= const
+
+        # add halo to the axes if need be
+        amin = min_ellipse_axis
+        aExt = aa + amin*np.exp(-a/amin)
+        bExt = bb + amin*np.exp(-b/amin)
+    return {'centre': centre, 'a': aa, 'b': bb, 'aExt': aExt, 'bExt': bExt, 'angle': angle, \
+            'axes2ijTransf': axes2ijTransf, 'ij2AxesTransf': ij2AxesTransf}
+
+
 class Ellipse:
     """
     A Class that computes the ellipse of a cloud of points
     """
-    def __init__(self, cells, min_ellipse_axis=10):
+    def __init__(self, cells, min_ellipse_axis=10, moments=None, fitted=None):
         """
         Constructor
-        @param cells set of (i,j) tuples, must have at least one cell
+        @param cells set of (i,j) tuples or tuple of i and j index arrays, must have at least
+                     one cell. Not used if moments or fitted is given
         @param min_ellipse_axis min axis length
+        @param moments: moments of the cells (see cellMoments)
+        @param fitted: (dictionary returned by fitMoments, index) when the ellipses of
+                       several sets of cells are computed together
         """
-        n = len(cells)
-        area = float(n)
-
-        inertia = np.zeros((2, 2), np.float64)
+        if fitted is None:
+            if moments is None:
+                if isinstance(cells, tuple):
+                    moments = cellMoments(cells[0], cells[1])
+                else:
+                    moments = cellMoments([c[0] for c in cells], [c[1] for c in cells])
+            self.fit(moments, min_ellipse_axis)
+            return
+        params, n = fitted
 
         # centre of cluster
-        self.centre = []
+        self.centre = params['centre'][n]
 
-        # average radii from the centre
-        self.a = 0.
-        self.b = 0.
+        # rotation matrices between ij space and the principal axes
+        self.axes2ijTransf = params['axes2ijTransf'][n]
+        self.ij2AxesTransf = params['ij2AxesTransf'][n]
+
+        # angle between the principal axes and the i, j directions
+        self.angle = params['angle'][n]
+
+        # average radii from the centre, scaled to match the cluster's area
+        self.a = params['a'][n]
+        self.b = params['b'][n]
 
-        iInds = np.array([c[0] for c in cells], np.float64)
-        jInds = np.array([c[1] for c in cells], np.float64)
+        # axes with a halo
+        self.aExt = params['aExt'][n]
+        self.bExt = params['bExt'][n]
 
-        iCentre = iInds.sum() / area
-        jCentre = jInds.sum() / area
+
+    def fit(self, moments, min_ellipse_axis):
+        """
+        Compute the ellipse of one set of cells from its moments
+        @param moments: moments of the cells (see cellMoments)
+        @param min_ellipse_axis min axis length
+        """
+        area, si, sj, sii, sij, sjj = [float(x) for x in moments]
+        inertia = np.zeros((2, 2), np.float64)
+
+        # centre of cluster
+        iCentre = si / area if area > 0 else np.nan
+        jCentre = sj / area if area > 0 else np.nan
         self.centre = np.array([iCentre, jCentre])
 
-        # compute inertia tensor (symmetric)
-        iInds -= iCentre
-        jInds -= jCentre
-        inertia[0, 0] = np.sum(iInds * iInds)
-        inertia[0, 1] = np.sum(iInds * jInds)
-        inertia[1, 0] = inertia[0, 1]
-        inertia[1, 1] = np.sum(jInds * jInds)
+        # compute inertia tensor (symmetric) around the centre
+        if area > 0:
+            inertia[0, 0] = sii - si * iCentre
+            inertia[0, 1] = sij - si * jCentre
+            inertia[1, 0] = inertia[0, 1]
+            inertia[1, 1] = sjj - sj * jCentre
 
         # the set of eigenvectors is the rotation matrix from ij space to the
         # inertial tensor's principal axes
@@ -65,9 +183,6 @@ class Ellipse:
         self.a = max(0.5, a)
         self.b = max(0.5, b)
 
-        # compute the total area
-        area = len(cells)
-
         # extend the axis to match the cluster's area
         const = math.sqrt(area /(math.pi * self.a * self.b))
         a *= const
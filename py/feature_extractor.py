@@ -4,34 +4,228 @@ Created on March 28, 2018
 @institution: Department of Physics, University of Auckland
 
 @description: A Class that extracts the clusters from the original data
-              using watershed algorithm from skimage.morphology
+              using a marker based watershed (see marker_watershed.pyx)
               Uses two different thresholds, the highest to estimate the convective cores,
               the lowest to keep the enveloppe of lower intensity around these cores.
               If the lower threshold is zero, we keep all the data
 '''
 
-# 0.13.x is know to give different results and seems to leak memory
-import skimage
-skimage_version = [int(v) for v in skimage.__version__.split('.')]
-if skimage_version[0] != 0 or skimage_version[1] != 12 or skimage_version[2] != 3:
-    fmt = '''
-ERROR: Wrong skimage version, need 0.12.3 but got {}. 
-Consider running "pip install --user --force-reinstall scikit-image==0.12.3"
-to install skimage 0.12.3.
-'''
-    raise ImportError, fmt.format(skimage.__version__)
-
 import numpy as np
 from scipy import ndimage
-from skimage.morphology import watershed
-from cluster import Cluster
-import cv2
 from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from marker_watershed import watershed
+from cluster import clustersFromGroups
+from instrumentation import recorder
+import cv2
+import ctypes
+import multiprocessing
+
+
+def binaryImage(data, thresh):
+    """
+    Build a black and white image, 255 where data is above the threshold (and not zero
+    or masked), 0 elsewhere. Works on a single time step or on all the time steps at once
+    @param data: precipitation data
+    @param thresh: threshold for precipitation
+    @return uint8 array with the shape of data
+    """
+    values = np.ma.getdata(data)
+    bw = ~(values <= thresh)
+    bw &= (values != 0)
+    mask = np.ma.getmask(data)
+    if mask is not np.ma.nomask:
+        bw &= ~mask
+    return bw.view(np.uint8) * np.uint8(255)
+
+
+def watershedMarkers(data, thresh_low, thresh_high, bw_data=None, bw_conv=None, buffers=None):
+    """
+    Build the markers and the mask of the watershed of a time step
+    @param data: precipitation data
+    @param thresh_low: low threshold for precipitation
+    @param thresh_high: high threshold for precipitation
+    @param bw_data: black and white image for thresh_low, if already computed
+    @param bw_conv: black and white image for thresh_high, if already computed
+    @param buffers: dictionary of work arrays reused between time steps (see extractClusters)
+    @return markers, mask (black and white image for thresh_low)
+    """
+    if buffers is None:
+        buffers = {}
+
+    # build black and white image with lower threshold to create borders for watershed
+    if bw_data is None:
+        bw_data = binaryImage(data, thresh_low)
+    border = cv2.dilate(bw_data, None, dst=buffers.get('border'), iterations=5)
+    border -= cv2.erode(border, None, dst=buffers.get('eroded'))
+
+    # build black and white image with high threshold to serve as markers for watershed
+    if bw_conv is None:
+        bw_conv = binaryImage(data, thresh_high)
+    markers = buffers.get('markers')
+    if markers is None:
+        markers = ndimage.label(bw_conv, structure=np.ones((3, 3)))[0]
+    else:
+        ndimage.label(bw_conv, structure=np.ones((3, 3)), output=markers)
+
+    # add border on image with high threshold to tell the watershed where it should
+    # fill in
+    markers[border == 255] = 255
+    return markers, bw_data
+
+
+def tileEdges(rain, tile_size):
+    """
+    Find the pairs of neighbouring tiles whose cells with rain touch (also diagonally) across
+    the boundary between them, only the cells along the boundaries are read
+    @param rain: black and white image of the cells with rain
+    @param tile_size: number of cells of the side of the tiles
+    @return row major indices of the tiles of each pair on the grid of tiles
+    """
+    num_tile_cols = (rain.shape[1] + tile_size - 1) // tile_size
+    edges = [[], []]
+    # boundaries between rows of tiles, then between columns of tiles
+    for image, transposed in (rain, False), (rain.T, True):
+        lines = np.arange(tile_size, image.shape[0], tile_size)
+        before = image[lines - 1] != 0
+        after = image[lines] != 0
+        length = image.shape[1]
+        for shift in -1, 0, 1:
+            # cell k of the line before touches cell k + shift of the line after
+            start, stop = max(0, -shift), length - max(0, shift)
+            nums, ks = np.nonzero(before[:, start:stop] & after[:, start + shift:stop + shift])
+            ks += start
+            for n, (tile_lines, tile_ks) in enumerate([(nums, ks // tile_size), \
+                                                       (nums + 1, (ks + shift) // tile_size)]):
+                if transposed:
+                    edges[n].append(tile_ks * num_tile_cols + tile_lines)
+                else:
+                    edges[n].append(tile_lines * num_tile_cols + tile_ks)
+    return np.concatenate(edges[0]), np.concatenate(edges[1])
+
+
+def rainyWindows(rain, tile_size):
+    """
+    Find the windows around the rain of a time step. The maximum of each tile tells whether
+    it has rain, and tiles are grouped when their cells with rain touch, so that every group
+    of connected cells is in the tiles of one group. A window is the box of the tiles of a
+    group, windows can overlap
+    @param rain: black and white image of the cells with rain
+    @param tile_size: number of cells of the side of the tiles
+    @return list of (slice of i, slice of j, cells of the window in the tiles of the group or
+            None when the window only has tiles of the group)
+    """
+    shape = rain.shape
+    tiles = np.maximum.reduceat(rain, np.arange(0, shape[0], tile_size), axis=0)
+    tiles = np.maximum.reduceat(tiles, np.arange(0, shape[1], tile_size), axis=1)
+    first, second = tileEdges(rain, tile_size)
+    graph = csr_matrix((np.ones(len(first), np.int8), (first, second)), shape=(tiles.size,) * 2)
+    groups = connected_components(graph, directed=False)[1]
+    rainy = np.flatnonzero(tiles)
+    tile_groups = np.zeros(tiles.size, np.int32)
+    tile_groups[rainy] = np.unique(groups[rainy], return_inverse=True)[1] + 1
+    tile_groups = tile_groups.reshape(tiles.shape)
+    windows = []
+    for group, (sl_i, sl_j) in enumerate(ndimage.find_objects(tile_groups)):
+        win_i = slice(sl_i.start * tile_size, min(sl_i.stop * tile_size, shape[0]))
+        win_j = slice(sl_j.start * tile_size, min(sl_j.stop * tile_size, shape[1]))
+        inside = tile_groups[sl_i, sl_j] == group + 1
+        if inside.all():
+            inside = None
+        else:
+            inside = inside.repeat(tile_size, axis=0).repeat(tile_size, axis=1)
+            inside = inside[:win_i.stop - win_i.start, :win_j.stop - win_j.start]
+        windows.append((win_i, win_j, inside))
+    return windows
+
+
+def tiledWatershed(data, thresh_low, thresh_high, tile_size, bw_data=None, bw_conv=None):
+    """
+    Compute the labels of the watershed of a time step only inside the windows around the
+    rain (see rainyWindows). The labels are the same as on the whole time step: the markers
+    are numbered in the order of their first cell on the whole time step, as ndimage.label
+    numbers them, and the flooding of a group of connected cells does not depend on the
+    other groups. The border added to the markers by watershedMarkers is outside the mask
+    of the watershed and is not needed. Only the labelled cells are returned, so that the
+    next stages do not go through the whole time step either. When the windows cover the
+    time step, nothing is computed: the watershed of the whole time step is faster
+    @param data: precipitation data
+    @param thresh_low: low threshold for precipitation
+    @param thresh_high: high threshold for precipitation
+    @param tile_size: number of cells of the side of the tiles
+    @param bw_data: black and white image for thresh_low, if already computed
+    @param bw_conv: black and white image for thresh_high, if already computed
+    @return row major indices of the labelled cells, sorted by label and then by index, and
+            their labels, None if the windows are too large
+    """
+    if bw_data is None:
+        bw_data = binaryImage(data, thresh_low)
+    if bw_conv is None:
+        bw_conv = binaryImage(data, thresh_high)
+
+    values = np.ma.getdata(data)
+
+    rainy = rainyWindows(bw_data | bw_conv, tile_size)
+    if sum((win_i.stop - win_i.start) * (win_j.stop - win_j.start) \
+           for win_i, win_j, inside in rainy) >= bw_data.size:
+        return None
+
+    # images and markers of each window, and index of the first cell of the markers on the
+    # whole time step
+    windows = []
+    firsts = [np.array([], np.int64)]
+    for win_i, win_j, inside in rainy:
+        win_data, win_conv = bw_data[win_i, win_j], bw_conv[win_i, win_j]
+        if inside is not None:
+            win_data = win_data * inside
+            win_conv = win_conv * inside
+        markers = ndimage.label(win_conv, structure=np.ones((3, 3)))[0]
+        # the first cell of a marker is where the label is above all the previous ones
+        inds = np.flatnonzero(markers)
+        nums = markers.ravel()[inds]
+        new = np.ones(len(nums), bool)
+        new[1:] = nums[1:] > np.maximum.accumulate(nums)[:-1]
+        iis, jjs = np.unravel_index(inds[new], markers.shape)
+        firsts.append(np.ravel_multi_index((iis + win_i.start, jjs + win_j.start), \
+                                           bw_conv.shape))
+        windows.append((win_i, win_j, win_data, markers, len(iis)))
+    firsts = np.concatenate(firsts)
+    numbers = np.empty(len(firsts), np.int32)
+    numbers[np.argsort(firsts)] = np.arange(1, len(firsts) + 1)
+
+    # cells of each window sorted by label, the cells of a label are all in one window
+    all_inds = [np.array([], np.int64)]
+    all_labels = [np.array([], np.int32)]
+    start = 0
+    for win_i, win_j, win_data, markers, num in windows:
+        lut = np.zeros(num + 1, np.int32)
+        lut[1:] = numbers[start:start + num]
+        start += num
+        win_labels = watershed(-values[win_i, win_j], lut[markers], mask=win_data)
+        inds = np.flatnonzero(win_labels)
+        labels = win_labels.ravel()[inds]
+        order = np.argsort(labels, kind='mergesort')
+        iis, jjs = np.unravel_index(inds[order], win_labels.shape)
+        all_inds.append(np.ravel_multi_index((iis + win_i.start, jjs + win_j.start), \
+                                             bw_data.shape))
+        all_labels.append(labels[order])
+    inds = np.concatenate(all_inds)
+    labels = np.concatenate(all_labels)
+
+    # put the runs of cells of the labels in the order of the labels
+    starts = np.flatnonzero(np.diff(labels)) + 1
+    starts = np.concatenate([[0], starts]) if len(labels) else starts
+    lengths = np.diff(np.append(starts, len(labels)))
+    order = np.argsort(labels[starts])
+    new_starts = np.cumsum(lengths[order]) - lengths[order]
+    order = np.repeat(starts[order] - new_starts, lengths[order]) + np.arange(len(labels))
+    return inds[order], labels[order]
 
 
 class FeatureExtractor:
 
-    def __init__(self, data, thresh_low, thresh_high, mask, frac):
+    def __init__(self, data, thresh_low, thresh_high, mask, frac, bw_data=None, bw_conv=None,
+                 buffers=None, tile_size=0):
         """
         Extract clusters from an image data
         @param data: precipitation data
@@ -39,68 +233,93 @@ class FeatureExtractor:
         @param thresh_high: high threshold for precipitation
         @param mask: mask used to remove precipitation far away from coasts
         @param frac: overlap threshold for mask
+        @param bw_data: black and white image for thresh_low, if already computed
+        @param bw_conv: black and white image for thresh_high, if already computed
+        @param buffers: dictionary of work arrays reused between time steps (see extractClusters)
+        @param tile_size: if not 0, the watershed is only computed around the tiles of this
+                          size that have rain (see tiledWatershed), with the same labels.
+                          The whole time step is computed when the rain is everywhere
         @return list of clusters
         """
         self.mask = mask
         self.frac = frac
+        # labelled cells, when they are known without going through the labels
+        self.cells = None
 
-	    # remove data below minimum threshold
-        ma_data = np.ma.masked_where(data <= thresh_low, data)
-
-        # build black and white image with lower threshold to create borders for watershed
-        tmp_data = ma_data.filled(fill_value=0)
-        tmp_data[np.where(tmp_data !=0)] = 255
-        bw_data = tmp_data.astype(np.uint8)
-        border = cv2.dilate(bw_data, None, iterations=5)
-        border -= cv2.erode(border, None)
+        with recorder.timer('watershed'):
+            cells = None
+            if tile_size:
+                if bw_data is None:
+                    bw_data = binaryImage(data, thresh_low)
+                if bw_conv is None:
+                    bw_conv = binaryImage(data, thresh_high)
+                cells = tiledWatershed(data, thresh_low, thresh_high, tile_size, bw_data, \
+                                       bw_conv)
+            if cells is None:
+                markers, bw_data = watershedMarkers(data, thresh_low, thresh_high, bw_data, \
+                                                    bw_conv, buffers)
 
-        # remove data below minimum threshold
-        ma_conv = np.ma.masked_where(data <= thresh_high, data)
-
-	    # build black and white image with high threshold to serve as markers for watershed
-        tmp_conv = ma_conv.filled(fill_value=0)
-        tmp_conv[np.where(tmp_conv !=0)] = 255
-        bw_conv = tmp_conv.astype(np.uint8)
-        markers = ndimage.label(bw_conv, structure=np.ones((3, 3)))[0]
-
-	    # add border on image with high threshold to tell the watershed where it should fill in
-        markers[border == 255] = 255
-
-        # label each feature
-        self.labels = watershed(-data, markers, mask=bw_data)
+                # label each feature
+                self.labels = watershed(-data, markers, mask=bw_data)
 
         # remove clusters outside of mask
-        self.labels = self.removeLargeScale()
+        with recorder.timer('remove_large_scale'):
+            if cells is not None:
+                self.cells = self.removeLargeScaleCells(*cells)
+                self.labels = np.zeros(data.shape, np.int32)
+                self.labels.flat[self.cells[0]] = self.cells[1]
+            else:
+                self.labels = self.removeLargeScale()
 
 
-    def getIndicesSparse(self, data):
-        M = self.compute_M(data)
-        return [np.unravel_index(row.data, data.shape) for row in M]
+    def removeLargeScale(self):
+        """
+        Remove clusters outside of the mask
+        @return cluster array without clusters far from coastline
+        """
+        # number of cells inside the mask for every label, in one pass over the labelled
+        # cells only (the mask is not contiguous when it is flipped)
+        inds = np.flatnonzero(self.labels)
+        labels = self.labels.ravel()[inds]
+        lut = self.maskLookup(inds, labels, self.labels.shape)
+        res = np.zeros(self.labels.shape, self.labels.dtype)
+        res.flat[inds] = lut[labels]
+        return res
 
 
-    def compute_M(self, data):
-        cols = np.arange(data.size)
-        return csr_matrix((cols, (data.ravel(), cols)),
-                            shape=(data.max() + 1, data.size))
+    def removeLargeScaleCells(self, inds, labels):
+        """
+        Remove clusters outside of the mask, from the labelled cells only
+        @param inds: row major indices of the labelled cells
+        @param labels: labels of the cells
+        @return indices and new labels of the cells kept, in the same order
+        """
+        lut = self.maskLookup(inds, labels, self.mask.shape)
+        labels = lut[labels]
+        kept = labels != 0
+        return inds[kept], labels[kept]
 
 
-    def removeLargeScale(self):
+    def maskLookup(self, inds, labels, shape):
         """
-        Remove clusters outside of the mask
-        @return cluster array without clusters far from coastline
+        Number the clusters kept by removeLargeScale
+        @param inds: row major indices of the labelled cells
+        @param labels: labels of the cells
+        @param shape: shape of the labels
+        @return lookup table of the new labels, 0 for the clusters outside of the mask
         """
-        new_label = np.zeros_like(self.labels)
-        nb = 1
-        inds = self.getIndicesSparse(self.labels)
-
-        # Get all the clusters except inds[0] = background
-        for num in range(1, len(inds)):
-            num_elems = len(inds[num])
-            check = np.nonzero(np.where(self.labels==num))
-            if self.mask[inds[num]].sum() >= self.frac * num_elems:
-                new_label[inds[num]] = nb
-                nb += 1
-        return new_label
+        num_labels = labels.max() + 1 if len(labels) else 1
+        weights = self.mask[np.unravel_index(inds, shape)]
+        num_mask = np.bincount(labels, weights=weights, minlength=num_labels)
+
+        # renumber the clusters that are kept (except background = 0) with a lookup table.
+        # The threshold is frac * 2 cells and not frac * num_elems: the number of elements
+        # used to be the length of the (i, j) tuple of indices. Kept to give the same tracks
+        keep = num_mask >= self.frac * 2
+        keep[0] = False
+        lut = np.zeros(num_labels, labels.dtype)
+        lut[keep] = np.arange(1, keep.sum() + 1)
+        return lut
 
 
     def getClusters(self, min_ellipse_axis=1):
@@ -109,17 +328,425 @@ class FeatureExtractor:
         @param min_ellipse_axis: minimum ellipse axis size
         @return list of clusters, each cluster is a feature
         """
-        res = []
-        inds = self.getIndicesSparse(self.labels)
+        if self.cells is not None:
+            return clustersFromCells(self.cells[0], self.cells[1], self.labels.shape, \
+                                     min_ellipse_axis)
+        return clustersFromLabels(self.labels, min_ellipse_axis)
 
-        # Get all features except background = inds[0]
-        for num in range(1, len(inds)):
-            num_elems = len(inds[num])
-            if num_elems > 0:
 
-                # store as a set
-                cells = {(inds[num][0][i], inds[num][1][i]) for i in range(len(inds[num][0]))}
-                res.append(Cluster(cells, min_ellipse_axis))
-        return res
+def clustersFromLabels(label_image, min_ellipse_axis=1):
+    """
+    Build the clusters of a label image
+    @param label_image: labels, 0 is the background
+    @param min_ellipse_axis: minimum ellipse axis size
+    @return list of clusters, one per label in increasing order
+    """
+    with recorder.timer('get_clusters'):
+        # group the indices of the cells by label (except background = 0), sorting only the
+        # labelled cells. The sort is stable so that the cells of a label stay in order
+        inds = np.flatnonzero(label_image)
+        labels = label_image.ravel()[inds]
+        order = np.argsort(labels, kind='mergesort')
+        inds = inds[order]
+        labels = labels[order]
+    return clustersFromCells(inds, labels, label_image.shape, min_ellipse_axis)
+
+
+def clustersFromCells(inds, labels, shape, min_ellipse_axis=1):
+    """
+    Build the clusters of labelled cells
+    @param inds: row major indices of the cells, sorted by label and then by index
+    @param labels: labels of the cells (not 0)
+    @param shape: shape of the labels
+    @param min_ellipse_axis: minimum ellipse axis size
+    @return list of clusters, one per label in increasing order
+    """
+    with recorder.timer('get_clusters'):
+        # the ellipses of all the labels are computed at once from the moments of the cells
+        iis, jjs = np.unravel_index(inds, shape)
+        res = clustersFromGroups(iis, jjs, labels, min_ellipse_axis)
+    recorder.count('clusters', len(res))
+    return res
+
+
+def extractClusters(all_data, thresh_low, thresh_high, mask, frac, min_ellipse_axis=1,
+                    tile_size=0):
+    """
+    Extract the clusters of all the time steps of a day. The black and white images are
+    computed for all time steps at once and the work arrays are reused between time steps,
+    the watershed is still applied to each time step so that the clusters are the same as
+    with FeatureExtractor
+    @param all_data: precipitation data (time, lat, lon)
+    @param thresh_low: low threshold for precipitation
+    @param thresh_high: high threshold for precipitation
+    @param mask: mask used to remove precipitation far away from coasts
+    @param frac: overlap threshold for mask
+    @param min_ellipse_axis: minimum ellipse axis size
+    @param tile_size: size of the tiles of the watershed, 0 for the whole time step
+    @return list of lists of clusters, one list per time step
+    """
+    with recorder.timer('watershed'):
+        bw_all_data = binaryImage(all_data, thresh_low)
+        bw_all_conv = binaryImage(all_data, thresh_high)
+    shape = all_data.shape[1:]
+    buffers = {'border': np.empty(shape, np.uint8), 'eroded': np.empty(shape, np.uint8),
+               'markers': np.empty(shape, np.int32)}
+    res = []
+    for t in xrange(all_data.shape[0]):
+        fe = FeatureExtractor(all_data[t], thresh_low, thresh_high, mask, frac, \
+                              bw_data=bw_all_data[t], bw_conv=bw_all_conv[t], buffers=buffers, \
+                              tile_size=tile_size)
+        res.append(fe.getClusters(min_ellipse_axis))
+    return res
+
+
+# shared arrays and parameters of the worker processes of ExtractionPool, set by _initWorker
+# in each process, also in the processes started again by the pool
+_worker_args = {}
+
+def _initWorker(values, mask, labels, params):
+    """
+    Keep the shared arrays and the parameters of the extraction in a worker process
+    @param values: shared precipitation of the day, as bytes
+    @param mask: shared mask of the precipitation of the day
+    @param labels: shared labels of the day
+    @param params: thresh_low, thresh_high, mask, frac and tile_size of FeatureExtractor
+    """
+    _worker_args.update(values=values, mask=mask, labels=labels, params=params)
+
+
+def _labelTimeStep(task):
+    """
+    Compute the labels of one time step in a worker process and write them in shared memory
+    @param task: time index, (lat, lon) shape and type of the precipitation of the day
+    @return time index
+    """
+    t, shape, dtype = task
+    dtype = np.dtype(dtype)
+    size = shape[0] * shape[1]
+    values = np.frombuffer(_worker_args['values'], dtype, size, t*size*dtype.itemsize)
+    mask = np.frombuffer(_worker_args['mask'], bool, size, t*size)
+    labels = np.frombuffer(_worker_args['labels'], np.int32, size, t*size*4)
+    thresh_low, thresh_high, mask_area, frac, tile_size = _worker_args['params']
+    data = np.ma.masked_array(values.reshape(shape), mask.reshape(shape))
+    labels[:] = FeatureExtractor(data, thresh_low, thresh_high, mask_area, frac, \
+                                 tile_size=tile_size).labels.ravel()
+    return t
+
+
+class ExtractionPool:
+    """
+    Pool of processes computing the labels of the time steps of the days of a run. The
+    precipitation of each day is copied to shared memory, the labels are sent back through
+    shared memory
+    """
+
+    def __init__(self, shape, thresh_low, thresh_high, mask, frac, workers, tile_size=0):
+        """
+        Constructor, the processes are started here: it should be called before the threads
+        of the run are started (see Prefetcher) and before the state of the tracking grows
+        @param shape: (time, lat, lon) of the days, the processes are started again for a day
+                      that does not fit
+        @param thresh_low: low threshold for precipitation
+        @param thresh_high: high threshold for precipitation
+        @param mask: mask used to remove precipitation far away from coasts
+        @param frac: overlap threshold for mask
+        @param workers: number of processes
+        @param tile_size: size of the tiles of the watershed, 0 for the whole time step
+        """
+        self.params = (thresh_low, thresh_high, mask, frac, tile_size)
+        self.workers = workers
+        self.pool = None
+        self.start(shape)
+
+
+    def start(self, shape):
+        """
+        Allocate the shared arrays and start the processes
+        @param shape: (time, lat, lon) of the days
+        """
+        self.close()
+        self.shape = tuple(shape)
+        size = int(np.prod(self.shape))
+        # the type of the precipitation is given with each day, up to 8 bytes per value
+        self.values = multiprocessing.RawArray(ctypes.c_char, 8*size)
+        self.mask = multiprocessing.RawArray(ctypes.c_bool, size)
+        self.labels = multiprocessing.RawArray(ctypes.c_int32, size)
+        self.pool = multiprocessing.Pool(self.workers, initializer=_initWorker, \
+                                         initargs=(self.values, self.mask, self.labels, \
+                                                   self.params))
+        # set while the time steps of a day are computed
+        self.busy = False
+
+
+    def extract(self, all_data, min_ellipse_axis=1):
+        """
+        Extract the clusters of all the time steps of a day. The lists of clusters are
+        given back in time order as soon as they are available, they are the same as with
+        FeatureExtractor
+        @param all_data: precipitation data (time, lat, lon)
+        @param min_ellipse_axis: minimum ellipse axis size
+        @return iterator over the lists of clusters, one list per time step
+        """
+        shape = all_data.shape
+        values = np.ma.getdata(all_data)
+        # the shared arrays may still be used by the time steps of a day that was not read
+        # to the end
+        if self.busy or shape[1:] != self.shape[1:] or shape[0] > self.shape[0] or \
+           values.dtype.itemsize > 8:
+            self.start((max(shape[0], self.shape[0]),) + shape[1:])
+        size = int(np.prod(shape))
+        np.frombuffer(self.values, values.dtype, size).reshape(shape)[...] = values
+        np.frombuffer(self.mask, bool, size).reshape(shape)[...] = np.ma.getmaskarray(all_data)
+        labels = np.frombuffer(self.labels, np.int32, size).reshape(shape)
+
+        self.busy = True
+        tasks = [(t, shape[1:], values.dtype.str) for t in xrange(shape[0])]
+        results = self.pool.imap(_labelTimeStep, tasks)
+        # the stages of the workers are not recorded, the time spent waiting for their labels
+        # is counted as watershed
+        for n in xrange(shape[0]):
+            with recorder.timer('watershed'):
+                t = results.next()
+            yield clustersFromLabels(labels[t], min_ellipse_axis)
+        self.busy = False
+
+
+    def close(self):
+        """
+        Stop the processes
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def extractClustersParallel(all_data, thresh_low, thresh_high, mask, frac, min_ellipse_axis=1,
+                            workers=2, tile_size=0):
+    """
+    Extract the clusters of all the time steps of a day with a pool of processes used only
+    for this day (see ExtractionPool to use the same processes for all the days)
+    @param all_data: precipitation data (time, lat, lon)
+    @param thresh_low: low threshold for precipitation
+    @param thresh_high: high threshold for precipitation
+    @param mask: mask used to remove precipitation far away from coasts
+    @param frac: overlap threshold for mask
+    @param min_ellipse_axis: minimum ellipse axis size
+    @param workers: number of processes
+    @param tile_size: size of the tiles of the watershed, 0 for the whole time step
+    @return iterator over the lists of clusters, one list per time step
+    """
+    pool = ExtractionPool(all_data.shape, thresh_low, thresh_high, mask, frac, workers, \
+                          tile_size)
+    try:
+        for clusters in pool.extract(all_data, min_ellipse_axis):
+            yield clusters
+    finally:
+        pool.close()
+
+
+#############################################################################################
+
+def testData(shape=(120, 200), seed=1234):
+    # random precipitation made of gaussian blobs
+    rs = np.random.RandomState(seed)
+    ii, jj = np.mgrid[0:shape[0], 0:shape[1]]
+    data = np.zeros(shape)
+    for n in range(40):
+        i0, j0 = rs.rand(2) * shape
+        data += rs.rand() * 10 * np.exp(-((ii - i0)**2 + (jj - j0)**2) / (2 * (1 + 3 * rs.rand())**2))
+    data[data < 0.3] = 0
+    mask = np.zeros(shape)
+    mask[:, :shape[1]/2] = 1
+    return data, mask
+
+def testRemoveLargeScale():
+    data, mask = testData()
+
+    # frac = 0 keeps all the labels of the watershed with the same numbers
+    fe = FeatureExtractor(data, thresh_low=0., thresh_high=3., mask=mask, frac=0.)
+    ws_labels = fe.labels.copy()
+    for frac in 0.3, 0.5, 1.0:
+        fe.labels = ws_labels
+        fe.frac = frac
+        res = fe.removeLargeScale()
+
+        # same as checking each label separately
+        ref = np.zeros_like(ws_labels)
+        nb = 1
+        for num in range(1, ws_labels.max() + 1):
+            ind = np.where(ws_labels == num)
+            if mask[ind].sum() >= frac * len(ind):
+                ref[ind] = nb
+                nb += 1
+        assert(np.array_equal(res, ref) and res.dtype == ref.dtype)
+    print 'testRemoveLargeScale OK'
+
+def testGetClusters():
+    data, mask = testData()
+    fe = FeatureExtractor(data, thresh_low=0., thresh_high=3., mask=mask, frac=0.5)
+    clusters = fe.getClusters(6)
+    assert(len(clusters) > 0)
+    ref = [num for num in range(1, fe.labels.max() + 1) if (fe.labels == num).any()]
+    assert(len(clusters) == len(ref))
+    for cl, num in zip(clusters, ref):
+        iis, jjs = np.where(fe.labels == num)
+        assert(np.array_equal(cl.iis, iis) and np.array_equal(cl.jjs, jjs))
+        assert(cl.min_ellipse_axis == 6)
+    print 'testGetClusters OK'
+
+
+def testBinaryImage():
+    # compare with masking the data and filling it with zeros
+    data = np.ma.masked_array(np.array([[-1., 0., 0.5, 3., np.nan], [2., 4., 0., -2., 5.]]),
+                              mask=[[0, 0, 0, 0, 0], [0, 1, 0, 0, 0]])
+    for values in data, data.filled(0.):
+        for thresh in -1.5, 0., 2.:
+            tmp = np.ma.masked_where(values <= thresh, values).filled(fill_value=0)
+            tmp[np.where(tmp !=0)] = 255
+            ref = tmp.astype(np.uint8)
+            res = binaryImage(values, thresh)
+            assert(np.array_equal(res, ref) and res.dtype == ref.dtype)
+    print 'testBinaryImage OK'
+
+def testExtractClusters():
+    all_data = np.ma.masked_array([testData(seed=seed)[0] for seed in range(5)])
+    all_data[2, 10:20, 30:50] = np.ma.masked
+    mask = testData()[1]
+    res = extractClusters(all_data, 0., 3., mask, 0.5, min_ellipse_axis=6)
+    assert(len(res) == all_data.shape[0])
+    for t in range(all_data.shape[0]):
+        ref = FeatureExtractor(all_data[t], 0., 3., mask, 0.5).getClusters(6)
+        assert(len(res[t]) == len(ref))
+        for cl, cl_ref in zip(res[t], ref):
+            assert(np.array_equal(cl.iis, cl_ref.iis) and np.array_equal(cl.jjs, cl_ref.jjs))
+    print 'testExtractClusters OK'
+
+def testExtractClustersParallel():
+    all_data = np.ma.masked_array([testData(seed=seed)[0] for seed in range(7)])
+    mask = testData()[1]
+    ref = extractClusters(all_data, 0., 3., mask, 0.5, min_ellipse_axis=6)
+    for workers in 2, 3:
+        res = list(extractClustersParallel(all_data, 0., 3., mask, 0.5, min_ellipse_axis=6,
+                                           workers=workers))
+        assert(len(res) == len(ref))
+        for clusters, clusters_ref in zip(res, ref):
+            assert(len(clusters) == len(clusters_ref))
+            for cl, cl_ref in zip(clusters, clusters_ref):
+                assert(np.array_equal(cl.iis, cl_ref.iis) and np.array_equal(cl.jjs, cl_ref.jjs))
+                assert(np.array_equal(cl.ellipse.centre, cl_ref.ellipse.centre))
+
+    # same processes for several days: with cells without data, with processes started again
+    # by the pool, after a day not read to the end and with more time steps
+    days = [all_data[:4], np.ma.masked_array(all_data[3:], all_data[3:] > 8.), all_data[:4], \
+            all_data[2:5].astype(np.float32), np.ma.concatenate([all_data, all_data])]
+    pool = ExtractionPool(all_data.shape, 0., 3., mask, 0.5, 2)
+    try:
+        for n, day in enumerate(days):
+            if n == 2:
+                # a new process for each time step, they get the shared arrays from the
+                # initializer (killing a process could leave the lock of the pool taken)
+                pool.pool.terminate()
+                pool.pool.join()
+                pool.pool = multiprocessing.Pool(2, initializer=_initWorker, \
+                                                 initargs=(pool.values, pool.mask, pool.labels, \
+                                                           pool.params), maxtasksperchild=1)
+            elif n == 3:
+                next(pool.extract(days[1], 6))
+            ref = extractClusters(day, 0., 3., mask, 0.5, min_ellipse_axis=6)
+            res = list(pool.extract(day, 6))
+            assert(len(res) == len(ref))
+            for clusters, clusters_ref in zip(res, ref):
+                assert(len(clusters) == len(clusters_ref))
+                for cl, cl_ref in zip(clusters, clusters_ref):
+                    assert(np.array_equal(cl.iis, cl_ref.iis) and np.array_equal(cl.jjs, cl_ref.jjs))
+    finally:
+        pool.close()
+
+    # region on both sides of 0 degree of longitude, the pool takes the shape of the mask as
+    # in tracking.py
+    wrap_data = np.ma.concatenate([all_data[:3, :, 150:], all_data[:3, :, :50]], axis=2)
+    wrap_mask = np.concatenate([mask[:, 150:], mask[:, :50]], axis=1)
+    ref = extractClusters(wrap_data, 0., 3., wrap_mask, 0.5, min_ellipse_axis=6)
+    pool = ExtractionPool((48,) + wrap_mask.shape, 0., 3., wrap_mask, 0.5, 2)
+    try:
+        res = list(pool.extract(wrap_data, 6))
+    finally:
+        pool.close()
+    assert(len(res) == len(ref))
+    for clusters, clusters_ref in zip(res, ref):
+        assert(len(clusters) == len(clusters_ref))
+        for cl, cl_ref in zip(clusters, clusters_ref):
+            assert(np.array_equal(cl.iis, cl_ref.iis) and np.array_equal(cl.jjs, cl_ref.jjs))
+    print 'testExtractClustersParallel OK'
+
+def testRainyWindows():
+    data = testData((300, 400), seed=3)[0]
+    data[data < 2] = 0
+    rain = binaryImage(data, 0.)
+    groups = ndimage.label(rain, structure=np.ones((3, 3)))[0]
+    for tile_size in 1, 8, 32, 500:
+        # every cell with rain is in one window, with all the cells connected to it
+        owner = np.zeros(rain.shape, np.int32)
+        for n, (win_i, win_j, inside) in enumerate(rainyWindows(rain, tile_size)):
+            if inside is None:
+                inside = np.ones((win_i.stop - win_i.start, win_j.stop - win_j.start), bool)
+            assert(not owner[win_i, win_j][inside].any())
+            owner[win_i, win_j][inside] = n + 1
+        assert((owner[rain != 0] > 0).all())
+        for num in range(1, groups.max() + 1):
+            assert(len(np.unique(owner[groups == num])) == 1)
+    assert(rainyWindows(np.zeros((10, 10), np.uint8), 4) == [])
+    print 'testRainyWindows OK'
+
+def testTiledWatershed():
+    # sparse rain with plateaus, cells without data and more than 255 markers
+    rs = np.random.RandomState(0)
+    data = np.ma.masked_array(np.around(testData((200, 300), seed=5)[0], 1))
+    data[:, 40:45] = np.ma.masked
+    small = np.zeros((400, 900))
+    small[rs.randint(0, 400, 700), rs.randint(0, 900, 700)] = 5.
+    small[rs.randint(0, 400, 400), rs.randint(0, 900, 400)] = 1.
+    for values in data, np.ma.masked_array(small):
+        for thresh_low, thresh_high in (0., 3.), (0.5, 2.), (2., 1.):
+            bw_data = binaryImage(values, thresh_low)
+            markers = watershedMarkers(values, thresh_low, thresh_high)[0]
+            ref = watershed(-values, markers, mask=bw_data)
+            inds = np.flatnonzero(ref)
+            order = np.argsort(ref.ravel()[inds], kind='mergesort')
+            for tile_size in 1, 5, 16, 64, 1000:
+                res = tiledWatershed(values, thresh_low, thresh_high, tile_size)
+                rain = binaryImage(values, min(thresh_low, thresh_high))
+                if sum((win_i.stop - win_i.start) * (win_j.stop - win_j.start) \
+                       for win_i, win_j, inside in rainyWindows(rain, tile_size)) >= rain.size:
+                    assert(res is None and tile_size >= 64)
+                    continue
+                assert(np.array_equal(res[0], inds[order]))
+                assert(np.array_equal(res[1], ref.ravel()[inds[order]]))
+                assert(res[1].dtype == ref.dtype)
+    assert(ref.max() > 255)
+    fe = FeatureExtractor(np.ma.masked_array(np.zeros((10, 10))), 0., 3., np.ones((10, 10)), \
+                          0.5, tile_size=4)
+    assert(not fe.labels.any() and fe.getClusters() == [])
+
+    mask = testData((200, 300))[1]
+    fe_ref = FeatureExtractor(data, 0., 3., mask, 0.5)
+    fe = FeatureExtractor(data, 0., 3., mask, 0.5, tile_size=32)
+    assert(np.array_equal(fe.labels, fe_ref.labels) and fe.labels.dtype == fe_ref.labels.dtype)
+    ref = fe_ref.getClusters(6)
+    res = fe.getClusters(6)
+    assert(len(res) == len(ref))
+    for cl, cl_ref in zip(res, ref):
+        assert(np.array_equal(cl.iis, cl_ref.iis) and np.array_equal(cl.jjs, cl_ref.jjs))
+    print 'testTiledWatershed OK'
 
 
+if __name__ == '__main__':
+    testRemoveLargeScale()
+    testGetClusters()
+    testBinaryImage()
+    testExtractClusters()
+    testExtractClustersParallel()
+    testRainyWindows()
+    testTiledWatershed()
@@ -0,0 +1,204 @@
+'''
+Created in October 2026
+
+@description: A Class that keeps the list of the harvest files of a region in a small csv
+              file next to them, so that the post-processing finds the files it needs
+              without listing the whole directory. Lines are only appended: one line per
+              file written by the harvest, one line per file removed. The file is rewritten
+              without the removed files when they are more than the files left
+'''
+
+import os
+
+# columns of the manifest
+COLUMNS = ['action', 't_min', 't_max', 'num_tracks', 'pickle_index', 'filename']
+
+
+class HarvestManifest:
+
+    def __init__(self, dirname, suffix):
+        """
+        Constructor
+        @param dirname: directory of the harvest files
+        @param suffix: suffix of the region (prefix of the harvest files)
+        """
+        self.dirname = dirname
+        self.suffix = suffix
+        self.filename = os.path.join(dirname, 'manifest_' + suffix + '.csv')
+
+
+    def exists(self):
+        """
+        @return True if the manifest exists
+        """
+        return os.path.isfile(self.filename)
+
+
+    def create(self):
+        """
+        Create the manifest with the harvest files already in the directory (written before
+        manifests existed), their number of tracks is not known (-1)
+        """
+        lines = []
+        dirname = self.dirname or '.'
+        for name in sorted(os.listdir(dirname)):
+            if not name.startswith(self.suffix + '_'):
+                continue
+            parts = name[len(self.suffix) + 1:].split('_')
+            if len(parts) < 4 or not (parts[0].isdigit() and parts[1].isdigit() \
+                                      and parts[-1].isdigit()):
+                continue
+            lines.append(self.formatLine('add', int(parts[0]), int(parts[1]), -1, \
+                                         int(parts[-1]), name))
+        self.write(lines)
+
+
+    def formatLine(self, action, t_min, t_max, num_tracks, pickle_index, name):
+        """
+        @return a line of the manifest
+        """
+        return '%s,%d,%d,%d,%d,%s\n' % (action, t_min, t_max, num_tracks, pickle_index, name)
+
+
+    def write(self, lines):
+        """
+        Write the whole manifest under a temporary name and rename it
+        @param lines: lines of the manifest
+        """
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(','.join(COLUMNS) + '\n')
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+
+
+    def appendLines(self, lines):
+        """
+        Append lines to the manifest in one write
+        @param lines: lines of the manifest
+        """
+        if not self.exists():
+            self.create()
+        with open(self.filename, 'a+') as f:
+            # end a line cut by an interrupted write, it is then ignored by read
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                lines = ['\n'] + lines
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def add(self, path, t_min, t_max, num_tracks, pickle_index):
+        """
+        Add a harvest file
+        @param path: path of the harvest file
+        @param t_min: first time index of the tracks
+        @param t_max: last time index of the tracks
+        @param num_tracks: number of tracks in the file
+        @param pickle_index: index of the harvest file, used by the restarts
+        """
+        self.appendLines([self.formatLine('add', t_min, t_max, num_tracks, pickle_index, \
+                                          os.path.basename(path))])
+
+
+    def read(self):
+        """
+        Read the manifest
+        @return list of [t_min, t_max, num_tracks, pickle_index, name] of the files present,
+                in the order in which they were added, and the number of removed files
+        """
+        files = {}
+        order = []
+        num_removed = 0
+        with open(self.filename) as f:
+            f.readline()
+            for line in f:
+                fields = line[:-1].split(',', 5)
+                if not line.endswith('\n') or len(fields) != len(COLUMNS):
+                    # line cut by an interrupted write
+                    continue
+                action, t_min, t_max, num_tracks, pickle_index, name = fields
+                if action == 'add':
+                    if name not in files:
+                        order.append(name)
+                    files[name] = [int(t_min), int(t_max), int(num_tracks), int(pickle_index), \
+                                   name]
+                elif name in files:
+                    del files[name]
+                    num_removed += 1
+        return [files[name] for name in order if name in files], num_removed
+
+
+    def remove(self, paths):
+        """
+        Remove harvest files from the manifest, the files themselves are not deleted
+        @param paths: paths of the harvest files
+        """
+        if not paths:
+            return
+        self.appendLines([self.formatLine('del', 0, 0, 0, 0, os.path.basename(path)) \
+                          for path in paths])
+        files, num_removed = self.read()
+        if num_removed > len(files):
+            self.write([self.formatLine('add', *row) for row in files])
+
+
+    def select(self, t_end, t_begin=None):
+        """
+        Find the harvest files whose first time index is before t_end and, if given, whose
+        last time index is after t_begin
+        @param t_end: time index
+        @param t_begin: time index
+        @return list of (path, t_min, t_max)
+        """
+        files, num_removed = self.read()
+        return [(os.path.join(self.dirname, row[4]), row[0], row[1]) for row in files \
+                if row[0] <= t_end and (t_begin is None or row[1] >= t_begin)]
+
+
+#############################################################################################
+
+def testHarvestManifest():
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # harvest file written before the manifest existed
+        open(os.path.join(tmpdir, 'io-cm_0_47_abc_0'), 'w').close()
+        open(os.path.join(tmpdir, 'io-cm2_0_47_abc_0'), 'w').close()
+        open(os.path.join(tmpdir, 'lat-lon_io-cm.txt'), 'w').close()
+        manifest = HarvestManifest(tmpdir, 'io-cm')
+        assert(not manifest.exists())
+        for n in range(1, 6):
+            manifest.add(os.path.join(tmpdir, 'io-cm_%d_%d_x_y_%d' % (n*48, n*48 + 60, n)), \
+                         n*48, n*48 + 60, 10*n, n)
+        assert(manifest.exists())
+        res = manifest.select(90)
+        assert([os.path.basename(r[0]) for r in res] == ['io-cm_0_47_abc_0', 'io-cm_48_108_x_y_1'])
+        assert(res[1][1:] == (48, 108))
+        res = manifest.select(300, t_begin=150)
+        assert([r[1] for r in res] == [96, 144, 192, 240])
+
+        # removed files are not selected, the manifest is compacted
+        manifest.remove([r[0] for r in manifest.select(150)])
+        assert([r[1] for r in manifest.select(1000)] == [192, 240])
+        files, num_removed = manifest.read()
+        assert(num_removed <= len(files))
+        assert(files[0][2] == 40)
+
+        # a line cut by an interrupted write is ignored
+        with open(manifest.filename, 'a') as f:
+            f.write('add,3')
+        assert(len(manifest.select(1000)) == 2)
+        manifest.add(os.path.join(tmpdir, 'io-cm_288_300_x_6'), 288, 300, 1, 6)
+        assert([r[1] for r in manifest.select(1000)] == [192, 240, 288])
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testHarvestManifest OK'
+
+
+if __name__ == '__main__':
+    testHarvestManifest()
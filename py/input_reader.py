@@ -0,0 +1,360 @@
+'''
+Created in October 2026
+
+@description: A Class that opens the bz2 compressed daily precipitation files without
+              writing the decompressed file next to the input. The data is decompressed in
+              memory and read with the in-memory mode of netCDF4, or written to a private
+              scratch file if the netcdf library was built without it.
+              Prefetcher reads the next days in a background thread while the current
+              day is tracked
+'''
+
+import bz2
+import os
+import sys
+import tempfile
+import threading
+import Queue
+import numpy as np
+from netCDF4 import Dataset as nc
+from instrumentation import recorder
+
+
+class InputReader:
+
+    def __init__(self, filename, scratch_dir=None):
+        """
+        Constructor
+        @param filename: name of the .nc.bz2 file
+        @param scratch_dir: directory used when the file cannot be opened from memory,
+                            defaults to /dev/shm if it exists
+        """
+        # some files use '_' instead of '-' in their name
+        if not os.path.isfile(filename):
+            dirname, basename = os.path.split(filename)
+            other = os.path.join(dirname, basename.replace('-','_'))
+            if os.path.isfile(other):
+                filename = other
+        self.filename = filename
+
+        # name of the decompressed file when the scratch directory is used
+        self.scratch_file = None
+
+        with recorder.timer('decompress'):
+            zipfile = bz2.BZ2File(filename)
+            try:
+                data_unzip = zipfile.read()
+            finally:
+                zipfile.close()
+
+        # keep a reference on the buffer as long as the dataset is open
+        self.buffer = data_unzip
+        with recorder.timer('netcdf_read'):
+            try:
+                self.f = nc(filename[:-4], memory=data_unzip)
+            except (TypeError, ValueError, IOError, RuntimeError):
+                self.buffer = None
+                self.f = self.openScratch(data_unzip, scratch_dir)
+
+        self.variables = self.f.variables
+
+
+    def openScratch(self, data_unzip, scratch_dir):
+        """
+        Write the decompressed data to a private scratch file and open it
+        @param data_unzip: decompressed data
+        @param scratch_dir: directory of the scratch file
+        @return netcdf dataset
+        """
+        if scratch_dir is None and os.path.isdir('/dev/shm'):
+            scratch_dir = '/dev/shm'
+        fd, self.scratch_file = tempfile.mkstemp(suffix='.nc', dir=scratch_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data_unzip)
+        try:
+            return nc(self.scratch_file)
+        except:
+            self.removeScratch()
+            raise
+
+
+    def removeScratch(self):
+        """
+        Remove the scratch file, if any
+        """
+        if self.scratch_file is not None:
+            try:
+                os.remove(self.scratch_file)
+            except OSError:
+                pass
+            self.scratch_file = None
+
+
+    def getData(self, lat_slice, lon_slice, varname='CMORPH'):
+        """
+        Read a variable over a region
+        @param lat_slice: latitude indices
+        @param lon_slice: longitude indices, start > stop for regions on both sides of
+                          0 degree of longitude
+        @param varname: name of the (time, lat, lon) variable
+        @return data
+        """
+        var = self.variables[varname]
+        with recorder.timer('netcdf_read'):
+            if lon_slice.start < lon_slice.stop:
+                return var[:, lat_slice, lon_slice]
+            data1 = var[:, lat_slice, lon_slice.start:]
+            data2 = var[:, lat_slice, :lon_slice.stop]
+            return np.concatenate((data1, data2), axis=2)
+
+
+    def getLat(self, lat_slice):
+        """
+        @param lat_slice: latitude indices
+        @return latitudes
+        """
+        return self.variables['lat'][lat_slice]
+
+
+    def getLon(self, lon_slice):
+        """
+        @param lon_slice: longitude indices, start > stop for regions on both sides of
+                          0 degree of longitude
+        @return longitudes
+        """
+        if lon_slice.start < lon_slice.stop:
+            return self.variables['lon'][lon_slice]
+        lon1 = self.variables['lon'][lon_slice.start:]
+        lon2 = self.variables['lon'][:lon_slice.stop]
+        return np.concatenate((lon1, lon2))
+
+
+    def getTime(self):
+        """
+        @return time of the time steps and its units
+        """
+        return self.variables['time'][:], self.variables['time'].units
+
+
+    def close(self):
+        """
+        Close the dataset and release the decompressed data
+        """
+        self.f.close()
+        self.buffer = None
+        self.removeScratch()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def readDay(filename, lat_slice, lon_slice):
+    """
+    Read the precipitation and the coordinates of a region for a day
+    @param filename: name of the .nc.bz2 file
+    @param lat_slice: latitude indices
+    @param lon_slice: longitude indices
+    @return all_data, lat, lon, time, time units
+    """
+    with InputReader(filename) as f:
+        return (f.getData(lat_slice, lon_slice), f.getLat(lat_slice), f.getLon(lon_slice)) + \
+               f.getTime()
+
+
+class Prefetcher:
+    """
+    Read the daily files in a background thread, at most depth days ahead of the day being
+    used. The days are given back in the same order as the input and contain the same data
+    as readDay
+    """
+
+    def __init__(self, days, lat_slice, lon_slice, depth=1):
+        """
+        Constructor
+        @param days: list of (date, filename)
+        @param lat_slice: latitude indices
+        @param lon_slice: longitude indices
+        @param depth: number of days read in advance, 0 to read each day when it is needed
+        """
+        self.days = list(days)
+        self.lat_slice = lat_slice
+        self.lon_slice = lon_slice
+        self.depth = depth
+        self.thread = None
+        self.stop = threading.Event()
+        if self.depth > 0:
+            self.queue = Queue.Queue(maxsize=self.depth)
+            self.thread = threading.Thread(target=self.produce)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def produce(self):
+        """
+        Read the days and put them in the queue, stop at the first error
+        """
+        for date, filename in self.days:
+            if self.stop.is_set():
+                return
+            try:
+                res = (date, filename) + readDay(filename, self.lat_slice, self.lon_slice)
+            except:
+                self.put((None, sys.exc_info()))
+                return
+            self.put((res, None))
+
+
+    def put(self, item):
+        """
+        Put an item in the queue, unless the consumer stopped
+        @param item: (day, exception info)
+        """
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+
+    def __iter__(self):
+        """
+        @return iterator over (date, filename, all_data, lat, lon, time, time units)
+        """
+        for date, filename in self.days:
+            if self.thread is None:
+                yield (date, filename) + readDay(filename, self.lat_slice, self.lon_slice)
+                continue
+            res, exc = self.queue.get()
+            if exc is not None:
+                raise exc[0], exc[1], exc[2]
+            yield res
+
+
+    def close(self):
+        """
+        Stop the background thread
+        """
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+
+#############################################################################################
+
+def createTestFile(filename, shape=(4, 30, 50)):
+    # synthetic CMORPH-like daily file, compressed with bz2
+    nc_filename = filename[:-4]
+    f = nc(nc_filename, 'w')
+    f.createDimension('time', size=None)
+    f.createDimension('lat', size=shape[1])
+    f.createDimension('lon', size=shape[2])
+    var = f.createVariable('time', 'f', ('time',))
+    var.units = 'hours since 2010-02-19 00:00'
+    var[:] = np.arange(shape[0])
+    f.createVariable('lat', 'f', ('lat',))[:] = np.linspace(-30, 30, shape[1])
+    f.createVariable('lon', 'f', ('lon',))[:] = np.linspace(0, 360, shape[2], endpoint=False)
+    np.random.seed(1234)
+    f.createVariable('CMORPH', 'f', ('time', 'lat', 'lon'))[:] = np.random.random(shape)
+    f.close()
+    with open(nc_filename, 'rb') as fh:
+        data = fh.read()
+    os.remove(nc_filename)
+    zipfile = bz2.BZ2File(filename, 'wb')
+    zipfile.write(data)
+    zipfile.close()
+    return data
+
+def testInputReader():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'Cmorph-2010_02_19.nc.bz2')
+        data = createTestFile(filename)
+        with open(os.path.join(tmpdir, 'ref.nc'), 'wb') as fh:
+            fh.write(data)
+        ref = nc(os.path.join(tmpdir, 'ref.nc'))
+        ref_data = ref.variables['CMORPH'][:]
+        ref_lon = ref.variables['lon'][:]
+        for scratch in False, True:
+            reader = InputReader(filename)
+            if scratch:
+                # same as when the netcdf library cannot read from memory
+                reader.f.close()
+                reader.buffer = None
+                reader.f = reader.openScratch(data, tmpdir)
+                reader.variables = reader.f.variables
+                assert(os.path.isfile(reader.scratch_file))
+            with reader:
+                all_data = reader.getData(slice(5, 20), slice(10, 40))
+                assert(np.array_equal(all_data, ref_data[:, 5:20, 10:40]))
+
+                # region on both sides of 0 degree of longitude
+                all_data = reader.getData(slice(5, 20), slice(40, 10))
+                expected = np.concatenate((ref_data[:, 5:20, 40:], ref_data[:, 5:20, :10]), axis=2)
+                assert(np.array_equal(all_data, expected))
+                lon = reader.getLon(slice(40, 10))
+                assert(np.array_equal(lon, np.concatenate((ref_lon[40:], ref_lon[:10]))))
+            assert(reader.scratch_file is None)
+
+        # nothing was written next to the input
+        assert(sorted(os.listdir(tmpdir)) == ['Cmorph-2010_02_19.nc.bz2', 'ref.nc'])
+        ref.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testInputReader OK'
+
+def testPrefetcher():
+    import shutil
+    from datetime import datetime, timedelta as td
+    tmpdir = tempfile.mkdtemp()
+    try:
+        days = []
+        for nb_day in range(4):
+            date = datetime(2010, 2, 19) + td(days=nb_day)
+            filename = os.path.join(tmpdir, date.strftime('Cmorph-%Y_%m_%d.nc.bz2'))
+            createTestFile(filename, shape=(2 + nb_day, 30, 50))
+            days.append((date, filename))
+        lat_slice, lon_slice = slice(3, 25), slice(45, 5)
+
+        serial = list(Prefetcher(days, lat_slice, lon_slice, depth=0))
+        for depth in 1, 3:
+            prefetcher = Prefetcher(days, lat_slice, lon_slice, depth=depth)
+            res = list(prefetcher)
+            prefetcher.close()
+            assert(len(res) == len(serial))
+            for r, ref in zip(res, serial):
+                assert(r[:2] == ref[:2])
+                for a, b in zip(r[2:], ref[2:]):
+                    assert(np.array_equal(a, b))
+
+        # stop before the end
+        prefetcher = Prefetcher(days, lat_slice, lon_slice, depth=1)
+        for day in prefetcher:
+            break
+        prefetcher.close()
+
+        # errors are raised in the caller
+        os.remove(days[2][1])
+        prefetcher = Prefetcher(days, lat_slice, lon_slice, depth=2)
+        try:
+            for day in prefetcher:
+                pass
+            assert(False)
+        except IOError:
+            pass
+        prefetcher.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testPrefetcher OK'
+
+
+if __name__ == '__main__':
+    testInputReader()
+    testPrefetcher()
@@ -0,0 +1,225 @@
+'''
+Created in October 2026
+
+@description: Timers and counters of the stages of the tracking, written as one row per day
+              to a csv or json-lines file. The functions of the pipeline report into the
+              module-level recorder; when it is not enabled, a timer is a shared object that
+              does nothing and a counter returns at once, so the calls can stay in place
+'''
+
+import csv
+import json
+import resource
+import threading
+import time
+
+# stages timed, in seconds
+STAGES = ['decompress', 'netcdf_read', 'watershed', 'remove_large_scale', 'get_clusters', \
+          'add_time', 'harvest', 'restart_write']
+
+# counters and values of the day
+COUNTERS = ['time_steps', 'clusters', 'live_tracks', 'harvested_tracks']
+
+# columns of the rows
+COLUMNS = ['day', 'wall'] + STAGES + COUNTERS + ['peak_rss_mb']
+
+
+class _NullTimer:
+    """
+    Timer used when the recorder is not enabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """
+    Add the time spent in a with block to a stage of the recorder
+    """
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.time0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.add(self.name, time.time() - self.time0)
+        return False
+
+
+def getPeakRss():
+    """
+    @return peak resident memory of the process in MB (Linux, ru_maxrss in kB)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Recorder:
+
+    def __init__(self):
+        """
+        Constructor, the recorder is not enabled until a file is opened
+        """
+        self.enabled = False
+        self.values = {}
+        self.lock = threading.Lock()
+        self.f = None
+        self.writer = None
+        self.row_start = None
+
+
+    def open(self, filename):
+        """
+        Enable the recorder, the rows are written as csv unless the file name ends with
+        .json or .jsonl
+        @param filename: name of the file
+        """
+        self.f = open(filename, 'w')
+        if filename.endswith('.json') or filename.endswith('.jsonl'):
+            self.writer = None
+        else:
+            self.writer = csv.DictWriter(self.f, COLUMNS, extrasaction='ignore')
+            self.writer.writeheader()
+        self.values = {}
+        self.row_start = time.time()
+        self.enabled = True
+
+
+    def timer(self, name):
+        """
+        @param name: name of the stage
+        @return context manager adding the time spent in the with block to the stage
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+
+    def add(self, name, value):
+        """
+        Add to a stage or a counter
+        @param name: name of the stage or counter
+        @param value: seconds or number to add
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+
+    def count(self, name, num=1):
+        """
+        Add to a counter
+        @param name: name of the counter
+        @param num: number to add
+        """
+        if self.enabled:
+            self.add(name, num)
+
+
+    def set(self, name, value):
+        """
+        Set a value of the day, for instance the number of live tracks
+        @param name: name of the value
+        @param value: value
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name] = value
+
+
+    def writeRow(self, day):
+        """
+        Write the row of a day and start the next one. The wall time is the time since the
+        previous row. Stages run by other threads (reading in advance) are counted in the row
+        of the day when they ran
+        @param day: name of the day
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            row = dict((name, 0) for name in STAGES + COUNTERS)
+            row.update(self.values)
+            self.values = {}
+        row['day'] = str(day)
+        row['wall'] = now - self.row_start
+        row['peak_rss_mb'] = getPeakRss()
+        self.row_start = now
+        if self.writer is None:
+            self.f.write(json.dumps(row, sort_keys=True) + '\n')
+        else:
+            self.writer.writerow(row)
+        self.f.flush()
+
+
+    def close(self):
+        """
+        Close the file and disable the recorder
+        """
+        self.enabled = False
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+# recorder of the process
+recorder = Recorder()
+
+
+#############################################################################################
+
+def testRecorder():
+    import os
+    import tempfile
+    rec = Recorder()
+
+    # nothing is recorded until a file is opened
+    with rec.timer('watershed'):
+        pass
+    rec.count('clusters', 3)
+    assert(rec.values == {} and rec.timer('add_time') is _NULL_TIMER)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in 'stats.csv', 'stats.jsonl':
+            filename = os.path.join(tmpdir, name)
+            rec.open(filename)
+            for day in range(2):
+                with rec.timer('watershed'):
+                    time.sleep(0.01)
+                rec.count('clusters', 3)
+                rec.count('clusters', 2)
+                rec.set('live_tracks', 7 + day)
+                rec.writeRow('2010-02-%02d' % (19 + day))
+            rec.close()
+            if name.endswith('.csv'):
+                rows = list(csv.DictReader(open(filename)))
+            else:
+                rows = [json.loads(line) for line in open(filename)]
+            assert(len(rows) == 2)
+            assert(rows[1]['day'] == '2010-02-20')
+            assert(int(rows[0]['clusters']) == 5 and int(rows[1]['live_tracks']) == 8)
+            assert(float(rows[0]['watershed']) >= 0.01 and float(rows[0]['add_time']) == 0)
+            assert(float(rows[0]['wall']) >= float(rows[0]['watershed']))
+            assert(float(rows[1]['peak_rss_mb']) > 0)
+        assert(not rec.enabled)
+    finally:
+        import shutil
+        shutil.rmtree(tmpdir)
+    print 'testRecorder OK'
+
+
+if __name__ == '__main__':
+    testRecorder()
@@ -0,0 +1,278 @@
+'''
+Created in October 2026
+
+@description: Marker based watershed (priority flood) giving the same labels as
+              skimage.morphology.watershed of scikit-image 0.12.3 with the default
+              connectivity: the pixels are flooded from the markers in increasing order of the
+              image, 4-connected, and the ties are broken in the order the pixels were reached.
+              The labels of the tracking depend on these ties (plateaus of equal
+              precipitation), which later versions of scikit-image break differently
+'''
+import os
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.stdlib cimport malloc, realloc, free
+
+# initial number of items of the heap, it grows as needed
+INITIAL_CAPACITY = 4096
+
+# (thresh_low, thresh_high) of the golden cases
+GOLDEN_THRESHOLDS = [(0., 3.), (0.5, 2.), (1., 5.)]
+
+
+cdef struct HeapItem:
+    double value
+    Py_ssize_t age
+    Py_ssize_t index
+
+
+cdef struct Heap:
+    HeapItem* items
+    Py_ssize_t size
+    Py_ssize_t capacity
+
+
+cdef inline bint _smaller(HeapItem* a, HeapItem* b) nogil:
+    # lowest value first, then first pushed
+    if a.value != b.value:
+        return a.value < b.value
+    return a.age < b.age
+
+
+cdef int _push(Heap* heap, double value, Py_ssize_t age, Py_ssize_t index) nogil except -1:
+    cdef HeapItem* items
+    cdef HeapItem item
+    cdef Py_ssize_t n, parent
+    if heap.size == heap.capacity:
+        items = <HeapItem*> realloc(heap.items, 2 * heap.capacity * sizeof(HeapItem))
+        if items == NULL:
+            with gil:
+                raise MemoryError('Cannot grow the heap of the watershed')
+        heap.items = items
+        heap.capacity *= 2
+    item.value = value
+    item.age = age
+    item.index = index
+    n = heap.size
+    heap.size += 1
+    while n > 0:
+        parent = (n - 1) // 2
+        if not _smaller(&item, &heap.items[parent]):
+            break
+        heap.items[n] = heap.items[parent]
+        n = parent
+    heap.items[n] = item
+    return 0
+
+
+cdef Py_ssize_t _pop(Heap* heap) nogil:
+    # remove the smallest item and return its index
+    cdef Py_ssize_t index = heap.items[0].index
+    cdef HeapItem last
+    cdef Py_ssize_t n = 0, child
+    heap.size -= 1
+    if heap.size == 0:
+        return index
+    last = heap.items[heap.size]
+    while True:
+        child = 2*n + 1
+        if child >= heap.size:
+            break
+        if child + 1 < heap.size and _smaller(&heap.items[child + 1], &heap.items[child]):
+            child += 1
+        if not _smaller(&heap.items[child], &last):
+            break
+        heap.items[n] = heap.items[child]
+        n = child
+    heap.items[n] = last
+    return index
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _flood(double[::1] values, np.int32_t[::1] labels, np.uint8_t[::1] inside, \
+                Py_ssize_t num_cols, Heap* heap) nogil except -1:
+    cdef Py_ssize_t num_cells = labels.shape[0]
+    cdef Py_ssize_t k, n, j, m, age = 0
+    cdef Py_ssize_t neighbours[4]
+    cdef bint valid[4]
+
+    # markers in row major order
+    for k in range(num_cells):
+        if labels[k] != 0:
+            _push(heap, values[k], age, k)
+            age += 1
+
+    while heap.size > 0:
+        k = _pop(heap)
+        j = k % num_cols
+        # same order of the neighbours as scikit-image: left, up, down, right
+        neighbours[0] = k - 1
+        valid[0] = j > 0
+        neighbours[1] = k - num_cols
+        valid[1] = k >= num_cols
+        neighbours[2] = k + num_cols
+        valid[2] = k + num_cols < num_cells
+        neighbours[3] = k + 1
+        valid[3] = j < num_cols - 1
+        for m in range(4):
+            n = neighbours[m]
+            if not valid[m] or labels[n] != 0 or not inside[n]:
+                continue
+            labels[n] = labels[k]
+            _push(heap, values[n], age, n)
+            age += 1
+    return 0
+
+
+def watershed(image, markers, mask=None):
+    """
+    Flood the image from the markers
+    @param image: 2d array, the lowest values are flooded first. nan is flooded last (the
+                  order of the nan cells is not the one of scikit-image, which depends on its
+                  sort)
+    @param markers: 2d array of integers, label of the basins, 0 elsewhere
+    @param mask: 2d array, only the pixels where the mask is not 0 are labelled, all by default
+    @return labels with the shape and type of markers, 0 outside the mask
+    """
+    image = np.ma.getdata(image)
+    if image.ndim != 2 or image.shape != markers.shape:
+        raise ValueError('image and markers must be 2d arrays with the same shape, got %s and %s' \
+                         % (str(image.shape), str(markers.shape)))
+    num_cols = image.shape[1]
+    values = np.array(image, np.float64).reshape(-1)
+    values[np.isnan(values)] = np.inf
+    labels = np.array(markers, np.int32).reshape(-1)
+    if mask is None:
+        inside = np.ones(labels.shape, np.uint8)
+    else:
+        if mask.shape != markers.shape:
+            raise ValueError('mask must have the shape of markers')
+        inside = (np.asarray(mask) != 0).view(np.uint8).reshape(-1)
+        labels[inside == 0] = 0
+
+    cdef double[::1] values_view = values
+    cdef np.int32_t[::1] labels_view = labels
+    cdef np.uint8_t[::1] inside_view = inside
+    cdef Py_ssize_t num_cols_c = num_cols
+    cdef Heap heap
+    heap.size = 0
+    heap.capacity = INITIAL_CAPACITY
+    heap.items = <HeapItem*> malloc(heap.capacity * sizeof(HeapItem))
+    if heap.items == NULL:
+        raise MemoryError('Cannot allocate the heap of the watershed')
+    try:
+        with nogil:
+            _flood(values_view, labels_view, inside_view, num_cols_c, &heap)
+    finally:
+        free(heap.items)
+    return labels.reshape(markers.shape).astype(markers.dtype, copy=False)
+
+
+#############################################################################################
+
+def getGoldenFilename():
+    """
+    @return name of the file of the labels computed by skimage.morphology.watershed 0.12.3
+            on the golden cases
+    """
+    # __file__ is only defined once the module is initialised
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', \
+                        'watershed_golden.npz')
+
+
+def goldenCases(num_cases=12):
+    """
+    Time steps of the golden corpus: random precipitation with plateaus of equal values and
+    cells without data, and the markers and mask built by FeatureExtractor
+    @param num_cases: number of cases
+    @return list of (image, markers, mask)
+    """
+    from feature_extractor import testData, watershedMarkers
+    cases = []
+    for n in range(num_cases):
+        shape = [(60, 90), (120, 200), (200, 150)][n % 3]
+        data = testData(shape, seed=100 + n)[0]
+        data = np.ma.masked_array(np.around(data, 1 - n % 2).astype(np.float32))
+        if n % 4 == 3:
+            data[:, shape[1] // 3:shape[1] // 3 + 5] = np.ma.masked
+        thresh_low, thresh_high = GOLDEN_THRESHOLDS[(n // 3) % len(GOLDEN_THRESHOLDS)]
+        markers, mask = watershedMarkers(data, thresh_low, thresh_high)
+        cases.append((-data, markers, mask))
+    return cases
+
+
+def createGoldenCorpus(filename=None):
+    """
+    Write the labels of skimage.morphology.watershed on the golden cases, needs scikit-image
+    0.12.3
+    @param filename: name of the .npz file, getGoldenFilename() by default
+    """
+    import skimage
+    from skimage.morphology import watershed as skimage_watershed
+    if skimage.__version__ != '0.12.3':
+        raise RuntimeError('need scikit-image 0.12.3 but got ' + skimage.__version__)
+    if filename is None:
+        filename = getGoldenFilename()
+    arrays = {}
+    for n, (image, markers, mask) in enumerate(goldenCases()):
+        arrays['labels%d' % n] = skimage_watershed(image, markers, mask=mask)
+    np.savez_compressed(filename, **arrays)
+
+
+def testGolden():
+    with np.load(getGoldenFilename()) as golden:
+        for n, (image, markers, mask) in enumerate(goldenCases()):
+            labels = watershed(image, markers, mask=mask)
+            assert(labels.dtype == markers.dtype)
+            assert(np.array_equal(labels, golden['labels%d' % n]))
+    print 'testGolden OK'
+
+
+def testTies():
+    # plateau reached from both markers at the same time: the cells are flooded in the order
+    # they were reached, the left neighbour first
+    image = np.zeros((3, 5))
+    markers = np.zeros((3, 5), np.int32)
+    markers[1, 0] = 1
+    markers[1, 4] = 2
+    mask = np.ones((3, 5), np.uint8)
+    mask[0, 0] = 0
+    labels = watershed(image, markers, mask=mask)
+    expected = np.array([[0, 1, 1, 2, 2],
+                         [1, 1, 1, 2, 2],
+                         [1, 1, 1, 2, 2]], np.int32)
+    assert(np.array_equal(labels, expected))
+
+    # markers outside the mask are removed
+    markers[0, 0] = 3
+    assert(np.array_equal(watershed(image, markers, mask=mask), expected))
+    print 'testTies OK'
+
+
+def testSpeed(shape=(827, 4948), repeat=3):
+    import time
+    from feature_extractor import testData, watershedMarkers
+    data = np.around(testData(shape)[0], 1)
+    markers, mask = watershedMarkers(data, 0., 3.)
+    time0 = time.time()
+    for n in range(repeat):
+        labels = watershed(-data, markers, mask=mask)
+    print 'marker_watershed: %.3f s' % ((time.time() - time0) / repeat)
+    try:
+        from skimage.morphology import watershed as skimage_watershed
+    except ImportError:
+        return
+    time0 = time.time()
+    for n in range(repeat):
+        ref = skimage_watershed(-data, markers, mask=mask)
+    print 'skimage.morphology.watershed: %.3f s' % ((time.time() - time0) / repeat)
+    assert(np.array_equal(labels, ref))
+
+
+if __name__ == '__main__':
+    testTies()
+    testGolden()
+    testSpeed()
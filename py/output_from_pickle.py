@@ -12,9 +12,11 @@ import cPickle
 import numpy as np
 import netCDF4
 from netCDF4 import Dataset as nc
-import bz2
+from input_reader import InputReader
+from track_store import decodeRuns
+from harvest_manifest import HarvestManifest
+from precip_store import PrecipStore, getPrecipFilename
 import os
-import gzip
 import matplotlib.pyplot as mpl
 
 
@@ -42,6 +44,29 @@ def readTxt(filename):
     return name
 
 
+def deleteFiles(inputdir, list_prefix, filenames):
+    """
+    Delete pickles and remove them from the manifests
+    @param inputdir: directory of the pickles
+    @param list_prefix: list of prefixes of the pickles
+    @param filenames: pickles to delete
+    """
+    for filename in filenames:
+        os.remove(filename)
+    for prefix in list_prefix:
+        manifest = HarvestManifest(inputdir, prefix)
+        if manifest.exists():
+            manifest.remove([f for f in filenames if os.path.basename(f).startswith(prefix + '_')])
+
+
+# packing of cprec as int16: precipitation is rounded to PACK_SCALE mm/h, from 0 to PACK_MAX
+# mm/h, the smallest value is the fill value
+PACK_SCALE = 0.01
+PACK_OFFSET = 32767*PACK_SCALE
+PACK_MAX = 65534*PACK_SCALE
+PACK_FILL_VALUE = -32768
+
+
 class OutputFromPickle:
 
     def __init__(self, nb_day, lat, lon, inputdir, outputdir, list_prefix, dict_pickles, \
@@ -64,6 +89,9 @@ class OutputFromPickle:
         # name of the pickle files to be read
         self.filenames = []
 
+        # dictionary with name of pickle file as key, first and last time indices as value
+        self.time_ranges = {}
+
         # dictionary with name of pickle file as key, value is a np.array with same length as
         # number of tracks from pickle, set at 0 by default and replace by track Id when track
         # over several output files
@@ -87,120 +115,183 @@ class OutputFromPickle:
         # list of prefix of the different regions to include in the output
         self.list_prefix = list_prefix
 
-        # dictionary with pickle name as key and file as value
+        # PickleCache with pickle name as key and TrackStore of the file as value
         self.dict_pickles = dict_pickles
 
 
-    def selectPickles(self):
+    def selectPickles(self, t_begin=None):
         """
+        @param t_begin: if given, only select the pickles with tracks after this time index,
+                        the others would have been deleted by the previous days
         @return list with all the pickles needed for a day
         """
         for n in range(len(self.list_prefix)):
-            test = [i for i in os.listdir(self.inputdir)]
+            manifest = HarvestManifest(self.inputdir, self.list_prefix[n])
+            if manifest.exists():
+                # files written by the harvest and not deleted yet
+                for path, t_min, t_max in manifest.select(self.end, t_begin):
+                    self.filenames.append(self.inputdir+os.path.basename(path))
+                    self.time_ranges[self.filenames[-1]] = (t_min, t_max)
+                continue
+
+            # no manifest, harvest files written by older versions
             files = [i for i in os.listdir(self.inputdir) if \
                       os.path.isfile(os.path.join(self.inputdir,i)) \
                       and i.startswith(self.list_prefix[n])]
             for nb in range(len(files)):
                 num = [int(s) for s in files[nb].split('_') if s.isdigit()]
-                if num[0] <= self.end :
+                if num[0] <= self.end and (t_begin is None or num[1] >= t_begin):
                     self.filenames.append(self.inputdir+files[nb])
+                    self.time_ranges[self.filenames[-1]] = (num[0], num[1])
         return self.filenames
 
 
     def extractTracks(self, files):
         """
         Extract tracks that correspond to the time of the file and gives them
-        a unique id
+        a unique id. The cells of all the clusters of the day are gathered as flat indices
+        and written at once
         @param files: all the pickles files for this day
         """
-        self.clusters = np.zeros((self.end-self.ini, len(self.lat), len(self.lon)))
-        tot_lon = len(self.lon)
+        all_indices = []
+        all_values = []
         for i in files:
-            lat_min, lat_max, lon_min, lon_max = self.getLatLon(i)
+            tracks = self.dict_pickles.get(i)
+            indices, values = self.getCells(i, tracks, self.assignIds(i, tracks))
+            all_indices.append(indices)
+            all_values.append(values)
+        self.setClusters(all_indices, all_values)
 
-            # Check if file already unzipped
-            if i not in self.dict_pickles:
-                with gzip.GzipFile(i) as gzf:
-                    tracks = cPickle.load(gzf)
-                    self.dict_pickles[i]=tracks
-            else:
-                tracks = self.dict_pickles[i]
-
-            # Set default track Id = 0 for all tracks if first time that file is read
-            if len(self.track_id) == 0:
-                self.track_id = {i: np.zeros(len(tracks))}
-            if i not in self.track_id :
-                print 'i not in self.track_id', i
-                self.setTrackId(i, len(tracks))
-            print 'i', i
-            for nb in range(len(tracks)):
-                keys = sorted(tracks[nb].keys())
-
-                # Check if track has an Id different from 0
-                if self.track_id.get(i)[nb] > 0 and ((keys[0] <= self.ini and keys[-1] >= self.ini) \
-                        or (keys[0] <= self.end and keys[-1] >= self.end)):
-                    new_id = self.track_id.get(i)[nb]
-                else :
-                    new_id = self.id + 1
-                    self.id = self.id + 1
-
-                # To avoid very large numbers in output, set up reasonable limit for id
-                if self.id > 10000:
-                    self.id = 1
-                    new_id = self.id
-
-                # Fill in clusters with new_id
-                for k in keys:
-                    if k >= self.ini and k < self.end:
-                        for cl in tracks[nb][k].get('clusters'):
-                            i_index, j_index, mat = cl.toArray()
-                            if int(lon_min) < int(lon_max):
-                                if len(self.list_prefix)==1:
-                                    self.clusters[k-self.ini, i_index[0]:i_index[-1]\
-                                               +1,j_index[0]:j_index[-1]\
-                                               +1][np.where(mat==1)]= new_id
-                                else:
-                                    self.clusters[k-self.ini, i_index[0]+int(lat_min):i_index[-1]\
-                                               +int(lat_min)+1,j_index[0]+int(lon_min):j_index[-1]\
-                                               +int(lon_min)+1][np.where(mat==1)]= new_id
-
-                            # Special case for region on both sides of 0 degree longitude
-                            else :
-                                len_west = tot_lon - int(lon_min)
-
-                                # Only positive longitudes
-                                if j_index[0] > len_west :
-                                    self.clusters[k-self.ini, i_index[0]+int(lat_min):i_index[-1]\
-                                                   +int(lat_min)+1,j_index[0]-len_west:j_index[-1]\
-                                                   -len_west+1][np.where(mat==1)]= new_id
-
-                                # Only negative longitudes
-                                elif j_index[-1] < len_west :
-                                    self.clusters[k-self.ini, i_index[0]+int(lat_min):i_index[-1]\
-                                                   +int(lat_min)+1,j_index[0]+int(lon_min):j_index[-1]\
-                                                   +int(lon_min)+1][np.where(mat==1)]= new_id
-
-                                # Both
-                                else :
-                                    mat_west = mat[:,0:(len_west-j_index[0])]
-                                    mat_east = mat[:,(len_west-j_index[0]):]
-                                    self.clusters[k-self.ini, i_index[0]+int(lat_min):i_index[-1]\
-                                                   +int(lat_min)+1,0:len(j_index)\
-                                                   -(len_west-j_index[0])+1]\
-                                                   [np.where(mat_east==1)]= new_id
-                                    self.clusters[k-self.ini, i_index[0]+int(lat_min):i_index[-1]\
-                                                   +int(lat_min)+1,j_index[0]+int(lon_min):]\
-                                                   [np.where(mat_west==1)]= new_id
-
-                            # Replace track ID kept for next output file if track goes further
-                            # than end of this day
-                            if keys[-1] >= self.end-self.ini:
-                                self.track_id[i][nb] = new_id
-
-                # if id not used, do not waste id
-                if keys[-1] < self.ini or keys[0] >= self.end:
-                    self.id = self.id -1
-                    new_id = self.id - 1
+
+    def assignIds(self, filename, tracks):
+        """
+        Give an id to the tracks of a pickle for this day, the tracks going on after the
+        end of the day keep their id for the next days
+        @param filename: pickle file
+        @param tracks: TrackStore of the pickle
+        @return id of each track, 0 for the tracks without clusters this day
+        """
+        i = filename
+
+        # Set default track Id = 0 for all tracks if first time that file is read
+        if len(self.track_id) == 0:
+            self.track_id = {i: np.zeros(len(tracks))}
+        if i not in self.track_id :
+            print 'i not in self.track_id', i
+            self.setTrackId(i, len(tracks))
+        print 'i', i
+
+        in_day = tracks.getActiveTracks(self.ini, self.end)
+        first_t = tracks.entry_t[tracks.track_entry_offset[:-1]]
+        last_t = tracks.entry_t[tracks.track_entry_offset[1:] - 1]
+        values = np.zeros(len(tracks), np.int32)
+        for nb in range(len(tracks)):
+            keys = first_t[nb], last_t[nb]
+
+            # Check if track has an Id different from 0
+            if self.track_id.get(i)[nb] > 0 and ((keys[0] <= self.ini and keys[-1] >= self.ini) \
+                    or (keys[0] <= self.end and keys[-1] >= self.end)):
+                new_id = self.track_id.get(i)[nb]
+            else :
+                new_id = self.id + 1
+                self.id = self.id + 1
+
+            # To avoid very large numbers in output, set up reasonable limit for id
+            if self.id > 10000:
+                self.id = 1
+                new_id = self.id
+
+            if in_day[nb]:
+                values[nb] = new_id
+
+                # Replace track ID kept for next output file if track goes further
+                # than end of this day
+                if keys[-1] >= self.end-self.ini:
+                    self.track_id[i][nb] = new_id
+
+            # if id not used, do not waste id
+            if keys[-1] < self.ini or keys[0] >= self.end:
+                self.id = self.id -1
+                new_id = self.id - 1
+        return values
+
+
+    def getCells(self, filename, tracks, values):
+        """
+        Find where the clusters of the day are in the output
+        @param filename: pickle file
+        @param tracks: TrackStore of the pickle
+        @param values: id of each track
+        @return flat indices in the output of the cells of the clusters and their id
+        """
+        run_track, run_t, run_i, run_j, run_len = tracks.getRuns(self.ini, self.end)
+        iis, jjs = decodeRuns(run_i, run_j, run_len)
+        indices = self.toFlatIndices(self.getLatLon(filename), \
+                                     np.repeat(run_t - self.ini, run_len), iis, jjs)
+        return indices, np.repeat(values[run_track], run_len)
+
+
+    def toFlatIndices(self, list_lat_lon, t_index, iis, jjs):
+        """
+        Position in the output of cells of a region: the region starts at (lat_min, lon_min)
+        unless it is the only one, a region on both sides of 0 degree longitude continues at
+        longitude 0
+        @param list_lat_lon: lat_min, lat_max, lon_min, lon_max of the region
+        @param t_index: time steps in the day
+        @param iis: i indices in the region
+        @param jjs: j indices in the region
+        @return flat indices in the output
+        """
+        lat_min, lat_max, lon_min, lon_max = list_lat_lon
+        nb_lat, nb_lon = len(self.lat), len(self.lon)
+        wrap = int(lon_min) >= int(lon_max)
+        if len(self.list_prefix) > 1 or wrap:
+            iis = iis + int(lat_min)
+            jjs = jjs + int(lon_min)
+        if wrap:
+            jjs = np.where(jjs >= nb_lon, jjs - nb_lon, jjs)
+        return (t_index.astype(np.int64)*nb_lat + iis)*nb_lon + jjs
+
+
+    def readPrecip(self, old_filename):
+        """
+        Read the precipitation of the day from the files written by the tracking with
+        -precip_store, instead of the input file
+        @param old_filename: name of cmorph file corresponding
+        @return precipitation on the grid of the output (0 outside the clusters of the
+                regions), time and its units, None if a region has no file for this day
+        """
+        stores = []
+        for prefix in self.list_prefix:
+            filename = getPrecipFilename(self.inputdir, prefix, old_filename[-17:-7])
+            if not os.path.isfile(filename):
+                return None
+            stores.append((prefix, PrecipStore(filename)))
+        shape = (stores[0][1].shape[0], len(self.lat), len(self.lon))
+        data = np.zeros(shape, np.float32)
+        mask = np.zeros(shape, bool)
+        for prefix, store in stores:
+            list_lat_lon = readTxt(self.inputdir+'lat-lon_'+str(prefix)+'.txt')
+            t_index, iis, jjs, values = store.getCells()
+            data.reshape(-1)[self.toFlatIndices(list_lat_lon, t_index, iis, jjs)] = values
+            t_index, iis, jjs = store.getMissing()
+            mask.reshape(-1)[self.toFlatIndices(list_lat_lon, t_index, iis, jjs)] = True
+        return np.ma.masked_array(data, mask), store.time, store.time_units
+
+
+    def setClusters(self, all_indices, all_values):
+        """
+        Write the cells of the clusters of the day in the output
+        @param all_indices: list of arrays of flat indices, one per pickle
+        @param all_values: list of arrays of ids
+        """
+        self.clusters = np.zeros((self.end-self.ini, len(self.lat), len(self.lon)), np.int32)
+
+        # when clusters overlap the last one written is kept as before
+        if all_indices:
+            indices = np.concatenate(all_indices)[::-1]
+            indices, last = np.unique(indices, return_index=True)
+            self.clusters.reshape(-1)[indices] = np.concatenate(all_values)[::-1][last]
 
 
     def getLatLon(self, file):
@@ -227,16 +318,22 @@ class OutputFromPickle:
         self.track_id[filename] = np.zeros(nb_tracks)
 
 
+    def getFinishedPickles(self):
+        """
+        @return the pickles of this day whose tracks all end before the end of the day
+        """
+        return [filename for filename in self.filenames if self.time_ranges[filename][1] < self.end]
+
+
     def deletePickles(self):
         """
         Delete pickle once all its tracks are finished
         """
-        for nb in range(len(self.filenames)):
-            num = [int(s) for s in self.filenames[nb].split('_') if s.isdigit()]
-            if num[1] < self.end :
-                os.remove(self.filenames[nb])
-                self.deleteTrackId(self.filenames[nb])
-                del self.dict_pickles[self.filenames[nb]]
+        deleted = self.getFinishedPickles()
+        for filename in deleted:
+            self.deleteTrackId(filename)
+            self.dict_pickles.discard(filename)
+        deleteFiles(self.inputdir, self.list_prefix, deleted)
 
 
     def deleteTrackId(self, filename):
@@ -247,12 +344,21 @@ class OutputFromPickle:
         self.track_id.pop(filename)
 
 
-    def writeFile(self, suffix, old_filename, list_lat_lon):
+    def writeFile(self, suffix, old_filename, list_lat_lon, complevel=4, shuffle=True, \
+                  chunksizes=(48, 32, 32), pack_precip=False, nb_type='i4'):
         """
         Write data to netcdf file
         @param suffix: suffix for output
         @param old_filename: name of cmorph file corresponding
         @param list_lat_lon: list given lat and lon for output file
+        @param complevel: deflate level of cprec and nb, 0 for no compression
+        @param shuffle: use the shuffle filter before compressing cprec and nb
+        @param chunksizes: (time, lat, lon) chunk shape of cprec and nb, None for the default
+                           of the netcdf library (one time step per chunk, slow to read the
+                           time series of a pixel)
+        @param pack_precip: write cprec as int16 with scale_factor and add_offset, precipitation
+                            is then rounded to PACK_SCALE and limited to PACK_MAX
+        @param nb_type: type of nb, 'i4' or 'u2' (ids are at most 10000)
         """
         new_filename = str(self.outputdir)+'tracking'+str(old_filename[-18:-7])+'_'\
                         +str(suffix)+'.nc'
@@ -269,22 +375,18 @@ class OutputFromPickle:
 
         lat_min, lat_max, lon_min, lon_max = list_lat_lon
 
-        # read data needed
-        zipfile = bz2.BZ2File(old_filename)
-        data_unzip = zipfile.read()
-        filename = old_filename[:-4]
-        open(filename, 'wb').write(data_unzip)
-        try:
-            ori = nc(filename)
-        except RuntimeError:
-            ori = nc(filename.replace('-','_'))
-        if max(list_lat_lon)>0:
-            var = ori.variables["CMORPH"][:,lat_min:lat_max,lon_min:lon_max]
+        # read data needed, from the files written by the tracking if there are some
+        precip_day = self.readPrecip(old_filename)
+        if precip_day is not None:
+            var, tint, unit = precip_day
         else:
-            var = ori.variables["CMORPH"][:,:,:]
-        tint = ori.variables["time"][:]
-        unit = ori.variables["time"].units
-        os.remove(filename)
+            with InputReader(old_filename) as ori:
+                if max(list_lat_lon)>0:
+                    var = ori.getData(slice(lat_min, lat_max), slice(lon_min, lon_max))
+                else:
+                    var = ori.variables["CMORPH"][:,:,:]
+                tint = ori.variables["time"][:]
+                unit = ori.variables["time"].units
 
         # create variables
         i_index = f.createVariable('lat', 'f', ('lat',) ,zlib=True,complevel=9,\
@@ -307,8 +409,18 @@ class OutputFromPickle:
         f.variables['time'].calendar='standard'
         f.variables['time'].units=unit
 
-        precip = f.createVariable('cprec','f',('time','lat','lon'),zlib=True,complevel=9,\
-                    least_significant_digit=4)
+        if chunksizes is not None:
+            chunksizes = [min(c, n) for c, n in zip(chunksizes, self.clusters.shape)]
+        compression = {'zlib': complevel > 0, 'complevel': complevel, 'shuffle': shuffle, \
+                       'chunksizes': chunksizes}
+        if pack_precip:
+            precip = f.createVariable('cprec', 'i2', ('time','lat','lon'), \
+                        fill_value=PACK_FILL_VALUE, **compression)
+            f.variables['cprec'].scale_factor = PACK_SCALE
+            f.variables['cprec'].add_offset = PACK_OFFSET
+        else:
+            precip = f.createVariable('cprec','f',('time','lat','lon'), \
+                        least_significant_digit=4, **compression)
         f.variables['cprec'].gridtype='lonlat'
         f.variables['cprec'].code=999
         f.variables['cprec'].long_name='detected coastal precipitation'
@@ -316,7 +428,7 @@ class OutputFromPickle:
         f.variables['cprec'].short_name='cprec'
         f.variables['cprec'].units='mm/h'
 
-        nb_var = f.createVariable('nb', 'i4', ('time', 'lat', 'lon'), zlib=True)
+        nb_var = f.createVariable('nb', nb_type, ('time', 'lat', 'lon'), **compression)
         f.variables['nb'].gridtype='lonlat'
         f.variables['nb'].code=0
         f.variables['nb'].long_name='identification number of the clusters'
@@ -329,12 +441,13 @@ class OutputFromPickle:
         t_index[:] = tint[:]
 
         # Write data for whole day
-        mask=np.zeros((self.end-self.ini, num_i, num_j))
-        mask[np.where(self.clusters != 0)] = 1
-        precip[:] = var * mask
+        data = var * (self.clusters != 0)
+        del var
+        if pack_precip:
+            data = np.ma.clip(data, 0, PACK_MAX)
+        precip[:] = data
         nb_var[:] = self.clusters
-        unique = np.unique(self.clusters)
-        del var, mask, data_unzip
+        del data
         f.close()
 
 
@@ -347,3 +460,44 @@ class OutputFromPickle:
         cPickle.dump(info, f)
 
 
+#############################################################################################
+
+def testExtractTracks():
+    import shutil
+    import tempfile
+    from cluster import Cluster
+    from pickle_cache import PickleCache
+    from track_store import writeTracks
+    tmpdir = tempfile.mkdtemp() + '/'
+    try:
+        # region aa from longitude 10, region bb on both sides of 0 degree longitude
+        createTxt(tmpdir + 'lat-lon_aa.txt', [0, 10, 10, 30])
+        createTxt(tmpdir + 'lat-lon_bb.txt', [5, 15, 90, 20])
+        def track(t_indices, iis, jjs):
+            cl = Cluster((np.array(iis, np.int32), np.array(jjs, np.int32)))
+            return dict((t, {'area': len(iis), 'clusters': [cl]}) for t in t_indices)
+        with open(tmpdir + 'aa_0_60_xyz_0', 'wb') as f:
+            writeTracks(f, [track([3, 4], [1, 1], [2, 3]), track([40, 60], [0], [0])])
+        with open(tmpdir + 'bb_2_3_xyz_0', 'wb') as f:
+            # cells on the west (j < 10) and on the east, the second track overlaps the first
+            writeTracks(f, [track([2], [0, 0, 1], [8, 9, 10]), track([2, 3], [0, 0], [9, 12])])
+        files = [tmpdir + 'aa_0_60_xyz_0', tmpdir + 'bb_2_3_xyz_0']
+        ofp = OutputFromPickle(0, np.arange(20), np.arange(100), tmpdir, tmpdir, ['aa', 'bb'], \
+                               PickleCache(), {}, 0)
+        ofp.extractTracks(files)
+        assert(ofp.clusters.dtype == np.int32)
+        assert(ofp.clusters.sum() == 1*4 + 2*1 + 3*2 + 4*4)
+        assert(list(ofp.clusters[3, 1, 12:14]) == [1, 1])
+        assert(ofp.clusters[40, 0, 10] == 2)
+        assert(list(ofp.clusters[2, 5, 98:]) == [3, 4] and ofp.clusters[2, 6, 0] == 3)
+        assert(ofp.clusters[2, 5, 2] == 4 and ofp.clusters[3, 5, 99] == 4)
+        assert(ofp.id == 4)
+        # track 2 continues the next day
+        assert(list(ofp.track_id[files[0]]) == [0, 2])
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testExtractTracks OK'
+
+
+if __name__ == '__main__':
+    testExtractTracks()
@@ -0,0 +1,743 @@
+'''
+Created in October 2026
+
+@description: Tracking of a domain split into bands of longitudes. Each band is extended by
+              a halo on both sides and tracked in its own process with its own
+              TimeConnectedClusters. The bands are tracked segment of days after segment of
+              days, going on from their restart files. After each segment, the tracks harvested
+              by the bands are stitched across the halos and harvested as in tracking.py, so
+              that write_output_pp.py reads them as the pickles of a single run over the whole
+              domain. Only the tracks that can still be joined to a track alive in a band are
+              kept in memory until the next segment
+'''
+
+import argparse
+import configparser
+import cPickle
+import glob
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import numpy as np
+from datetime import datetime
+from checkpoint import Checkpoint
+from cluster import Cluster, countCommonCells
+from coastal_mapping import CoastalMapping
+from harvest_manifest import HarvestManifest
+from input_reader import InputReader
+from output_from_pickle import deleteFiles
+from time_connected_clusters import TimeConnectedClusters
+from track_store import TrackStore, writeTracks
+from tracking import tracking, writeLatLon, listDays
+from write_output_pp import createTxt
+
+
+def splitDomain(width, num_tiles, halo):
+    """
+    Split the longitudes of a domain into bands of the same size
+    @param width: number of longitudes of the domain
+    @param num_tiles: number of bands
+    @param halo: number of longitudes added on each side of the bands
+    @return list of (core_start, core_stop, start, stop), indices relative to the domain.
+            The cores cover the domain without overlap, start:stop is the band with its halo
+    """
+    if num_tiles < 1 or num_tiles > width:
+        raise ValueError('Cannot split %d longitudes into %d bands' % (width, num_tiles))
+    if halo < 0:
+        raise ValueError('The halo must be positive')
+    bounds = [width * k // num_tiles for k in range(num_tiles + 1)]
+    tiles = []
+    for k in range(num_tiles):
+        tiles.append((bounds[k], bounds[k + 1], max(0, bounds[k] - halo), \
+                      min(width, bounds[k + 1] + halo)))
+    return tiles
+
+
+def getDomainWidth(minmax_lons, num_lon):
+    """
+    @param minmax_lons: min and max longitude indices, min > max for a domain on both sides
+                        of 0 degree of longitude
+    @param num_lon: number of longitudes of the data
+    @return number of longitudes of the domain
+    """
+    if minmax_lons[0] < minmax_lons[1]:
+        return minmax_lons[1] - minmax_lons[0]
+    return minmax_lons[1] - minmax_lons[0] + num_lon
+
+
+def getTileLons(minmax_lons, start, stop, num_lon):
+    """
+    @param minmax_lons: min and max longitude indices of the domain
+    @param start: first longitude index of the band, relative to the domain
+    @param stop: last longitude index + 1 of the band, relative to the domain
+    @param num_lon: number of longitudes of the data
+    @return min and max longitude indices of the band in the data
+    """
+    return np.array([(minmax_lons[0] + start) % num_lon, (minmax_lons[0] + stop) % num_lon])
+
+
+def reachesOverlap(cl, start, stop):
+    """
+    @param cl: cluster
+    @param start: first longitude index of the overlap
+    @param stop: last longitude index + 1 of the overlap
+    @return True if the box of the cluster reaches into the overlap
+    """
+    return cl.box[1][1] >= start and cl.box[0][1] < stop
+
+
+def getOverlaps(tiles, k):
+    """
+    @param tiles: list of (core_start, core_stop, start, stop)
+    @param k: index of a band
+    @return list of (start, stop) of the overlaps of the band with its neighbours, relative
+            to the domain
+    """
+    overlaps = []
+    if k > 0:
+        overlaps.append((tiles[k][2], tiles[k - 1][3]))
+    if k < len(tiles) - 1:
+        overlaps.append((tiles[k + 1][2], tiles[k][3]))
+    return overlaps
+
+
+def getLiveFilename(targetdir, suffix, segment):
+    """
+    @param targetdir: directory of the pickles of the band
+    @param suffix: suffix of the band
+    @param segment: index of the segment
+    @return name of the file of the clusters of the live tracks at the end of the segment
+    """
+    return os.path.join(targetdir, 'live_%s_%d' % (suffix, segment))
+
+
+def writeLiveClusters(filename, tracks, overlaps):
+    """
+    Write the clusters of the tracks still alive in a band that reach the overlaps with the
+    neighbouring bands, the tracks harvested on the other side of the seams may be joined to
+    them. The file is written under a temporary name first
+    @param filename: name of the file
+    @param tracks: tracks still alive
+    @param overlaps: list of (start, stop) of the overlaps, relative to the band
+    """
+    live = []
+    for track in tracks:
+        seam_track = {}
+        for t_index, cl_list in track.items():
+            clusters = [cl for cl in cl_list['clusters'] \
+                        if any(reachesOverlap(cl, start, stop) for start, stop in overlaps)]
+            if clusters:
+                seam_track[t_index] = {'area': sum(cl.getNumberOfCells() for cl in clusters), \
+                                       'clusters': clusters}
+        if seam_track:
+            live.append(seam_track)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        writeTracks(f, live)
+    os.rename(tmp_filename, filename)
+
+
+def trackTile(args):
+    """
+    Track the days of a segment in a band, run in a separate process. The band goes on from
+    its restart files, which are written at the end of the segment, and the clusters of its
+    live tracks in the overlaps are written to the live file of the segment (see
+    writeLiveClusters). The output of tracking goes to a log file in the directory of the band
+    @param args: tuple of the arguments of tracking, the restart directory, the number of
+                 days of the segments, whether this is the last segment, the overlaps
+                 relative to the band and the name of the live file
+    """
+    fyear, lyear, minmax_lons, minmax_lats, suffix, targetdir, harvestPeriod, prefetch, cm, \
+        restart_dir, segment_days, last, overlaps, live_filename = args
+    stdout = sys.stdout
+    sys.stdout = open(os.path.join(targetdir, suffix + '.log'), 'a')
+    try:
+        checkpoint = Checkpoint(os.path.join(restart_dir, "clusters_restart_%s" % suffix))
+        if not checkpoint.exists():
+            # first segment, remove the pickles of an interrupted run
+            deleteFiles(targetdir, [suffix], glob.glob(os.path.join(targetdir, suffix + '_*')))
+        tcc = tracking(fyear, lyear, minmax_lons, minmax_lats, suffix, restart_dir, \
+                       segment_days, harvestPeriod, prefetch=prefetch, workers=1, \
+                       targetdir=targetdir, filter_tracks=False, coastal_mapping=cm, \
+                       final_harvest=last)
+        writeLiveClusters(live_filename, tcc.cluster_connect, overlaps)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def loadTracks(targetdir, suffix, j_offset, first_index=0):
+    """
+    Load the tracks harvested by tracking, in the order of the harvests
+    @param targetdir: directory of the pickles
+    @param suffix: suffix of the run
+    @param j_offset: longitude index added to the cells of the clusters
+    @param first_index: only load the pickles with this pickle index or a larger one
+    @return list of tracks, names of the pickles
+    """
+    manifest = HarvestManifest(targetdir, suffix)
+    if not manifest.exists():
+        return [], []
+    tracks = []
+    filenames = []
+    for t_min, t_max, num_tracks, pickle_index, name in manifest.read()[0]:
+        if pickle_index >= first_index:
+            filenames.append(os.path.join(targetdir, name))
+            tracks += TrackStore(filenames[-1]).getTracks(j_offset=j_offset)
+    return tracks, filenames
+
+
+def isOwned(cl, tile):
+    """
+    A cluster belongs to the band whose core contains the mean longitude index of its cells,
+    the other bands only see it in their halo
+    @param cl: cluster, indices relative to the domain
+    @param tile: (core_start, core_stop, start, stop)
+    @return True if the band owns the cluster
+    """
+    j_mean = cl.jjs.mean()
+    return tile[0] <= j_mean < tile[1]
+
+
+def joinTracks(tiles_tracks, tiles):
+    """
+    Group the tracks of the bands that are the same track seen from both sides of a seam:
+    tracks of neighbouring bands that share cells at the same time
+    @param tiles_tracks: list of the tracks of each band, indices relative to the domain
+    @param tiles: list of (core_start, core_stop, start, stop)
+    @return list of groups of indices of the tracks, the tracks of all the bands being numbered
+            one band after the other. Groups are in the order of their first track
+    """
+    tracks = []
+    for tile_tracks in tiles_tracks:
+        tracks += tile_tracks
+
+    # union-find over the tracks
+    parent = range(len(tracks))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    start = 0
+    for k in range(len(tiles) - 1):
+        stop = start + len(tiles_tracks[k])
+
+        # clusters that reach into the overlap of the two bands, by time index
+        ov_start, ov_stop = tiles[k + 1][2], tiles[k][3]
+        west, east = {}, {}
+        for side, ids in (west, xrange(start, stop)), \
+                         (east, xrange(stop, stop + len(tiles_tracks[k + 1]))):
+            for track_id in ids:
+                for t_index, cl_list in tracks[track_id].items():
+                    for cl in cl_list['clusters']:
+                        if reachesOverlap(cl, ov_start, ov_stop):
+                            side.setdefault(t_index, []).append((track_id, cl))
+
+        # join the tracks whose clusters share cells, the common cells of all the pairs of
+        # clusters at a time index are counted at once
+        for t_index in west:
+            if t_index not in east:
+                continue
+            common = countCommonCells([cl for track_id, cl in west[t_index]], \
+                                      [cl for track_id, cl in east[t_index]])
+            for n_w, n_e in sorted(common, key=lambda pair: (pair[1], pair[0])):
+                parent[find(east[t_index][n_e][0])] = find(west[t_index][n_w][0])
+        start = stop
+
+    groups = {}
+    roots = []
+    for track_id in range(len(tracks)):
+        root = find(track_id)
+        if root not in groups:
+            groups[root] = []
+            roots.append(root)
+        groups[root].append(track_id)
+    return [groups[root] for root in roots]
+
+
+def mergeTracks(tracks, tiles):
+    """
+    Join the tracks of a group with the owned clusters only, so that the clusters in the halos
+    are not duplicated
+    @param tracks: list of (index of the band, track)
+    @param tiles: list of (core_start, core_stop, start, stop)
+    @return joined track, empty if no cluster is owned
+    """
+    new_track = {}
+    for k, track in tracks:
+        for t_index, cl_list in track.items():
+            clusters = [cl for cl in cl_list['clusters'] if isOwned(cl, tiles[k])]
+            if not clusters:
+                continue
+            if t_index not in new_track:
+                new_track[t_index] = {'area': 0, 'clusters': []}
+            new_track[t_index]['clusters'] += clusters
+            new_track[t_index]['area'] += sum(cl.getNumberOfCells() for cl in clusters)
+    return new_track
+
+
+def stitchTracks(tiles_tracks, tiles):
+    """
+    Stitch the tracks of the bands. Tracks of neighbouring bands that share cells at the same
+    time are the same track seen from both sides of the seam and are joined. Each cluster is
+    kept only by the band that owns it, so that the clusters in the halos are not duplicated
+    @param tiles_tracks: list of the tracks of each band, indices relative to the domain
+    @param tiles: list of (core_start, core_stop, start, stop)
+    @return list of tracks
+    """
+    tracks = []
+    for k, tile_tracks in enumerate(tiles_tracks):
+        tracks += [(k, track) for track in tile_tracks]
+    stitched = []
+    for group in joinTracks(tiles_tracks, tiles):
+        new_track = mergeTracks([tracks[track_id] for track_id in group], tiles)
+        if new_track:
+            stitched.append(new_track)
+    return stitched
+
+
+class Stitcher:
+    """
+    Stitch the tracks harvested by the bands segment after segment and harvest the stitched
+    tracks at the same time steps and with the same checks as in tracking.py. The tracks of
+    the bands wait in memory while they can be joined to a track alive in a band, the others
+    are harvested at the end of the segment
+    """
+
+    def __init__(self, tiles, timesteps, harvestPeriod, prefix, i_minmax, j_minmax, mask, \
+                 frac, max_cells, length_time, length_time_lim, ind_lim):
+        """
+        Constructor
+        @param tiles: list of (core_start, core_stop, start, stop)
+        @param timesteps: number of time steps per day
+        @param harvestPeriod: number of time steps between two harvests (0 for no harvest)
+        @param prefix, i_minmax, j_minmax, mask, frac, max_cells, length_time, length_time_lim,
+               ind_lim: see TimeConnectedClusters.harvestTracks
+        """
+        self.tiles = tiles
+        self.timesteps = timesteps
+        self.harvestPeriod = harvestPeriod
+        self.harvest_args = (prefix, i_minmax, j_minmax, mask, frac, max_cells, length_time, \
+                             length_time_lim, ind_lim)
+
+        # tracks of each band waiting to be stitched, in the order of the harvests, with their
+        # number among all the tracks harvested by the band
+        self.pending = [[] for tile in tiles]
+        self.num_harvested = [0] * len(tiles)
+
+        # stitched tracks waiting for the next harvest, (first time index, first track of the
+        # bands, track)
+        self.finished = []
+
+
+    def getState(self):
+        """
+        @return what is needed to go on after a restart
+        """
+        return {'pending': self.pending, 'num_harvested': self.num_harvested, \
+                'finished': self.finished}
+
+
+    def setState(self, state):
+        """
+        @param state: value returned by getState
+        """
+        self.pending = state['pending']
+        self.num_harvested = state['num_harvested']
+        self.finished = state['finished']
+
+
+    def getNumberOfPendingTracks(self):
+        """
+        @return number of tracks of the bands waiting to be stitched
+        """
+        return sum(len(tile_pending) for tile_pending in self.pending)
+
+
+    def addSegment(self, tiles_tracks, live_tracks, t_begin, t_end, pickle_index, last=False):
+        """
+        Stitch the tracks harvested by the bands during a segment and harvest the stitched
+        tracks that cannot be joined to the live tracks of the bands any more
+        @param tiles_tracks: list of the tracks harvested by each band during the segment
+        @param live_tracks: list of the clusters of the live tracks of each band in the
+                            overlaps at the end of the segment
+        @param t_begin: first time index of the segment
+        @param t_end: last time index + 1 of the segment
+        @param pickle_index: index of the pickles written
+        @param last: last segment, all the tracks are harvested at the end
+        """
+        num_tiles = len(self.tiles)
+        for k in range(num_tiles):
+            for track in tiles_tracks[k]:
+                self.pending[k].append((self.num_harvested[k], track))
+                self.num_harvested[k] += 1
+
+        # the live tracks follow the tracks of their band, the groups with a live track are
+        # not finished
+        nodes = []
+        for k in range(num_tiles):
+            nodes += [(k, n) for n in range(len(self.pending[k]))]
+            nodes += [(k, None)] * len(live_tracks[k])
+        groups = joinTracks([[track for num, track in self.pending[k]] + live_tracks[k] \
+                             for k in range(num_tiles)], self.tiles)
+        finished = self.finished
+        done = [np.zeros(len(tile_pending), bool) for tile_pending in self.pending]
+        for group in groups:
+            members = [nodes[track_id] for track_id in group]
+            if any(n is None for k, n in members):
+                continue
+            new_track = mergeTracks([(k, self.pending[k][n][1]) for k, n in members], self.tiles)
+            for k, n in members:
+                done[k][n] = True
+            if new_track:
+                # tracks are ordered by first time index and then by first track of the bands,
+                # as when all the tracks of the bands are stitched at once
+                first = min((k, self.pending[k][n][0]) for k, n in members)
+                finished.append((min(new_track), first, new_track))
+        self.pending = [[item for item, is_done in zip(self.pending[k], done[k]) if not is_done] \
+                        for k in range(num_tiles)]
+        finished.sort(key=lambda item: item[:2])
+
+        tcc = TimeConnectedClusters()
+        for t_index in xrange(t_begin, t_end):
+            if self.harvestPeriod and (t_index % self.timesteps + 1) % self.harvestPeriod == 0:
+                tcc.cluster_connect = [item[2] for item in finished if max(item[2]) < t_index]
+                finished = [item for item in finished if max(item[2]) >= t_index]
+                tcc.t_index = t_index + 1
+                tcc.harvestTracks(*self.harvest_args, pickle_index=pickle_index, dead_only=True)
+        if last:
+            tcc.cluster_connect = [item[2] for item in finished]
+            tcc.harvestTracks(*self.harvest_args, pickle_index=pickle_index, dead_only=False)
+            finished = []
+        self.finished = finished
+
+
+def writeStitchState(filename, state):
+    """
+    Write the state of the stitching under a temporary name first
+    @param filename: name of the file
+    @param state: dictionary
+    """
+    tmp_filename = filename + '.tmp'
+    with gzip.GzipFile(tmp_filename, 'wb') as f:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+
+
+def partitionedTracking(fyear, lyear, minmax_lons, minmax_lats, suffix, harvestPeriod, \
+                         num_tiles, halo=None, processes=None, prefetch=0, keep_tiles=False, \
+                         segment_days=1, restart_dir=None):
+    """
+    Track a domain split into bands of longitudes
+    @param fyear: first date
+    @param lyear: last date
+    @param minmax_lons: min and max longitude indices of the domain
+    @param minmax_lats: min and max latitude indices of the domain
+    @param suffix: suffix for output
+    @param harvestPeriod: number of time steps between two harvests (0 for no harvest)
+    @param num_tiles: number of bands
+    @param halo: number of longitudes added on each side of the bands, None for twice lzone.
+                 It should be larger than the systems crossing the seams
+    @param processes: number of bands tracked at the same time, None for the number of cpus
+    @param prefetch: number of days read in advance by each band
+    @param keep_tiles: keep the pickles of the bands
+    @param segment_days: number of days tracked by the bands between two stitchings
+    @param restart_dir: directory of the restart files of the bands and of the stitching, the
+                        run goes on from them if they exist. None to start over, the restart
+                        files of the bands are then written in the directory of the bands
+    """
+    config_full = configparser.ConfigParser()
+    config_full.read('config.cfg')
+    C = config_full['clusters']
+    data_path = os.path.expandvars(C.get('data_path'))
+    lsm = os.path.expandvars(C.get('lsm_path'))
+    targetdir = os.path.expandvars(C.get('targetdir'))
+    reso = C.getint('reso')
+    szone = C.getint('szone', 8)
+    lzone = C.getint('lzone', 50)
+    frac_mask = C.getfloat('frac_mask', 1.0)
+    min_size = C.getint('min_size', 0)
+    max_size = C.getint('max_size', 800000)
+    max_cells = C.getint('max_cells', 4500)
+    t_life = C.getint('t_life', 5)
+    t_life_lim = C.getint('t_life_lim', 2)
+    mask_dir = C.get('mask_dir', None)
+    if mask_dir:
+        mask_dir = os.path.expandvars(mask_dir)
+    if halo is None:
+        halo = 2*lzone
+    if segment_days < 1:
+        raise ValueError('A segment must have at least one day')
+
+    days = listDays(data_path, fyear, lyear)
+    with InputReader(days[0][1]) as f:
+        num_lon = len(f.variables['lon'])
+        timesteps = len(f.variables['time'])
+    width = getDomainWidth(minmax_lons, num_lon)
+    tiles = splitDomain(width, num_tiles, halo)
+
+    # masks of the whole domain, each band uses its part of them
+    lat_slice = slice(minmax_lats[0], minmax_lats[1])
+    lon_slice = slice(minmax_lons[0], minmax_lons[1])
+    cm = CoastalMapping(lsm, np.int(reso), lat_slice, lon_slice, np.int(szone), \
+                         np.int(lzone), np.int(min_size), np.int(max_size), cache_dir=mask_dir)
+    stitcher = Stitcher(tiles, timesteps, harvestPeriod, targetdir+suffix, \
+                        (0, minmax_lats[1] - minmax_lats[0]), (0, width), np.flipud(cm.sArea), \
+                        frac_mask, max_cells, t_life*timesteps, t_life_lim*timesteps, minmax_lats)
+
+    # go on from the last segment stitched, or start over
+    tiledir = os.path.join(targetdir, 'tiles_' + str(suffix), '')
+    tile_suffixes = [str(suffix) + '-tile' + str(k) for k in range(num_tiles)]
+    first_segment = 0
+    state_filename = None
+    tile_restart_dir = os.path.join(tiledir, 'restart')
+    if restart_dir is not None:
+        tile_restart_dir = restart_dir
+        state_filename = os.path.join(restart_dir, 'stitch_restart_%s.pkl.gz' % suffix)
+    if state_filename is not None and os.path.exists(state_filename):
+        with gzip.GzipFile(state_filename) as f:
+            state = cPickle.load(f)
+        if state['tiles'] != tiles or state['segment_days'] != segment_days or \
+           state['fyear'] != fyear:
+            raise RuntimeError('The restart files in %s are for other bands or dates' % \
+                               restart_dir)
+        first_segment = state['segment']
+        stitcher.setState(state['stitcher'])
+        print "Restarting from segment", first_segment, "with", \
+              stitcher.getNumberOfPendingTracks(), "tracks waiting to be stitched"
+
+        # delete the pickles written after the restart file
+        deleted = []
+        for pickle in glob.glob(os.path.join(targetdir, "%s_*" % suffix)):
+            if int(pickle.split("_")[-1]) >= first_segment:
+                os.remove(pickle)
+                deleted.append(pickle)
+        manifest = HarvestManifest(targetdir, suffix)
+        if manifest.exists():
+            manifest.remove(deleted)
+    else:
+        if os.path.exists(tiledir):
+            shutil.rmtree(tiledir)
+        os.makedirs(tiledir)
+        if restart_dir is not None:
+            for tile_suffix in tile_suffixes:
+                dirname = os.path.join(restart_dir, "clusters_restart_%s" % tile_suffix)
+                if os.path.exists(dirname):
+                    shutil.rmtree(dirname)
+
+    for k, (core_start, core_stop, start, stop) in enumerate(tiles):
+        print 'band', k, 'core', core_start, core_stop, 'with halo', start, stop
+    num_segments = (len(days) + segment_days - 1) // segment_days
+    for segment in range(first_segment, num_segments):
+        first_day = segment * segment_days
+        last_day = min(first_day + segment_days, len(days))
+        last = last_day == len(days)
+        print 'segment', segment, days[first_day][0], days[last_day - 1][0]
+
+        # track the days of the segment in the bands, unless they were tracked before a restart
+        tasks = []
+        for k, (core_start, core_stop, start, stop) in enumerate(tiles):
+            live_filename = getLiveFilename(tiledir, tile_suffixes[k], segment)
+            if os.path.exists(live_filename):
+                continue
+            overlaps = [(ov_start - start, ov_stop - start) for ov_start, ov_stop \
+                        in getOverlaps(tiles, k)]
+            tasks.append((days[first_day][0], days[last_day - 1][0], \
+                          getTileLons(minmax_lons, start, stop, num_lon), minmax_lats, \
+                          tile_suffixes[k], tiledir, harvestPeriod, prefetch, \
+                          cm.getLonBand(start, stop), tile_restart_dir, segment_days, last, \
+                          overlaps, live_filename))
+        if processes == 1:
+            map(trackTile, tasks)
+        elif tasks:
+            pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+            try:
+                pool.map(trackTile, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        # stitch the tracks harvested by the bands during the segment
+        tiles_tracks = []
+        live_tracks = []
+        consumed = []
+        for k in range(num_tiles):
+            tracks, filenames = loadTracks(tiledir, tile_suffixes[k], tiles[k][2], segment)
+            tiles_tracks.append(tracks)
+            consumed.append(filenames)
+            live_filename = getLiveFilename(tiledir, tile_suffixes[k], segment)
+            live_tracks.append(TrackStore(live_filename).getTracks(j_offset=tiles[k][2]))
+        stitcher.addSegment(tiles_tracks, live_tracks, first_day*timesteps, \
+                            last_day*timesteps, segment, last)
+        print 'number of tracks', sum(len(tracks) for tracks in tiles_tracks), 'live', \
+              sum(len(tracks) for tracks in live_tracks), 'waiting', \
+              stitcher.getNumberOfPendingTracks()
+        del tiles_tracks, live_tracks
+
+        if state_filename is not None:
+            writeStitchState(state_filename, {'segment': segment + 1, 'tiles': tiles, \
+                                              'segment_days': segment_days, 'fyear': fyear, \
+                                              'stitcher': stitcher.getState()})
+        if not keep_tiles:
+            for k in range(num_tiles):
+                deleteFiles(tiledir, [tile_suffixes[k]], consumed[k])
+                os.remove(getLiveFilename(tiledir, tile_suffixes[k], segment))
+
+    # files read by the post-processing
+    if not os.path.isfile(str(targetdir)+'lat-lon_'+str(suffix)+'.txt'):
+        createTxt(str(targetdir)+'lat-lon_'+str(suffix)+'.txt', [minmax_lats[0], \
+                   minmax_lats[1], minmax_lons[0], minmax_lons[1]])
+    writeLatLon(targetdir, suffix, days[0][1], minmax_lats, minmax_lons)
+    createTxt(str(targetdir)+'filenames_'+str(suffix)+'.txt', [day[1] for day in days])
+
+    if not keep_tiles:
+        shutil.rmtree(tiledir)
+    if state_filename is not None:
+        os.remove(state_filename)
+
+
+#############################################################################################
+
+def createTestTrack(t_cells, min_ellipse_axis=1):
+    # track from {t_index: [set of cells]}
+    track = {}
+    for t_index, cells_list in t_cells.items():
+        clusters = [Cluster(cells, min_ellipse_axis) for cells in cells_list]
+        track[t_index] = {'area': sum(cl.getNumberOfCells() for cl in clusters), \
+                          'clusters': clusters}
+    return track
+
+def testSplitDomain():
+    tiles = splitDomain(100, 3, 10)
+    assert(tiles == [(0, 33, 0, 43), (33, 66, 23, 76), (66, 100, 56, 100)])
+    assert(getDomainWidth([10, 50], 200) == 40)
+    assert(getDomainWidth([180, 20], 200) == 40)
+    assert(list(getTileLons([180, 20], 10, 30, 200)) == [190, 10])
+    try:
+        splitDomain(2, 3, 0)
+        assert(False)
+    except ValueError:
+        pass
+    print 'testSplitDomain OK'
+
+def testStitchTracks():
+    tiles = splitDomain(40, 2, 6)
+    box = lambda i0, j0: set((i, j) for i in range(i0, i0 + 3) for j in range(j0, j0 + 3))
+
+    # system moving east across the seam at j = 20, seen by both bands in the halos
+    west = [createTestTrack({0: [box(5, 12)], 1: [box(5, 16)], 2: [box(5, 20)]}),
+            # system far from the seam
+            createTestTrack({0: [box(30, 2)], 1: [box(30, 3)]})]
+    east = [createTestTrack({1: [box(5, 16)], 2: [box(5, 20)], 3: [box(5, 24)]}),
+            createTestTrack({2: [box(20, 35)]})]
+    tracks = stitchTracks([west, east], tiles)
+    assert(len(tracks) == 3)
+    seam = tracks[0]
+    assert(sorted(seam.keys()) == [0, 1, 2, 3])
+    for t_index in seam:
+        # one copy of each cluster
+        assert(len(seam[t_index]['clusters']) == 1)
+        assert(seam[t_index]['area'] == 9)
+    assert(seam[2]['clusters'][0].box[0][1] == 20)
+    assert(sorted(tracks[1].keys()) == [0, 1])
+    assert(sorted(tracks[2].keys()) == [2])
+    print 'testStitchTracks OK'
+
+def testStitcher():
+    import tempfile
+    tiles = splitDomain(40, 2, 6)
+    box = lambda i0, j0: set((i, j) for i in range(i0, i0 + 3) for j in range(j0, j0 + 3))
+    seam_west = createTestTrack({1: [box(5, 16)], 2: [box(5, 20)]})
+    seam_east = createTestTrack({2: [box(5, 20)], 3: [box(5, 24)], 4: [box(5, 26)], \
+                                 5: [box(5, 28)]})
+    far_west = createTestTrack({0: [box(30, 2)], 1: [box(30, 3)]})
+    far_east = createTestTrack({6: [box(20, 35)]})
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # 2 segments of 4 time steps, harvest every 2 time steps, no track is filtered out
+        stitcher = Stitcher(tiles, 4, 2, os.path.join(tmpdir, 'test'), (0, 40), (0, 40), \
+                            np.ones((40, 40)), 0., 10**6, 100, 100, (0, 40))
+
+        # the seam track is harvested by the western band and still alive in the eastern band
+        live_east = createTestTrack({2: [box(5, 20)], 3: [box(5, 24)]})
+        stitcher.addSegment([[seam_west, far_west], []], [[], [live_east]], 0, 4, 0)
+        assert(stitcher.getNumberOfPendingTracks() == 1)
+        tracks, filenames = loadTracks(tmpdir, 'test', 0)
+        assert(len(tracks) == 1 and sorted(tracks[0].keys()) == [0, 1])
+
+        # go on after a restart
+        state = cPickle.loads(cPickle.dumps(stitcher.getState(), cPickle.HIGHEST_PROTOCOL))
+        stitcher = Stitcher(tiles, 4, 2, os.path.join(tmpdir, 'test'), (0, 40), (0, 40), \
+                            np.ones((40, 40)), 0., 10**6, 100, 100, (0, 40))
+        stitcher.setState(state)
+        stitcher.addSegment([[], [seam_east, far_east]], [[], []], 4, 8, 1, last=True)
+        assert(stitcher.getNumberOfPendingTracks() == 0)
+
+        # same tracks as when all the tracks of the bands are stitched at once
+        tracks, filenames = loadTracks(tmpdir, 'test', 0)
+        expected = stitchTracks([[seam_west, far_west], [seam_east, far_east]], tiles)
+        assert(len(tracks) == len(expected) == 3)
+        assert(sorted(tracks[0].keys()) == [0, 1])
+        for track in expected[::2]:
+            assert(any(sorted(track.keys()) == sorted(res.keys()) and \
+                       all(track[t_index]['area'] == res[t_index]['area'] for t_index in track) \
+                       for res in tracks))
+        assert(sorted(tracks[1].keys()) == [1, 2, 3, 4, 5])
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testStitcher OK'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tracking of a domain split into bands of \
+                                     longitudes tracked in parallel.')
+    parser.add_argument('-t', action='store_true', help='Run the tests')
+    parser.add_argument('-d1', dest='date1', default='2010-02-19', help='Start date YYYY-MM-DD')
+    parser.add_argument('-d2', dest='date2', default='2010-02-21', help='End date YYYY-MM-DD')
+    parser.add_argument('-lons', dest='lons', default='0:4948', help='Min and max longitude \
+                           indices LONMIN,LONMAX')
+    parser.add_argument('-lats', dest='lats', default='0:827', help='Min and max latitude \
+                           indices LATMIN,LATMAX')
+    parser.add_argument('-suffix', dest='suffix', default='', help='Suffix for output')
+    parser.add_argument('-harvest', dest='harvestPeriod', type=int, default=48,
+                         help='Number of time steps before dead tracks area saved to disk (0 \
+                                for no harvest)')
+    parser.add_argument('-tiles', type=int, default=4, help='Number of bands of longitudes')
+    parser.add_argument('-halo', type=int, default=None, help='Number of longitudes added on \
+                           each side of the bands (default twice lzone)')
+    parser.add_argument('-processes', type=int, default=None, help='Number of bands tracked \
+                           at the same time (default number of cpus)')
+    parser.add_argument('-prefetch', type=int, default=0, help="Number of days read in advance \
+                           in a background thread by each band")
+    parser.add_argument('-keep_tiles', action='store_true', help='Keep the pickles of the bands')
+    parser.add_argument('-segment_days', type=int, default=1, help='Number of days tracked by \
+                           the bands between two stitchings, the tracks of the bands that can \
+                           still be joined to live tracks are kept in memory until then')
+    parser.add_argument('-restart_dir', default=None, help='Directory for storing and loading \
+                           the restart files of the bands and of the stitching')
+    args = parser.parse_args()
+
+    if args.t:
+        testSplitDomain()
+        testStitchTracks()
+        testStitcher()
+        sys.exit(0)
+
+    try:
+        minmax_lons = np.array(args.lons.split(':')).astype(np.int)
+    except:
+        raise RuntimeError, 'Wrong specification of longitude bound indices, use -lons LONMIN:LONMAX'
+    try:
+        minmax_lats = np.array(args.lats.split(':')).astype(np.int)
+    except:
+        raise RuntimeError, 'Wrong specification of latitude bound indices, use -lats LATMIN:LATMAX'
+    fyear = datetime.strptime(args.date1,'%Y-%m-%d')
+    lyear = datetime.strptime(args.date2,'%Y-%m-%d')
+    partitionedTracking(fyear, lyear, minmax_lons, minmax_lats, args.suffix, args.harvestPeriod, \
+                         args.tiles, args.halo, args.processes, args.prefetch, args.keep_tiles, \
+                         args.segment_days, args.restart_dir)
@@ -0,0 +1,142 @@
+'''
+Created in October 2026
+
+@description: A Class that keeps the harvest files read by the post-processing in memory, up
+              to a given size. The files used the least recently are dropped first and read
+              again from disk if they are needed later. Counters of hits, misses and evictions
+              help choosing the size
+'''
+
+from collections import OrderedDict
+from track_store import TrackStore
+
+
+class PickleCache:
+
+    def __init__(self, max_bytes=None, loader=TrackStore):
+        """
+        Constructor
+        @param max_bytes: maximum size of the files kept in memory, None for no limit
+        @param loader: function reading a file, the object returned must have a getSize method
+        """
+        self.max_bytes = max_bytes
+        self.loader = loader
+
+        # objects read, with file name as key, the most recently used last
+        self.items = OrderedDict()
+
+        # size of each object, with file name as key
+        self.sizes = {}
+
+        # total size of the objects kept
+        self.num_bytes = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __contains__(self, filename):
+        return filename in self.items
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def get(self, filename):
+        """
+        @param filename: name of the file
+        @return the object of the file, read if it is not in memory
+        """
+        if filename in self.items:
+            self.hits += 1
+            value = self.items.pop(filename)
+            self.items[filename] = value
+            return value
+        self.misses += 1
+        value = self.loader(filename)
+        self.items[filename] = value
+        self.sizes[filename] = value.getSize()
+        self.num_bytes += self.sizes[filename]
+        self.evict()
+        return value
+
+
+    def evict(self):
+        """
+        Drop the least recently used objects until the size is below the limit, the last
+        object used is always kept
+        """
+        if self.max_bytes is None:
+            return
+        while self.num_bytes > self.max_bytes and len(self.items) > 1:
+            filename, value = self.items.popitem(last=False)
+            self.num_bytes -= self.sizes.pop(filename)
+            self.evictions += 1
+
+
+    def discard(self, filename):
+        """
+        Forget a file, for instance once it is deleted
+        @param filename: name of the file
+        """
+        if filename in self.items:
+            del self.items[filename]
+            self.num_bytes -= self.sizes.pop(filename)
+
+
+    def getStats(self):
+        """
+        @return dictionary with the counters, the number of files and the size in memory
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, \
+                'files': len(self.items), 'bytes': self.num_bytes}
+
+
+#############################################################################################
+
+def testPickleCache():
+    class Item:
+        def __init__(self, filename):
+            self.filename = filename
+        def getSize(self):
+            return 100
+
+    cache = PickleCache(max_bytes=250, loader=Item)
+    assert(cache.get('a').filename == 'a')
+    cache.get('b')
+    cache.get('a')
+    assert(cache.getStats()['hits'] == 1)
+
+    # 'b' is the least recently used
+    cache.get('c')
+    assert('b' not in cache and 'a' in cache and 'c' in cache)
+    assert(cache.evictions == 1 and cache.num_bytes == 200)
+
+    # read again on a miss
+    assert(cache.get('b').filename == 'b')
+    assert(cache.misses == 4 and 'a' not in cache)
+
+    cache.discard('b')
+    cache.discard('x')
+    assert(len(cache) == 1 and cache.num_bytes == 100)
+
+    # an object bigger than the limit is kept until the next one
+    cache = PickleCache(max_bytes=50, loader=Item)
+    cache.get('a')
+    assert('a' in cache)
+    cache.get('b')
+    assert(len(cache) == 1 and 'b' in cache)
+
+    # no limit
+    cache = PickleCache(loader=Item)
+    for name in 'abcdef':
+        cache.get(name)
+    assert(len(cache) == 6 and cache.evictions == 0)
+    print 'testPickleCache OK'
+
+
+if __name__ == '__main__':
+    testPickleCache()
@@ -0,0 +1,194 @@
+'''
+Created in October 2026
+
+@description: Sparse storage of the precipitation of a day, written by the tracking so that
+              the post-processing does not read the compressed input again. Only the cells of
+              the clusters found at each time step are kept, with their precipitation, and the
+              cells where the input has no data. Cells are stored as runs of consecutive
+              longitudes, as in the harvest files
+'''
+
+import os
+import numpy as np
+from track_store import encodeRuns, decodeRuns
+
+# increase when the content of the files changes
+VERSION = 1
+
+
+def getPrecipFilename(targetdir, suffix, date_str):
+    """
+    @param targetdir: directory of the harvest files
+    @param suffix: suffix of the region
+    @param date_str: day as YYYY_MM_DD
+    @return name of the file of the day
+    """
+    return os.path.join(str(targetdir), 'precip_' + str(suffix), date_str + '.npz')
+
+
+def toRuns(t_indices, iis, jjs, shape):
+    """
+    Sort cells, remove duplicates and encode them as runs
+    @param t_indices: time indices
+    @param iis: i indices
+    @param jjs: j indices
+    @param shape: (time, lat, lon) of the day
+    @return sorted flat indices of the cells, time, i, first j and length of each run
+    """
+    flat = np.unique(np.ravel_multi_index((t_indices, iis, jjs), shape))
+    t, i, j = np.unravel_index(flat, shape)
+    run_t, run_i, run_j, run_len = encodeRuns(t.astype(np.int32), i.astype(np.int32), \
+                                              j.astype(np.int32))
+    return flat, run_t, run_i, run_j, run_len
+
+
+class PrecipDay:
+    """
+    Collect the cells of the clusters of each time step of a day and write them with their
+    precipitation
+    """
+
+    def __init__(self, all_data, time, time_units):
+        """
+        Constructor
+        @param all_data: precipitation of the day (time, lat, lon), masked where there is no data
+        @param time: time of the time steps
+        @param time_units: units of time
+        """
+        self.all_data = all_data
+        self.time = np.asarray(time)
+        self.time_units = time_units
+        self.cells = []
+
+
+    def addClusters(self, t_index, clusters):
+        """
+        @param t_index: time step in the day
+        @param clusters: clusters of the time step
+        """
+        for cl in clusters:
+            if cl.getNumberOfCells() > 0:
+                self.cells.append((np.full(cl.getNumberOfCells(), t_index, np.int32), \
+                                   cl.iis, cl.jjs))
+
+
+    def write(self, filename):
+        """
+        Write the file of the day, under a temporary name first
+        @param filename: name of the file
+        """
+        shape = self.all_data.shape
+        empty = np.array([], np.int32)
+        cells = zip(*self.cells) if self.cells else ([empty], [empty], [empty])
+        flat, run_t, run_i, run_j, run_len = toRuns(np.concatenate(cells[0]), \
+                                                    np.concatenate(cells[1]), \
+                                                    np.concatenate(cells[2]), shape)
+        values = np.ma.filled(self.all_data, 0).reshape(-1)[flat].astype(np.float32)
+        missing = np.nonzero(np.ma.getmaskarray(self.all_data))
+        flat, miss_t, miss_i, miss_j, miss_len = toRuns(missing[0], missing[1], missing[2], \
+                                                        shape)
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez_compressed(f, version=np.array(VERSION), shape=np.array(shape), \
+                                time=self.time, time_units=np.array(self.time_units), \
+                                run_t=run_t, run_i=run_i, run_j=run_j, run_len=run_len, \
+                                values=values, missing_t=miss_t, missing_i=miss_i, \
+                                missing_j=miss_j, missing_len=miss_len)
+        os.rename(tmp_filename, filename)
+
+
+class PrecipStore:
+    """
+    Read access to the precipitation of a day written by PrecipDay
+    """
+
+    def __init__(self, filename):
+        """
+        Constructor
+        @param filename: name of the file
+        """
+        with np.load(filename) as data:
+            arrays = dict((key, data[key]) for key in data.files)
+        if int(arrays['version']) != VERSION:
+            raise RuntimeError('Precipitation file %s has version %d, expected %d' % \
+                               (filename, int(arrays['version']), VERSION))
+        self.shape = tuple(arrays['shape'])
+        self.time = arrays['time']
+        self.time_units = str(arrays['time_units'])
+        self.run_t, self.run_len = arrays['run_t'], arrays['run_len']
+        self.run_i, self.run_j = arrays['run_i'], arrays['run_j']
+        self.values = arrays['values']
+        self.missing = [arrays[key] for key in ('missing_t', 'missing_i', 'missing_j', \
+                                                'missing_len')]
+
+
+    def getCells(self):
+        """
+        @return time, i and j indices of the cells of the clusters, and their precipitation
+        """
+        iis, jjs = decodeRuns(self.run_i, self.run_j, self.run_len)
+        return np.repeat(self.run_t, self.run_len), iis, jjs, self.values
+
+
+    def getMissing(self):
+        """
+        @return time, i and j indices of the cells without data
+        """
+        run_t, run_i, run_j, run_len = self.missing
+        iis, jjs = decodeRuns(run_i, run_j, run_len)
+        return np.repeat(run_t, run_len), iis, jjs
+
+
+    def toArray(self):
+        """
+        @return precipitation of the day (time, lat, lon), 0 outside the clusters and masked
+                where there is no data
+        """
+        data = np.zeros(self.shape, np.float32)
+        t, iis, jjs, values = self.getCells()
+        data[t, iis, jjs] = values
+        mask = np.zeros(self.shape, bool)
+        t, iis, jjs = self.getMissing()
+        mask[t, iis, jjs] = True
+        return np.ma.masked_array(data, mask)
+
+
+#############################################################################################
+
+def testPrecipStore():
+    import shutil
+    import tempfile
+    from cluster import Cluster
+    np.random.seed(3)
+    all_data = np.ma.masked_array(np.random.random((4, 20, 30)).astype(np.float32))
+    all_data[2, 5:8, 10:20] = np.ma.masked
+    tmpdir = tempfile.mkdtemp()
+    try:
+        day = PrecipDay(all_data, np.arange(4) * 0.5, 'hours since 2010-02-19 00:00')
+        clusters = [Cluster((np.array([1, 1, 1, 2], np.int32), np.array([3, 4, 5, 4], np.int32))), \
+                    Cluster((np.array([6, 7], np.int32), np.array([12, 12], np.int32)))]
+        for t in range(4):
+            day.addClusters(t, clusters if t != 1 else [])
+        filename = getPrecipFilename(tmpdir, 'test', '2010_02_19')
+        day.write(filename)
+        assert(os.listdir(os.path.dirname(filename)) == ['2010_02_19.npz'])
+
+        store = PrecipStore(filename)
+        assert(store.shape == (4, 20, 30) and store.time_units == 'hours since 2010-02-19 00:00')
+        data = store.toArray()
+        mask = np.zeros(all_data.shape, bool)
+        for t in 0, 2, 3:
+            mask[t, 1, 3:6] = mask[t, 2, 4] = mask[t, 6:8, 12] = True
+        expected = all_data * mask
+        assert(np.array_equal(data.filled(-1), expected.filled(-1)))
+        assert(data.mask[2, 5:8, 10:20].all() and data.mask.sum() == 30)
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testPrecipStore OK'
+
+
+if __name__ == '__main__':
+    testPrecipStore()
@@ -8,6 +8,7 @@ from Cython.Build import cythonize
 extensions = [
     Extension("ellipse", ["ellipse.pyx"]),
     Extension("time_connected_clusters", ["time_connected_clusters.pyx"]),
+    Extension("marker_watershed", ["marker_watershed.pyx"]),
 ]
 
 setup(
@@ -9,6 +9,8 @@ Created in June 2018
 
 from cluster import Cluster
 from ellipse import Ellipse
+from track_store import writeTracks
+from harvest_manifest import HarvestManifest
 import numpy as np
 import netCDF4
 import copy
@@ -17,7 +19,6 @@ import cPickle
 import functools
 import tempfile
 import os
-import gzip
 import sys
 
 
@@ -51,6 +52,77 @@ cdef bint _isPointInsideEllipse(double a, double b,
     return (ptXPrime*ptXPrime + ptYPrime*ptYPrime < 1.0)
 
 
+def getReachBox(centre, a, b):
+    """
+    Get a box containing an ellipse whatever its orientation, a point can only be inside the
+    ellipse if it is inside the box
+    @param centre: centre of the ellipse
+    @param a: first axis
+    @param b: second axis
+    @return i_min, j_min, i_max, j_max
+    """
+    # slightly larger than the largest axis to stay on the safe side of round-off errors
+    r = max(a, b) * (1. + 1.e-9) + 1.e-9
+    return (centre[0] - r, centre[1] - r, centre[0] + r, centre[1] + r)
+
+
+class BoxIndex:
+    """
+    Uniform grid hash of boxes, to find the boxes that may overlap a given box without
+    comparing it with every box
+    """
+
+    def __init__(self, boxes):
+        """
+        Constructor
+        @param boxes: list of (i_min, j_min, i_max, j_max)
+        """
+        self.boxes = boxes
+
+        # dictionary with (i, j) grid cell as key, list of the box indices as value
+        self.grid = {}
+
+        # size of the grid cells, about the size of the boxes
+        self.cell_size = 1.
+        if boxes:
+            self.cell_size = max(1., float(np.median([max(b[2] - b[0], b[3] - b[1]) \
+                                                      for b in boxes])))
+        for n in range(len(boxes)):
+            for key in self.getGridCells(boxes[n]):
+                if key in self.grid:
+                    self.grid[key].append(n)
+                else:
+                    self.grid[key] = [n]
+
+
+    def getGridCells(self, box):
+        """
+        @param box: i_min, j_min, i_max, j_max
+        @return list of the grid cells covered by the box
+        """
+        cs = self.cell_size
+        i0, j0 = int(math.floor(box[0] / cs)), int(math.floor(box[1] / cs))
+        i1, j1 = int(math.floor(box[2] / cs)), int(math.floor(box[3] / cs))
+        return [(gi, gj) for gi in xrange(i0, i1 + 1) for gj in xrange(j0, j1 + 1)]
+
+
+    def query(self, box):
+        """
+        @param box: i_min, j_min, i_max, j_max
+        @return sorted indices of the boxes overlapping box
+        """
+        found = set()
+        for key in self.getGridCells(box):
+            found.update(self.grid.get(key, ()))
+        res = []
+        for n in found:
+            b = self.boxes[n]
+            if b[0] <= box[2] and box[0] <= b[2] and b[1] <= box[3] and box[1] <= b[3]:
+                res.append(n)
+        res.sort()
+        return res
+
+
 def __reduceOne(cluster_list, frac):
     """
     Reduce the list of clusters by merging overlapping clusters
@@ -59,6 +131,10 @@ def __reduceOne(cluster_list, frac):
     @return True if the list was reduced
     """
     n = len(cluster_list)
+
+    # the centres can only be inside both ellipses if their boxes overlap
+    index = BoxIndex([getReachBox(cl.ellipse.centre, cl.ellipse.a, cl.ellipse.b) \
+                      for cl in cluster_list])
     for i in range(n):
         cli = cluster_list[i]
         eli = cli.ellipse
@@ -66,7 +142,9 @@ def __reduceOne(cluster_list, frac):
         eli_centre = eli.centre
         eli_a = eli.a
         eli_b = eli.b
-        for j in range(i + 1, n):
+        for j in index.query(index.boxes[i]):
+            if j <= i:
+                continue
             clj = cluster_list[j]
             elj = clj.ellipse
             elj_transf = elj.ij2AxesTransf
@@ -172,6 +250,21 @@ class TimeConnectedClusters:
         # set of track Ids to which the new clusters will be assigned to
         new_track_ids = set()
 
+        # clusters of the tracks at t_index - 1, in track order. The new clusters created below
+        # start new tracks or are added at t_index, this list does not change
+        old_track_ids = []
+        old_clusters = []
+        for track_id in range(self.getNumberOfTracks()):
+            if self.t_index-1 in self.cluster_connect[track_id]:
+                for old_cl in self.cluster_connect[track_id][self.t_index - 1].get('clusters'):
+                    old_track_ids.append(track_id)
+                    old_clusters.append(old_cl)
+
+        # a new and an old cluster can only be connected if the box of one of the extended
+        # ellipses contains the centre of the other, so if the boxes overlap
+        index = BoxIndex([getReachBox(cl.ellipse.centre, cl.ellipse.aExt, cl.ellipse.bExt) \
+                          for cl in old_clusters])
+
         for new_cl_index in range(len(new_clusters)):
             new_cl = new_clusters[new_cl_index]
             new_el = new_cl.ellipse
@@ -183,40 +276,35 @@ class TimeConnectedClusters:
             # the track Id that we need to assign this cluster to
             new_track_id = -1
 
-            # find out if this cluster belongs to an existing track
-            num_tracks = self.getNumberOfTracks()
+            # find out if this cluster belongs to an existing track, the candidates are
+            # in the same order as the tracks
             connected_clusters = []
             connected_track_ids = []
-            for track_id in range(num_tracks):
-
-                # check if track exists at t_index - 1
-                if self.t_index-1 in self.cluster_connect[track_id]:
-                    old_clusters = self.cluster_connect[track_id][self.t_index - 1].get('clusters')
-                else :
-                    old_clusters = []
+            for n in index.query(getReachBox(new_centre, new_aExt, new_bExt)):
+                old_cl = old_clusters[n]
+                track_id = old_track_ids[n]
 
                 # apply tracking between new cluster and every cluster of the existing track
-                for old_cl in old_clusters:
-                    old_el = old_cl.ellipse
-                    old_transf = old_el.ij2AxesTransf[0, :]
-                    old_centre = old_el.centre
-
-                    # is the centre of new_cl inside the ellipse of old_cl?
-                    isNewClInsideOldCl = _isPointInsideEllipse(old_el.aExt, old_el.bExt, 
-                    	                                       old_transf[0], old_transf[1],
-                                                               old_centre[0], old_centre[1],
-                                                               new_centre[0], new_centre[1])
-
-                    # is the centre of old_cl inside the ellipse of new_cl?
-                    isOldClInsideNewCl = _isPointInsideEllipse(new_aExt, new_bExt, 
-                    	                                       new_transf[0], new_transf[1],
-                                                               new_centre[0], new_centre[1],
-                                                               old_centre[0], old_centre[1])
-
-                    # list track and old cluster to which the new cluster is connected
-                    if isNewClInsideOldCl or isOldClInsideNewCl:
-                        connected_clusters.append(old_cl)
-                        connected_track_ids.append(track_id)
+                old_el = old_cl.ellipse
+                old_transf = old_el.ij2AxesTransf[0, :]
+                old_centre = old_el.centre
+
+                # is the centre of new_cl inside the ellipse of old_cl?
+                isNewClInsideOldCl = _isPointInsideEllipse(old_el.aExt, old_el.bExt, 
+                	                                       old_transf[0], old_transf[1],
+                                                           old_centre[0], old_centre[1],
+                                                           new_centre[0], new_centre[1])
+
+                # is the centre of old_cl inside the ellipse of new_cl?
+                isOldClInsideNewCl = _isPointInsideEllipse(new_aExt, new_bExt, 
+                	                                       new_transf[0], new_transf[1],
+                                                           new_centre[0], new_centre[1],
+                                                           old_centre[0], old_centre[1])
+
+                # list track and old cluster to which the new cluster is connected
+                if isNewClInsideOldCl or isOldClInsideNewCl:
+                    connected_clusters.append(old_cl)
+                    connected_track_ids.append(track_id)
 
             # calculate surface covered by cluster
             area = new_cl.getNumberOfCells()
@@ -262,8 +350,9 @@ class TimeConnectedClusters:
         clusters = self.cluster_connect[track_id][t_index].get('clusters', [])
         if not clusters:
             return None
-        all_cells = functools.reduce(lambda x, y: x.union(y), [cl.cells for cl in clusters])
-        return Cluster(all_cells)
+        iis = np.concatenate([cl.iis for cl in clusters])
+        jjs = np.concatenate([cl.jjs for cl in clusters])
+        return Cluster((iis, jjs))
 
 
     def _backwardTracking(self, new_track_ids):
@@ -282,6 +371,11 @@ class TimeConnectedClusters:
             if self.t_index-1 in self.cluster_connect[track_id]:
                   old_big_clusters[track_id] = self.getBigClusterAt(track_id, self.t_index - 1)
 
+        # index of the centres of the old big clusters
+        old_track_ids = sorted(old_big_clusters)
+        old_centres = [old_big_clusters[track_id].ellipse.centre for track_id in old_track_ids]
+        index = BoxIndex([(c[0], c[1], c[0], c[1]) for c in old_centres])
+
         # find the tracks to fuse
         new_track_ids_to_fuse = []
 
@@ -296,14 +390,15 @@ class TimeConnectedClusters:
             big_aExt = big_ellipse.aExt
             big_bExt = big_ellipse.bExt
 
+            # only the centres inside the box of the ellipse can be inside the ellipse
             track_ids_to_fuse = set()
-            for track_id in old_big_clusters:
+            for n in index.query(getReachBox(big_centre, big_aExt, big_bExt)):
+                track_id = old_track_ids[n]
                 if track_id == new_track_id:
                     continue
 
                 # get the big cluster in track_id at the previous time
-                old_big_cluster = old_big_clusters[track_id]
-                obc_centre = old_big_cluster.ellipse.centre
+                obc_centre = old_centres[n]
 
                 # is the old big cluster inside the big clusters ellipse?
                 isOBCInsideBC = _isPointInsideEllipse(big_aExt, big_bExt, big_transf[0,0], big_transf[0,1],
@@ -437,11 +532,9 @@ class TimeConnectedClusters:
         @param t_index: time index
         @return the i and j cells as separate arrays
         """
-        ijs = []
-        for cl in self.getClusters(track_id, t_index):
-            ijs += list(cl.cells)
-        iis = np.array([ij[0] for ij in ijs])
-        jjs = np.array([ij[1] for ij in ijs])
+        clusters = self.getClusters(track_id, t_index)
+        iis = np.concatenate([cl.iis for cl in clusters] + [np.array([], np.int32)])
+        jjs = np.concatenate([cl.jjs for cl in clusters] + [np.array([], np.int32)])
         return iis, jjs
 
 
@@ -487,8 +580,7 @@ class TimeConnectedClusters:
         touch_lim = False
         for t_index in self.cluster_connect[track_id]:
             for cl in self.cluster_connect[track_id][t_index].get('clusters'):
-                i_index, j_index, mat = cl.toArray()
-                if i_index[0] == ind_lim[0]-ind_lim[0] or i_index[-1] == ind_lim[1]-ind_lim[0]-1 :
+                if cl.box[0][0] == ind_lim[0]-ind_lim[0] or cl.box[1][0] == ind_lim[1]-ind_lim[0]-1 :
                     touch_lim = True
                     return touch_lim
         return touch_lim
@@ -527,7 +619,8 @@ class TimeConnectedClusters:
 
 
     def harvestTracks(self, prefix, i_minmax, j_minmax, mask, frac, max_cells, \
-                       length_time, length_time_lim, ind_lim, pickle_index, dead_only=False):
+                       length_time, length_time_lim, ind_lim, pickle_index, dead_only=False, \
+                       filter_tracks=True):
         """
         Harvest tracks and remove from list
         @param prefix: prefix to be prepended to the file name
@@ -543,6 +636,8 @@ class TimeConnectedClusters:
         @pickle_index: index used on pickle to identify which ones are written after restart
         @param dead_only: only harvest tracks that are no longer alive, otherwise
                            harvest all the tracks
+        @param filter_tracks: apply the coastal and synoptic checks to the dead tracks, False
+                              to keep all the tracks (they are checked later on)
         """
         t_index_min = self.LARGE_INT
         t_index_max = -self.LARGE_INT
@@ -557,7 +652,7 @@ class TimeConnectedClusters:
 
                 # keep only tracks that are above islands at some time
                 # and that are not synoptic
-                if not dead_only or (self.checkTrackOverMask(mask, frac, track_id) \
+                if not dead_only or not filter_tracks or (self.checkTrackOverMask(mask, frac, track_id) \
                          and self.checkNoSynoptic(max_cells, length_time, length_time_lim, \
                                                    ind_lim, track_id)):
                     good_tracks_to_harvest.append(track_id)
@@ -566,8 +661,18 @@ class TimeConnectedClusters:
         prfx = prefix + '_{}_{}_'.format(t_index_min, t_index_max)
         sufx = '_%d' % pickle_index
         num_times = t_index_max - t_index_min + 1
-        self.saveTracks(good_tracks_to_harvest, num_times, i_minmax, j_minmax,
-                        prfx, suffix=sufx)
+
+        # the manifest lists the files written before it existed, create it first
+        manifest = HarvestManifest(os.path.dirname(prefix), os.path.basename(prefix))
+        if not manifest.exists():
+            manifest.create()
+        filename = self.saveTracks(good_tracks_to_harvest, num_times, i_minmax, j_minmax,
+                                   prfx, suffix=sufx)
+
+        # list the file in the manifest read by the post-processing
+        if filename is not None:
+            manifest.add(filename, t_index_min, t_index_max, len(good_tracks_to_harvest), \
+                         pickle_index)
 
         # remove the harvested tracks
         tracks_to_harvest.sort(reverse=True)
@@ -625,11 +730,7 @@ class TimeConnectedClusters:
             for time_index in range(num_times):
                 clusters = self.getClusters(track_id, time_index)
                 for cl in clusters:
-                    n_cells = cl.getNumberOfCells()
-                    tis = [time_index] * n_cells
-                    jis = [c[1] - jMin for c in cl.cells]
-                    iis = [c[0] - iMin for c in cl.cells]
-                    data[tis, iis, jis] = track_id + 1
+                    data[time_index, cl.iis - iMin, cl.jjs - jMin] = track_id + 1
         return data
 
 
@@ -668,14 +769,15 @@ class TimeConnectedClusters:
         @param j_minmax: min/max lon indices
         @param prefix: prefix of the file
         @param suffix: suffix of the file
+        @return name of the file, None if there is no track to save
         """
         if not track_id_list:
             # nothing to do
-            return
+            return None
         data = [self.cluster_connect[tid] for tid in track_id_list]
         with tempfile.NamedTemporaryFile(prefix=prefix, dir=os.getcwd(), delete=False, suffix=suffix) as f:
-            with gzip.GzipFile(fileobj=f) as gzf:
-                cPickle.dump(data, gzf)
+            writeTracks(f, data)
+        return f.name
 
 
     def getNumberOfTracks(self):
@@ -758,8 +860,37 @@ def testTwoClustersAtTime0():
     print 'Two clusters'
     print tcc
 
+def testBoxIndex():
+    np.random.seed(123)
+    clusters = []
+    for n in range(200):
+        i0, j0 = np.random.randint(0, 300, 2)
+        iis = i0 + np.random.randint(0, 1 + np.random.randint(1, 15), 30)
+        jjs = j0 + np.random.randint(0, 1 + np.random.randint(1, 15), 30)
+        clusters.append(Cluster((iis.astype(np.int32), jjs.astype(np.int32)), min_ellipse_axis=6))
+    boxes = [getReachBox(cl.ellipse.centre, cl.ellipse.aExt, cl.ellipse.bExt) for cl in clusters]
+    index = BoxIndex(boxes)
+    for box in boxes[:50]:
+        expected = [n for n, b in enumerate(boxes) if b[0] <= box[2] and box[0] <= b[2] \
+                    and b[1] <= box[3] and box[1] <= b[3]]
+        assert(index.query(box) == expected)
+
+    # every centre inside an extended ellipse is found by the index
+    for n, cl in enumerate(clusters):
+        el = cl.ellipse
+        candidates = index.query(getReachBox(el.centre, el.aExt, el.bExt))
+        for m, other in enumerate(clusters):
+            c = other.ellipse.centre
+            if _isPointInsideEllipse(el.aExt, el.bExt, el.ij2AxesTransf[0, 0], \
+                                     el.ij2AxesTransf[0, 1], el.centre[0], el.centre[1], \
+                                     c[0], c[1]):
+                assert(m in candidates)
+    assert(BoxIndex([]).query((0, 0, 10, 10)) == [])
+    print 'testBoxIndex OK'
+
 if __name__ == '__main__':
     testNoCluster()
+    testBoxIndex()
     testOneCluster()
     testReduceNonOverlapping()
     testReduceOverlapping()
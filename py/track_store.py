@@ -0,0 +1,415 @@
+'''
+Created in October 2026
+
+@description: Columnar storage of harvested tracks. A harvest file holds flat arrays instead
+              of pickled Cluster instances: one row per track, one row per time step of a
+              track (entry), one row per cluster with its centre, ellipse and box, and the
+              cells of the clusters as runs of consecutive longitudes. The clusters can be
+              read and painted without building Cluster instances. Files written by older
+              versions (gzip pickles of lists of tracks) are read through the same class
+'''
+
+import cPickle
+import gzip
+import numpy as np
+from cluster import Cluster
+
+# increase when the content of the files changes
+VERSION = 1
+
+
+def encodeRuns(cluster_ids, iis, jjs):
+    """
+    Encode cells as runs of consecutive j indices
+    @param cluster_ids: cluster index of each cell, cells are sorted by cluster, i then j
+    @param iis: i indices
+    @param jjs: j indices
+    @return cluster index, i, first j and length of each run
+    """
+    if len(iis) == 0:
+        empty = np.array([], np.int32)
+        return empty, empty, empty, empty
+    new_run = np.ones(len(iis), bool)
+    new_run[1:] = (cluster_ids[1:] != cluster_ids[:-1]) | (iis[1:] != iis[:-1]) | \
+                  (jjs[1:] != jjs[:-1] + 1)
+    starts = np.flatnonzero(new_run)
+    lengths = np.diff(np.append(starts, len(iis)))
+    return cluster_ids[starts], iis[starts], jjs[starts], lengths.astype(np.int32)
+
+
+def decodeRuns(run_i, run_j, run_len):
+    """
+    Decode runs into cells
+    @param run_i: i index of each run
+    @param run_j: first j index of each run
+    @param run_len: length of each run
+    @return i indices, j indices
+    """
+    offsets = np.cumsum(run_len) - run_len
+    iis = np.repeat(run_i, run_len)
+    jjs = np.repeat(run_j - offsets, run_len) + np.arange(run_len.sum(), dtype=np.int32)
+    return iis.astype(np.int32), jjs.astype(np.int32)
+
+
+def tracksToArrays(tracks):
+    """
+    Convert tracks to the columns of a harvest file
+    @param tracks: list of tracks, each track is {t_index: {'area': area, 'clusters': [...]}}
+    @return dictionary of arrays
+    """
+    entry_t, entry_area, entry_num = [], [], []
+    track_num = []
+    clusters = []
+    for track in tracks:
+        t_indices = sorted(track.keys())
+        track_num.append(len(t_indices))
+        for t_index in t_indices:
+            entry_t.append(t_index)
+            entry_area.append(track[t_index]['area'])
+            entry_num.append(len(track[t_index]['clusters']))
+            clusters += track[t_index]['clusters']
+
+    num = len(clusters)
+    ncells = np.array([cl.getNumberOfCells() for cl in clusters], np.int64)
+    cell_cluster = np.repeat(np.arange(num, dtype=np.int32), ncells)
+    iis = np.concatenate([cl.iis for cl in clusters] + [np.array([], np.int32)])
+    jjs = np.concatenate([cl.jjs for cl in clusters] + [np.array([], np.int32)])
+    run_cluster, run_i, run_j, run_len = encodeRuns(cell_cluster, iis, jjs)
+
+    def offsets(counts, dtype=np.int64):
+        res = np.zeros(len(counts) + 1, dtype)
+        res[1:] = np.cumsum(counts)
+        return res
+
+    centre = np.zeros((num, 2))
+    axes = np.zeros((num, 4))
+    angle = np.zeros(num)
+    box = np.zeros((num, 4), np.int32)
+    min_axis = np.zeros(num)
+    for n, cl in enumerate(clusters):
+        if cl.getNumberOfCells() == 0:
+            continue
+        el = cl.ellipse
+        centre[n] = el.centre
+        axes[n] = el.a, el.b, el.aExt, el.bExt
+        angle[n] = el.angle
+        box[n] = cl.box[0][0], cl.box[0][1], cl.box[1][0], cl.box[1][1]
+        min_axis[n] = cl.min_ellipse_axis
+
+    return {'version': np.array(VERSION),
+            'track_entry_offset': offsets(track_num),
+            'entry_t': np.array(entry_t, np.int32),
+            'entry_area': np.array(entry_area, np.int64),
+            'entry_cluster_offset': offsets(entry_num),
+            'cluster_ncells': ncells.astype(np.int32),
+            'cluster_run_offset': offsets(np.bincount(run_cluster, minlength=num)),
+            'cluster_centre': centre,
+            'cluster_axes': axes,
+            'cluster_angle': angle,
+            'cluster_box': box,
+            'cluster_min_axis': min_axis,
+            'run_i': run_i.astype(np.int32),
+            'run_j': run_j.astype(np.int32),
+            'run_len': run_len}
+
+
+def writeTracks(f, tracks):
+    """
+    Write tracks to a harvest file
+    @param f: file name or open file
+    @param tracks: list of tracks, each track is {t_index: {'area': area, 'clusters': [...]}}
+    """
+    np.savez_compressed(f, **tracksToArrays(tracks))
+
+
+class TrackStore:
+    """
+    Read access to the tracks of a harvest file
+    """
+
+    def __init__(self, filename=None, arrays=None):
+        """
+        Constructor
+        @param filename: harvest file, columnar or gzip pickle
+        @param arrays: columns as returned by tracksToArrays, instead of a file
+        """
+        if arrays is None:
+            with open(filename, 'rb') as f:
+                magic = f.read(2)
+            if magic == '\x1f\x8b':
+                # list of tracks pickled by older versions
+                with gzip.GzipFile(filename) as gzf:
+                    arrays = tracksToArrays(cPickle.load(gzf))
+            else:
+                with np.load(filename) as data:
+                    arrays = dict((key, data[key]) for key in data.files)
+                if int(arrays['version']) != VERSION:
+                    raise RuntimeError('Harvest file %s has version %d, expected %d' % \
+                                       (filename, int(arrays['version']), VERSION))
+        for key, value in arrays.items():
+            setattr(self, key, value)
+
+
+    def __len__(self):
+        return len(self.track_entry_offset) - 1
+
+
+    def getNumberOfTracks(self):
+        """
+        @return number of tracks
+        """
+        return len(self)
+
+
+    def getSize(self):
+        """
+        @return approximate size in memory in bytes, including the index built by getRuns
+        """
+        size = sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+        if not hasattr(self, 'run_entry'):
+            size += 4*(len(self.run_len) + len(self.entry_t))
+        return size
+
+
+    def getTimes(self, track_id):
+        """
+        @param track_id: track index in the file
+        @return sorted time indices of the track
+        """
+        return self.entry_t[self.track_entry_offset[track_id]:self.track_entry_offset[track_id + 1]]
+
+
+    def getStartEndTimes(self, track_id):
+        """
+        @param track_id: track index in the file
+        @return t_beg, t_end
+        """
+        t_indices = self.getTimes(track_id)
+        return int(t_indices[0]), int(t_indices[-1])
+
+
+    def getEntry(self, track_id, t_index):
+        """
+        @param track_id: track index in the file
+        @param t_index: time index
+        @return entry index, -1 if the track is not present at t_index
+        """
+        e0, e1 = self.track_entry_offset[track_id], self.track_entry_offset[track_id + 1]
+        e = e0 + np.searchsorted(self.entry_t[e0:e1], t_index)
+        if e < e1 and self.entry_t[e] == t_index:
+            return e
+        return -1
+
+
+    def getClusterIndices(self, track_id, t_index):
+        """
+        @param track_id: track index in the file
+        @param t_index: time index
+        @return indices of the clusters of the track at t_index
+        """
+        e = self.getEntry(track_id, t_index)
+        if e < 0:
+            return xrange(0)
+        return xrange(self.entry_cluster_offset[e], self.entry_cluster_offset[e + 1])
+
+
+    def getCells(self, cluster_index):
+        """
+        @param cluster_index: cluster index in the file
+        @return i and j indices of the cells
+        """
+        r0, r1 = self.cluster_run_offset[cluster_index], self.cluster_run_offset[cluster_index + 1]
+        return decodeRuns(self.run_i[r0:r1], self.run_j[r0:r1], self.run_len[r0:r1])
+
+
+    def buildIndex(self):
+        """
+        Compute the entry of each run and the track of each entry, once for all the days
+        read from this file
+        """
+        if hasattr(self, 'run_entry'):
+            return
+        cluster_entry = np.repeat(np.arange(len(self.entry_t), dtype=np.int32), \
+                                  np.diff(self.entry_cluster_offset))
+        run_cluster = np.repeat(np.arange(len(self.cluster_ncells), dtype=np.int32), \
+                                np.diff(self.cluster_run_offset))
+        self.run_entry = cluster_entry[run_cluster]
+        self.entry_track = np.repeat(np.arange(len(self), dtype=np.int32), \
+                                     np.diff(self.track_entry_offset))
+
+
+    def getActiveTracks(self, t_begin, t_end):
+        """
+        @param t_begin: first time index
+        @param t_end: time index after the last one
+        @return boolean array, True for the tracks with cells between the two time indices
+        """
+        self.buildIndex()
+        entry_runs = np.diff(self.cluster_run_offset[self.entry_cluster_offset])
+        sel = (self.entry_t >= t_begin) & (self.entry_t < t_end) & (entry_runs > 0)
+        return np.bincount(self.entry_track[sel], minlength=len(self)) > 0
+
+
+    def getRuns(self, t_begin, t_end):
+        """
+        Find the runs of cells of all the clusters present between two time indices
+        @param t_begin: first time index
+        @param t_end: time index after the last one
+        @return track index, time index, i, first j and length of each run, ordered by
+                track, time index and cluster
+        """
+        self.buildIndex()
+        run_t = self.entry_t[self.run_entry]
+        sel = np.flatnonzero((run_t >= t_begin) & (run_t < t_end))
+        return self.entry_track[self.run_entry[sel]], run_t[sel], self.run_i[sel], \
+               self.run_j[sel], self.run_len[sel]
+
+
+    def toArray(self, cluster_index):
+        """
+        Convert a cluster to a dense array over its box, as Cluster.toArray
+        @param cluster_index: cluster index in the file
+        @return array of i coordinates, array of j coordinates, array of zeros and ones
+        """
+        if self.cluster_ncells[cluster_index] <= 0:
+            return np.array([]), np.array([]), np.array([])
+        i_min, j_min, i_max, j_max = self.cluster_box[cluster_index]
+        iis, jjs = self.getCells(cluster_index)
+        values = np.zeros((i_max - i_min + 1, j_max - j_min + 1), np.int32)
+        values[iis - i_min, jjs - j_min] = 1
+        return np.arange(i_min, i_max + 1), np.arange(j_min, j_max + 1), values
+
+
+    def getCluster(self, cluster_index, i_offset=0, j_offset=0):
+        """
+        @param cluster_index: cluster index in the file
+        @param i_offset: added to the i indices
+        @param j_offset: added to the j indices
+        @return Cluster instance
+        """
+        iis, jjs = self.getCells(cluster_index)
+        return Cluster((iis + i_offset, jjs + j_offset), \
+                       min_ellipse_axis=self.cluster_min_axis[cluster_index])
+
+
+    def getTracks(self, i_offset=0, j_offset=0):
+        """
+        Build the tracks as written by the tracking, with Cluster instances
+        @param i_offset: added to the i indices of the cells
+        @param j_offset: added to the j indices of the cells
+        @return list of tracks, each track is {t_index: {'area': area, 'clusters': [...]}}
+        """
+        tracks = []
+        for track_id in range(len(self)):
+            track = {}
+            for e in xrange(self.track_entry_offset[track_id], self.track_entry_offset[track_id + 1]):
+                clusters = [self.getCluster(c, i_offset, j_offset) for c in \
+                            xrange(self.entry_cluster_offset[e], self.entry_cluster_offset[e + 1])]
+                track[int(self.entry_t[e])] = {'area': int(self.entry_area[e]), 'clusters': clusters}
+            tracks.append(track)
+        return tracks
+
+
+#############################################################################################
+
+def createTestTracks():
+    np.random.seed(7)
+    tracks = []
+    for n in range(20):
+        track = {}
+        t0 = np.random.randint(0, 50)
+        for t_index in range(t0, t0 + np.random.randint(1, 10)):
+            clusters = []
+            for k in range(np.random.randint(1, 4)):
+                i0, j0 = np.random.randint(0, 100, 2)
+                size = np.random.randint(1, 60)
+                iis = (i0 + np.random.randn(size) * 3).astype(np.int32)
+                jjs = (j0 + np.random.randn(size) * 5).astype(np.int32)
+                clusters.append(Cluster((iis, jjs), min_ellipse_axis=6))
+            track[t_index] = {'area': sum(cl.getNumberOfCells() for cl in clusters), \
+                              'clusters': clusters}
+        tracks.append(track)
+    return tracks
+
+def testRuns():
+    iis = np.array([0, 0, 0, 1, 1, 0, 0], np.int32)
+    jjs = np.array([3, 4, 6, 4, 5, 4, 5], np.int32)
+    cluster_ids = np.array([0, 0, 0, 0, 0, 1, 1], np.int32)
+    run_cluster, run_i, run_j, run_len = encodeRuns(cluster_ids, iis, jjs)
+    assert(list(run_cluster) == [0, 0, 0, 1])
+    assert(list(run_len) == [2, 1, 2, 2])
+    ii, jj = decodeRuns(run_i, run_j, run_len)
+    assert(np.array_equal(ii, iis) and np.array_equal(jj, jjs))
+    print 'testRuns OK'
+
+def testTrackStore():
+    import os
+    import tempfile
+    tracks = createTestTracks()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # columnar file and file pickled by older versions
+        filename = os.path.join(tmpdir, 'test_0_60_XXXX_0')
+        with open(filename, 'wb') as f:
+            writeTracks(f, tracks)
+        old_filename = os.path.join(tmpdir, 'old_0_60_XXXX_0')
+        with gzip.GzipFile(old_filename, 'wb') as gzf:
+            cPickle.dump(tracks, gzf)
+        for name in filename, old_filename:
+            store = TrackStore(name)
+            assert(len(store) == len(tracks))
+            c = 0
+            for track_id, track in enumerate(tracks):
+                assert(list(store.getTimes(track_id)) == sorted(track.keys()))
+                for t_index in sorted(track.keys()):
+                    indices = store.getClusterIndices(track_id, t_index)
+                    assert(len(indices) == len(track[t_index]['clusters']))
+                    for cl, c in zip(track[t_index]['clusters'], indices):
+                        ref = cl.toArray()
+                        res = store.toArray(c)
+                        for a, b in zip(ref, res):
+                            assert(np.array_equal(a, b))
+                        assert(np.allclose(store.cluster_centre[c], cl.ellipse.centre))
+                assert(len(store.getClusterIndices(track_id, -1)) == 0)
+
+            # cells of a time window, ordered by track, time index and cluster
+            run_track, run_t, run_i, run_j, run_len = store.getRuns(10, 30)
+            iis, jjs = decodeRuns(run_i, run_j, run_len)
+            res = zip(np.repeat(run_track, run_len), np.repeat(run_t, run_len), iis, jjs)
+            ref = [(track_id, t_index, i, j) for track_id in range(len(tracks)) \
+                   for t_index in store.getTimes(track_id) if 10 <= t_index < 30 \
+                   for c in store.getClusterIndices(track_id, t_index) \
+                   for i, j in zip(*store.getCells(c))]
+            assert(len(ref) > 0 and res == ref)
+            active = np.zeros(len(tracks), bool)
+            active[run_track] = True
+            assert(np.array_equal(store.getActiveTracks(10, 30), active))
+            assert(store.getSize() > 4*len(store.run_len))
+            rebuilt = store.getTracks()
+            for track, new_track in zip(tracks, rebuilt):
+                assert(sorted(track.keys()) == sorted(new_track.keys()))
+                for t_index in track:
+                    assert(track[t_index]['area'] == new_track[t_index]['area'])
+                    for cl, new_cl in zip(track[t_index]['clusters'], new_track[t_index]['clusters']):
+                        assert(np.array_equal(cl.iis, new_cl.iis))
+                        assert(np.array_equal(cl.jjs, new_cl.jjs))
+                        assert(np.allclose(cl.ellipse.centre, new_cl.ellipse.centre))
+        print 'sizes: columnar', os.path.getsize(filename), 'pickle', os.path.getsize(old_filename)
+        assert(os.path.getsize(filename) < os.path.getsize(old_filename))
+
+        # empty harvest
+        with open(filename, 'wb') as f:
+            writeTracks(f, [])
+        store = TrackStore(filename)
+        assert(len(store) == 0)
+        assert(len(store.getRuns(0, 48)[0]) == 0)
+        assert(len(store.getActiveTracks(0, 48)) == 0)
+    finally:
+        import shutil
+        shutil.rmtree(tmpdir)
+    print 'testTrackStore OK'
+
+
+if __name__ == '__main__':
+    testRuns()
+    testTrackStore()
@@ -5,36 +5,92 @@ import matplotlib.pyplot as mpl
 import time
 import glob
 from time_connected_clusters import TimeConnectedClusters
-from feature_extractor import FeatureExtractor
+from feature_extractor import FeatureExtractor, extractClusters, ExtractionPool
 from cluster import Cluster
 from coastal_mapping import CoastalMapping
+from input_reader import InputReader, Prefetcher
+from checkpoint import Checkpoint
+from harvest_manifest import HarvestManifest
+from precip_store import PrecipDay, getPrecipFilename
+from instrumentation import recorder
 from output_from_pickle import OutputFromPickle
 from write_output_pp import createTxt, readTxt
 import configparser
 import sys,os,string
 import gzip
-import bz2
 import cPickle
 from datetime import datetime,timedelta as td
 
 
+def writeLatLon(targetdir, suffix, filename, minmax_lats, minmax_lons):
+    """
+    Store once and for all the latitudes and longitudes of the region and of the whole globe
+    for the post-processing
+    @param targetdir: directory of the pickles
+    @param suffix: suffix of the region
+    @param filename: name of a daily file
+    @param minmax_lats: min and max latitude indices of the region
+    @param minmax_lons: min and max longitude indices of the region
+    """
+    if os.path.isfile(str(targetdir)+'lon_tot_'+str(suffix)+'.txt') and \
+        os.path.isfile(str(targetdir)+'lon_tot.txt'):
+        return
+    f = InputReader(filename)
+    # Store for zone
+    lat_tot_zone = f.variables['lat'][minmax_lats[0]:minmax_lats[1]]
+    lon_tot_zone = f.variables['lon'][minmax_lons[0]:minmax_lons[1]]
+    createTxt(str(targetdir)+'lat_tot_'+str(suffix)+'.txt', lat_tot_zone)
+    createTxt(str(targetdir)+'lon_tot_'+str(suffix)+'.txt', lon_tot_zone)
+    # Store for whole globe
+    lat_tot = f.variables['lat'][:]
+    lon_tot = f.variables['lon'][:]
+    createTxt(str(targetdir)+'lat_tot.txt', lat_tot)
+    createTxt(str(targetdir)+'lon_tot.txt', lon_tot)
+    f.close()
+
+
+def listDays(data_path, fyear, lyear):
+    """
+    @param data_path: directory of the daily files
+    @param fyear: first date
+    @param lyear: last date
+    @return list of (date, filename)
+    """
+    delta = lyear - fyear
+    days = []
+    for nb_day in xrange(delta.days + 1):
+        date = fyear + td(days=nb_day)
+        filename=os.path.join(str(data_path)+'Cmorph-' \
+               + str(date.year) + '_' + str(date.month).zfill(2) + '_'\
+               + str(date.day).zfill(2) + '.nc.bz2')
+        filename = filename.replace('--','-').replace('__','_')
+        days.append((date, filename))
+    return days
+
+
 def tracking(fyear, lyear, minmax_lons, minmax_lats, suffix, restart_dir,
-             restart_interval, harvestPeriod):
+             restart_interval, harvestPeriod, prefetch=0, workers=1, targetdir=None,
+             filter_tracks=True, coastal_mapping=None, precip_store=False, final_harvest=True):
 
     # check if restart exists
     restart = False
-    restart_file = None
+    checkpoint = None
     pickle_index = 0
     if restart_dir is not None:
+        checkpoint = Checkpoint(os.path.join(restart_dir, "clusters_restart_%s" % suffix))
         restart_file = os.path.join(restart_dir, "clusters_restart_%s.pkl" % suffix)
-        if os.path.exists(restart_file):
+        if checkpoint.exists():
+            restart = True
+            print "Loading restart files from: %s" % checkpoint.dirname
+            restart_data = checkpoint.load()
+        elif os.path.exists(restart_file):
+            # restart file written by older versions, whole state in one file
             restart = True
             print "Loading restart file: %s" % restart_file
-
-            # load restart file
             with gzip.GzipFile(restart_file) as fh:
                 restart_data = cPickle.load(fh)
 
+        if restart:
             # unpack
             tcc = restart_data['tcc']
             minmax_lats = restart_data['minmax_lats']
@@ -55,13 +111,20 @@ def tracking(fyear, lyear, minmax_lons, minmax_lats, suffix, restart_dir,
             config_full = configparser.ConfigParser()
             config_full.read('config.cfg')
             C = config_full['clusters']
-            targetdir = os.path.expandvars(C.get('targetdir'))
-            pickles = glob.glob(os.path.join(targetdir, "%s_*" % suffix))
+            pickle_dir = targetdir
+            if pickle_dir is None:
+                pickle_dir = os.path.expandvars(C.get('targetdir'))
+            pickles = glob.glob(os.path.join(pickle_dir, "%s_*" % suffix))
+            deleted = []
             for pickle in pickles:
                 pickle_index_file = int(pickle.split("_")[-1])
                 if pickle_index_file > pickle_index:
                     print "Deleting pickle file that was created after the restart file: %s" % pickle
                     os.remove(pickle)
+                    deleted.append(pickle)
+            manifest = HarvestManifest(pickle_dir, suffix)
+            if manifest.exists():
+                manifest.remove(deleted)
 
             # increment the pickle index
             pickle_index += 1
@@ -72,27 +135,27 @@ def tracking(fyear, lyear, minmax_lons, minmax_lats, suffix, restart_dir,
         list_filename = []
 
     # prepare for writing restart files
-    if restart_file is None or restart_interval is None:
+    if checkpoint is None or restart_interval is None:
         # don't write restart files
         restart_interval = None
-        restart_file = None
+        checkpoint = None
 
     else:
-        # make the restart directory, if required
-        if not os.path.exists(restart_dir):
-            os.makedirs(restart_dir)
-        print "Saving restart files to: %s" % restart_file
+        # the restart directory is made when the first file is written
+        print "Saving restart files to: %s" % checkpoint.dirname
         print "Saving restart files every %d days" % restart_interval
 
     # run tracking
-    _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
-                   suffix, harvestPeriod, restart_file, restart_interval,
-                   pickle_index)
+    return _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
+                          suffix, harvestPeriod, checkpoint, restart_interval,
+                          pickle_index, prefetch, workers, targetdir, filter_tracks,
+                          coastal_mapping, precip_store, final_harvest)
 
 
 def _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
-                   suffix, harvestPeriod, restart_file, restart_interval,
-                   pickle_index):
+                   suffix, harvestPeriod, checkpoint, restart_interval,
+                   pickle_index, prefetch=0, workers=1, targetdir=None, filter_tracks=True,
+                   coastal_mapping=None, precip_store=False, final_harvest=True):
 
     ##########################################################################
     # Import arguments from config.cfg or fix default
@@ -106,12 +169,15 @@ def _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
     data_path = os.path.expandvars(C.get('data_path'))
     lsm = os.path.expandvars(C.get('lsm_path'))
     print 'lsm', lsm
-    targetdir = os.path.expandvars(C.get('targetdir'))
+    if targetdir is None:
+        targetdir = os.path.expandvars(C.get('targetdir'))
     reso = C.getint('reso')
     print 'reso', reso
     min_prec = C.getfloat('min_prec', 0)
     max_prec = C.getfloat('max_prec', 3.0)
     print 'min_prec, max_prec', min_prec, max_prec
+    tile_size = C.getint('tile_size', 0)
+    print 'tile_size', tile_size
     szone = C.getint('szone', 8)
     lzone = C.getint('lzone', 50)
     print 'szone, lzone', szone, lzone
@@ -130,6 +196,10 @@ def _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
     frac_decrease = C.getfloat('frac_decrease', 0.9)
     print 'frac_decrease', frac_decrease
     save = C.getboolean('save')
+    mask_dir = C.get('mask_dir', None)
+    if mask_dir:
+        mask_dir = os.path.expandvars(mask_dir)
+    print 'mask_dir', mask_dir
     #########################################################################
 
     # Get lat-lon limits of region and save it post_processing
@@ -141,95 +211,82 @@ def _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
         createTxt(str(targetdir)+'lat-lon_'+str(suffix)+'.txt', [minmax_lats[0], \
                    minmax_lats[1], minmax_lons[0], minmax_lons[1]])
 
-    # Create the two coastal masks
-    cm = CoastalMapping(lsm, np.int(reso), lat_slice, lon_slice, np.int(szone), \
-                         np.int(lzone), np.int(min_size), np.int(max_size))
-    sys.exit()
+    # Create the two coastal masks, unless given by the caller
+    cm = coastal_mapping
+    if cm is None:
+        cm = CoastalMapping(lsm, np.int(reso), lat_slice, lon_slice, np.int(szone), \
+                             np.int(lzone), np.int(min_size), np.int(max_size), cache_dir=mask_dir)
 
-    # difference between start and end dates
-    delta = lyear - fyear
+    # daily files between start and end dates
+    days = listDays(data_path, fyear, lyear)
+
+    # processes extracting the clusters, started once for the run and before the thread
+    # reading in advance. Days have 48 half-hourly time steps over the domain of the masks,
+    # which is also right for regions on both sides of 0 degree of longitude
+    extraction_pool = None
+    if workers > 1:
+        mask = np.flipud(cm.lArea)
+        extraction_pool = ExtractionPool((48,) + mask.shape, min_prec, max_prec, mask, \
+                                         frac_mask, workers, tile_size)
+
+    # read the files in advance while tracking, the thread is a daemon and does not
+    # prevent exiting on errors
+    prefetcher = Prefetcher(days, lat_slice, lon_slice, depth=prefetch)
 
     #########################################################################
     # Loop over days
     #########################################################################
-    for nb_day in xrange(delta.days + 1):
-        date = fyear + td(days=nb_day)
-        filename=os.path.join(str(data_path)+'Cmorph-' \
-               + str(date.year) + '_' + str(date.month).zfill(2) + '_'\
-               + str(date.day).zfill(2) + '.nc.bz2')
-
-        # Open the file
-        filename = filename.replace('--','-').replace('__','_')
+    for nb_day, (date, filename, all_data, lat, lon, tint, unit) in enumerate(prefetcher):
         print 'filename', filename
         list_filename = np.append(list_filename, filename)
-        zipfile = bz2.BZ2File(filename)
-        data_unzip = zipfile.read()
-        newfilename = filename[:-4]
-        open(newfilename, 'wb').write(data_unzip)
-        try:
-            f = nc(newfilename)
-        except RuntimeError:
-            f = nc(newfilename.replace('-','_'))
-        if lon_slice.start < lon_slice.stop:
-            all_data = f.variables["CMORPH"][:, lat_slice, lon_slice]
-        else:
-            all_data1 = f.variables["CMORPH"][:, lat_slice,lon_slice.start:]
-            all_data2 = f.variables["CMORPH"][:, lat_slice,:lon_slice.stop]
-            all_data = np.concatenate((all_data1, all_data2), axis=2)
 
         # Store once and for all info: lat, lon for post-processing
         if nb_day == 0:
-            lat = f.variables['lat'][minmax_lats[0]:minmax_lats[1]]
-            if os.path.isfile(str(targetdir)+'lon_tot_'+str(suffix)+'.txt') and \
-                os.path.isfile(str(targetdir)+'lon_tot.txt'):
-                pass
-            else:
-                # Store for zone
-                lat_tot_zone = f.variables['lat'][minmax_lats[0]:minmax_lats[1]]
-                lon_tot_zone = f.variables['lon'][minmax_lons[0]:minmax_lons[1]]
-                createTxt(str(targetdir)+'lat_tot_'+str(suffix)+'.txt', lat_tot_zone)
-                createTxt(str(targetdir)+'lon_tot_'+str(suffix)+'.txt', lon_tot_zone)
-                # Store for whole globe
-                lat_tot = f.variables['lat'][:]
-                lon_tot = f.variables['lon'][:]
-                createTxt(str(targetdir)+'lat_tot.txt', lat_tot)
-                createTxt(str(targetdir)+'lon_tot.txt', lon_tot)
-
-            # Special case of zones on both sides of 0 degree of longitude
-            if lon_slice.start < lon_slice.stop:
-                lon = f.variables['lon'][minmax_lons[0]:minmax_lons[1]]
-            else:
-                lon1 = f.variables['lon'][minmax_lons[0]:]
-                lon2 = f.variables['lon'][:minmax_lons[1]]
-                lon = np.concatenate((lon1, lon2))
-        f.close()
+            writeLatLon(targetdir, suffix, filename, minmax_lats, minmax_lons)
 
         # Begin tracking
         i_minmax = (0, len(lat))
         j_minmax = (0, len(lon))
         timesteps = np.shape(all_data)[0]
-        for t in xrange(timesteps):
-            print 'nb_day, t', nb_day, t
-            data = all_data[t]
 
-            # Extract clusters with watershed and remove large-scale clusters
-            clusters = FeatureExtractor(data, thresh_low=min_prec, thresh_high=max_prec, \
-                           mask=np.flipud(cm.lArea), frac=frac_mask).getClusters(min_axis)
+        # Extract clusters with watershed and remove large-scale clusters for the whole day,
+        # with several processes the clusters are given in time order as soon as they are ready
+        if extraction_pool is not None:
+            all_clusters = extraction_pool.extract(all_data, min_ellipse_axis=min_axis)
+        else:
+            all_clusters = extractClusters(all_data, thresh_low=min_prec, thresh_high=max_prec, \
+                               mask=np.flipud(cm.lArea), frac=frac_mask, min_ellipse_axis=min_axis, \
+                               tile_size=tile_size)
+
+        # precipitation of the cells of the clusters, read by the post-processing instead
+        # of the input file
+        precip_day = None
+        if precip_store:
+            precip_day = PrecipDay(all_data, tint, unit)
+
+        for t, clusters in enumerate(all_clusters):
+            print 'nb_day, t', nb_day, t
+            recorder.count('time_steps')
+            if precip_day is not None:
+                precip_day.addClusters(t, clusters)
 
             # Check time connectivity between clusters
-            tcc.addTime(clusters, frac_ellipse, frac_decrease)
+            with recorder.timer('add_time'):
+                tcc.addTime(clusters, frac_ellipse, frac_decrease)
 
             # Harvest the dead tracks and write to file
             if harvestPeriod and (t + 1) % harvestPeriod == 0:
-                tcc.harvestTracks(targetdir+suffix, i_minmax, j_minmax, np.flipud(cm.sArea), \
-                                   frac_mask, max_cells, t_life*timesteps, t_life_lim*timesteps, \
-                                   minmax_lats, pickle_index, dead_only=True)
-
-        try:
-            os.remove(newfilename)
-        except OSError:
-            pass
-        del all_data, data, clusters, data_unzip
+                num_tracks = tcc.getNumberOfTracks()
+                with recorder.timer('harvest'):
+                    tcc.harvestTracks(targetdir+suffix, i_minmax, j_minmax, np.flipud(cm.sArea), \
+                                       frac_mask, max_cells, t_life*timesteps, \
+                                       t_life_lim*timesteps, minmax_lats, pickle_index, \
+                                       dead_only=True, filter_tracks=filter_tracks)
+                recorder.count('harvested_tracks', num_tracks - tcc.getNumberOfTracks())
+
+        if precip_day is not None:
+            precip_day.write(getPrecipFilename(targetdir, suffix, date.strftime('%Y_%m_%d')))
+        del all_data, all_clusters, clusters, precip_day
 
         # store restart file
         if restart_interval is not None and (nb_day + 1) % restart_interval == 0:
@@ -242,20 +299,11 @@ def _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
                 'pickle_index': pickle_index,
             }
 
-            # if the restart file already exists we temporarily rename it in case writing the new one fails
-            tmpRestart = False
-            if os.path.exists(restart_file):
-                os.rename(restart_file, restart_file + '.tmp')
-                tmpRestart = True
-
-            # create the restart file
-            print "Writing restart file:", restart_file
-            with gzip.GzipFile(restart_file, "wb", 1) as fh:
-                cPickle.dump(restart_data, fh)
-
-            # remove temporary file
-            if tmpRestart:
-                os.remove(restart_file + '.tmp')
+            # only the changes since the last restart file are written, each file is
+            # complete on disk before it is renamed
+            print "Writing restart file in:", checkpoint.dirname
+            with recorder.timer('restart_write'):
+                checkpoint.write(restart_data)
 
             # increment pickle_index, so we know which pickle files were written after the restart
             # we will delete these when restarting, otherwise they will be duplicated
@@ -264,14 +312,30 @@ def _tracking_main(tcc, list_filename, fyear, lyear, minmax_lons, minmax_lats,
         # save filenames for post-processing:
         createTxt(str(targetdir)+'filenames_'+str(suffix)+'.txt', list_filename)
 
+        recorder.set('live_tracks', tcc.getNumberOfTracks())
+        recorder.writeRow(date.strftime('%Y-%m-%d'))
+
+    prefetcher.close()
+    if extraction_pool is not None:
+        extraction_pool.close()
+
+    # the tracks still alive are kept for the next days (see partitioned_tracking.py)
+    if not final_harvest:
+        return tcc
+
     # final harvest (all tracks)
     print "final harvest (pickle index is %d)" % pickle_index
-    tcc.harvestTracks(targetdir+suffix, i_minmax, j_minmax, np.flipud(cm.sArea), frac_mask, \
-                       max_cells, t_life*timesteps, t_life_lim*timesteps, minmax_lats, \
-                       pickle_index, dead_only=False)
+    num_tracks = tcc.getNumberOfTracks()
+    with recorder.timer('harvest'):
+        tcc.harvestTracks(targetdir+suffix, i_minmax, j_minmax, np.flipud(cm.sArea), frac_mask, \
+                           max_cells, t_life*timesteps, t_life_lim*timesteps, minmax_lats, \
+                           pickle_index, dead_only=False)
+    recorder.count('harvested_tracks', num_tracks)
+    recorder.writeRow('final_harvest')
 
     if save:
         tcc.save('cmorph.pckl_'+str(suffix))
+    return tcc
 
 
 if __name__ == '__main__':
@@ -291,6 +355,18 @@ if __name__ == '__main__':
                            restart files")
     parser.add_argument('-restart_interval', type=int, default=None, help="If set then write \
                            restart files at this interval (days)")
+    parser.add_argument('-prefetch', type=int, default=0, help="Number of days read in advance \
+                           in a background thread (0 to read each day when needed, each day \
+                           read in advance is kept in memory)")
+    parser.add_argument('-workers', type=int, default=1, help="Number of processes used to \
+                           extract the clusters of the time steps of a day (the time connection \
+                           is still done in time order, the results are the same)")
+    parser.add_argument('-precip_store', action='store_true', help="Write the precipitation \
+                           of the cells of the clusters of each day next to the pickles, the \
+                           post-processing then does not read the input files again")
+    parser.add_argument('-stats', default=None, help="Write the time spent in each stage, the \
+                           numbers of clusters and tracks and the peak memory of each day to \
+                           this file (json lines if it ends with .jsonl, csv otherwise)")
     args = parser.parse_args()
 
     # get the lat-lon box
@@ -309,5 +385,11 @@ if __name__ == '__main__':
     except IndexError,ValueError:
         sys.stdout.write(helpstring+'\n')
         sys.exit()
-    tracking(fyear, lyear, minmax_lons, minmax_lats, args.suffix, args.restart_dir,
-             args.restart_interval, args.harvestPeriod)
+    if args.stats is not None:
+        recorder.open(args.stats)
+    try:
+        tracking(fyear, lyear, minmax_lons, minmax_lats, args.suffix, args.restart_dir,
+                 args.restart_interval, args.harvestPeriod, args.prefetch,
+                 args.workers, precip_store=args.precip_store)
+    finally:
+        recorder.close()
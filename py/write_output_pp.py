@@ -8,12 +8,124 @@ Created in May 2018
 
 import numpy as np
 import argparse
-from output_from_pickle import OutputFromPickle, readTxt, createTxt
+from output_from_pickle import OutputFromPickle, readTxt, createTxt, deleteFiles
+from pickle_cache import PickleCache
 from datetime import datetime
 import sys, os
 import cPickle
+import multiprocessing
 
-def writeOutputPP(lastname, inputdir, outputdir, list_prefix, suffix, restart_dir):
+def assignTrackIds(pp_filenames, start_ind, lat, lon, inputdir, outputdir, list_prefix, \
+                   dict_pickles, track_id, id):
+    """
+    First pass of the parallel post-processing: give the ids to the tracks of each day in
+    the same order as writeOutputPP, without writing the output and without deleting the
+    pickles
+    @param pp_filenames: input files of the days
+    @param start_ind: index of the first day
+    @param lat: latitudes of the output
+    @param lon: longitudes of the output
+    @param inputdir: directory where pickles are stored
+    @param outputdir: directory where outputs will be stored
+    @param list_prefix: list of prefixes to choose what pickle files read
+    @param dict_pickles: PickleCache
+    @param track_id: id of the tracks going on, with pickle name as key
+    @param id: last id used
+    @return list of (pickles, id of their tracks) for each day, pickles finished by the
+            last day, OutputFromPickle of the last day
+    """
+    days = []
+    finished = []
+    for nb_day in xrange(len(pp_filenames)):
+        ofp = OutputFromPickle(nb_day+start_ind, lat, lon, inputdir, outputdir, list_prefix, \
+                                dict_pickles, track_id, id)
+
+        # the pickles finished by the previous days are not deleted yet
+        files = ofp.selectPickles(None if nb_day == 0 else ofp.ini)
+        files.sort()
+        days.append((files, [ofp.assignIds(i, dict_pickles.get(i)) for i in files]))
+        for filename in ofp.getFinishedPickles():
+            ofp.deleteTrackId(filename)
+            dict_pickles.discard(filename)
+            finished.append(filename)
+        track_id = ofp.track_id
+        id = ofp.id
+    return days, finished, ofp
+
+
+# arguments of the worker processes of writeDaysParallel, set by _initWorker in each process,
+# also in the processes started again by the pool
+_worker_args = {}
+
+def _initWorker(args):
+    """
+    Keep the arguments of _writeDay in a worker process
+    @param args: dictionary of the arguments common to all the days
+    """
+    _worker_args.update(args)
+
+
+def _writeDay(task):
+    """
+    Second pass of the parallel post-processing: write the output of a day
+    @param task: index of the day, input file, pickles and id of their tracks
+    @return index of the day
+    """
+    nb_day, filename, files, values = task
+    args = _worker_args
+    print 'write_output for', filename
+    ofp = OutputFromPickle(nb_day, args['lat'], args['lon'], args['inputdir'], \
+                           args['outputdir'], args['list_prefix'], args['dict_pickles'], {}, 0)
+    all_indices = []
+    all_values = []
+    for i, ids in zip(files, values):
+        indices, cell_values = ofp.getCells(i, ofp.dict_pickles.get(i), ids)
+        all_indices.append(indices)
+        all_values.append(cell_values)
+    ofp.setClusters(all_indices, all_values)
+    ofp.writeFile(str(args['suffix']), filename, args['lat_lon'], **args['output_options'])
+    return nb_day
+
+
+def writeDaysParallel(pp_filenames, start_ind, lat, lon, inputdir, outputdir, list_prefix, \
+                      suffix, lat_lon, dict_pickles, track_id, id, processes, \
+                      output_options=None):
+    """
+    Write the output of the days in a pool of processes. The ids are given first by going
+    through the days in order, the output is then the same as when the days are written one
+    after the other. The pickles that are finished are deleted at the end
+    @param processes: number of processes, each has a cache of the size of dict_pickles
+    @param output_options: options of OutputFromPickle.writeFile
+    @return OutputFromPickle of the last day, with the ids used for a restart
+    """
+    if output_options is None:
+        output_options = {}
+    days, finished, ofp = assignTrackIds(pp_filenames, start_ind, lat, lon, inputdir, \
+                                         outputdir, list_prefix, dict_pickles, track_id, id)
+    tasks = [(nb_day+start_ind, pp_filenames[nb_day]) + days[nb_day] \
+             for nb_day in xrange(len(pp_filenames))]
+    del days
+
+    # consecutive days share pickles, they are given to the same process
+    chunksize = max(1, len(tasks) // (4*processes))
+    args = dict(lat=lat, lon=lon, inputdir=inputdir, outputdir=outputdir, \
+                list_prefix=list_prefix, suffix=suffix, lat_lon=lat_lon, \
+                output_options=output_options, dict_pickles=PickleCache(dict_pickles.max_bytes))
+    pool = multiprocessing.Pool(processes, initializer=_initWorker, initargs=(args,))
+    try:
+        for nb_day in pool.imap_unordered(_writeDay, tasks, chunksize):
+            pass
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # Delete pickle that will not be used anymore
+    deleteFiles(inputdir, list_prefix, finished)
+    return ofp
+
+
+def writeOutputPP(lastname, inputdir, outputdir, list_prefix, suffix, restart_dir, \
+                  cache_size=2048, processes=1, output_options=None):
     """
     @param lastname: end date when post-processing stops
     @param inputdir: directory where pickles are stored
@@ -22,14 +134,23 @@ def writeOutputPP(lastname, inputdir, outputdir, list_prefix, suffix, restart_di
     @param suffix: suffix for output
     @param restart_dir: restart directory for post-processing pickle need to start 
                         next post-processing from where we left
+    @param cache_size: maximum size in MB of the pickles kept in memory between days,
+                       None for no limit
+    @param processes: number of days written at the same time
+    @param output_options: options of OutputFromPickle.writeFile (compression, chunks, types)
     """
     restart = False
     restart_file = None
+    if output_options is None:
+        output_options = {}
 
     # set defaults if no restart post-processing or first time doing post-processing
     id = 0
     track_id ={}
-    dict_pickles = {}
+    if cache_size is None:
+        dict_pickles = PickleCache()
+    else:
+        dict_pickles = PickleCache(cache_size*1024**2)
     offset = 0
     start_ind = 0
     filenames = readTxt(str(inputdir)+'filenames_'+str(list_prefix[0])+'.txt')
@@ -70,28 +191,109 @@ def writeOutputPP(lastname, inputdir, outputdir, list_prefix, suffix, restart_di
         pp_filenames = filenames
     print 'pp_filenames', pp_filenames
 
-    for nb_day in xrange(len(pp_filenames)):
-        print 'write_output for', pp_filenames[nb_day]
-        ofp = OutputFromPickle(nb_day+start_ind, lat, lon, inputdir, outputdir, list_prefix, \
-                                dict_pickles, track_id, id)
-        files = ofp.selectPickles()
-        if len(files)==0:
-            print 'no files in writeOutputPP'
-        files2 = files.sort()
-        ofp.extractTracks(files)
-        ofp.writeFile(str(suffix), pp_filenames[nb_day], lat_lon)
-
-        # Delete pickle that will not be used anymore
-        ofp.deletePickles()
-        dict_pickles = ofp.dict_pickles
-        track_id = ofp.track_id
-        id = ofp.id
+    if processes > 1:
+        ofp = writeDaysParallel(pp_filenames, start_ind, lat, lon, inputdir, outputdir, \
+                                list_prefix, suffix, lat_lon, dict_pickles, track_id, id, \
+                                processes, output_options)
+    else:
+        for nb_day in xrange(len(pp_filenames)):
+            print 'write_output for', pp_filenames[nb_day]
+            ofp = OutputFromPickle(nb_day+start_ind, lat, lon, inputdir, outputdir, list_prefix, \
+                                    dict_pickles, track_id, id)
+            files = ofp.selectPickles()
+            if len(files)==0:
+                print 'no files in writeOutputPP'
+            files2 = files.sort()
+            ofp.extractTracks(files)
+            ofp.writeFile(str(suffix), pp_filenames[nb_day], lat_lon, **output_options)
+
+            # Delete pickle that will not be used anymore
+            ofp.deletePickles()
+            dict_pickles = ofp.dict_pickles
+            track_id = ofp.track_id
+            id = ofp.id
+
+    print 'pickle cache', dict_pickles.getStats()
 
     # save informations about post-processing
-    ofp.saveInfoPP(pp_filenames[nb_day], restart_file)
+    ofp.saveInfoPP(pp_filenames[-1], restart_file)
 
 
 #################################################################
+
+def testWriteDaysParallel():
+    import shutil
+    import tempfile
+    from netCDF4 import Dataset
+    from benchmark_output import writeDay
+    from cluster import Cluster
+    from track_store import writeTracks
+    tmpdir = tempfile.mkdtemp() + '/'
+    try:
+        # 4 days of 10 x 20 precipitation
+        nlat, nlon = 10, 20
+        np.random.seed(1234)
+        filenames = []
+        for day in range(4):
+            filenames.append(tmpdir + 'Cmorph-2010_02_%02d.nc.bz2' % (19 + day))
+            writeDay(filenames[-1], np.around(np.random.uniform(0, 5, (48, nlat, nlon)), 2))
+        inputdir = tmpdir + 'pickles/'
+        os.makedirs(inputdir)
+        createTxt(inputdir + 'lat-lon_aa.txt', [0, nlat, 0, nlon])
+        createTxt(inputdir + 'lat_tot_aa.txt', list(np.linspace(-60, 60, nlat)))
+        createTxt(inputdir + 'lon_tot_aa.txt', list(np.linspace(0, 360, nlon, endpoint=False)))
+        createTxt(inputdir + 'filenames_aa.txt', filenames)
+        def track(t_indices, i0, j0):
+            iis, jjs = np.mgrid[i0:i0 + 2, j0:j0 + 3]
+            cl = Cluster((iis.ravel().astype(np.int32), jjs.ravel().astype(np.int32)))
+            return dict((t, {'area': 6, 'clusters': [cl]}) for t in t_indices)
+        # tracks within a day, over several days and going on after the last day
+        pickles = {'aa_0_60_xyz_0': [track([3, 4], 1, 2), track(range(40, 61), 5, 5)],
+                   'aa_30_150_xyz_0': [track(range(30, 151, 3), 2, 10), track([35], 7, 15)],
+                   'aa_100_120_xyz_1': [track(range(100, 121), 0, 0)],
+                   'aa_140_200_xyz_1': [track([140], 4, 4), track(range(170, 201), 8, 17)]}
+        for name, tracks in pickles.items():
+            with open(inputdir + name, 'wb') as f:
+                writeTracks(f, tracks)
+
+        results = {}
+        for processes in 1, 3:
+            dirname = tmpdir + 'run%d/' % processes
+            shutil.copytree(inputdir, dirname + 'pickles/')
+            os.makedirs(dirname + 'output/')
+            os.makedirs(dirname + 'restart/')
+            writeOutputPP('2010_02_22', dirname + 'pickles/', dirname + 'output/', ['aa'], \
+                          'test', dirname + 'restart/', processes=processes)
+            output = []
+            for name in sorted(os.listdir(dirname + 'output/')):
+                nc = Dataset(dirname + 'output/' + name)
+                output.append((name, nc.variables['nb'][:], nc.variables['cprec'][:]))
+                nc.close()
+            with open(dirname + 'restart/info_pp.pkl') as f:
+                info = cPickle.load(f)
+            results[processes] = (output, sorted(os.listdir(dirname + 'pickles/')), info)
+
+        # same output, same pickles deleted and left for the next post-processing
+        output1, pickles1, info1 = results[1]
+        output3, pickles3, info3 = results[3]
+        assert(len(output1) == len(output3) == 4)
+        for (name1, nb1, cprec1), (name3, nb3, cprec3) in zip(output1, output3):
+            assert(name1 == name3)
+            assert(np.array_equal(nb1, nb3))
+            assert(np.ma.allequal(cprec1, cprec3))
+        assert(output1[-1][1].max() == 7)
+        assert(pickles1 == pickles3)
+        assert([name for name in pickles1 if name.startswith('aa_')] == ['aa_140_200_xyz_1'])
+        assert(info1['id'] == info3['id'] == 7)
+        # the pickles are in the directory of each run
+        ids1 = dict((os.path.basename(key), list(ids)) for key, ids in info1['track_id'].items())
+        ids3 = dict((os.path.basename(key), list(ids)) for key, ids in info3['track_id'].items())
+        assert(ids1 == ids3 == {'aa_140_200_xyz_1': [6, 7]})
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'testWriteDaysParallel OK'
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Post-processing')
     parser.add_argument('-d', dest='date', default='2010_02_21', help='End date YYYY_MM_DD')
@@ -104,6 +306,28 @@ if __name__ == '__main__':
     parser.add_argument('-s', dest='suffix', default='final', help='suffix for netcdf file')
     parser.add_argument('-restart_dir', default=None, help="Directory for storing and loading \
                                restart files")
+    parser.add_argument('-cache_size', type=int, default=2048, help="Maximum size in MB of \
+                               the pickles kept in memory, 0 for no limit")
+    parser.add_argument('-processes', type=int, default=1, help="Number of days written \
+                               at the same time")
+    parser.add_argument('-complevel', type=int, default=4, help="Deflate level of the \
+                               output, from 0 (no compression) to 9")
+    parser.add_argument('-no_shuffle', action='store_true', help="Do not use the shuffle \
+                               filter before compressing")
+    parser.add_argument('-chunks', default='48,32,32', help="time,lat,lon chunk shape of \
+                               the output, or none for the default of the netcdf library")
+    parser.add_argument('-pack', action='store_true', help="Write cprec as int16 with \
+                               scale_factor and add_offset (0.01 mm/h)")
+    parser.add_argument('-nb_type', default='i4', choices=['i4', 'u2'], help="Type of nb")
+    parser.add_argument('-t', action='store_true', help='Run the tests')
     args = parser.parse_args()
+
+    if args.t:
+        testWriteDaysParallel()
+        sys.exit(0)
+
+    chunks = None if args.chunks == 'none' else tuple(int(n) for n in args.chunks.split(','))
+    output_options = {'complevel': args.complevel, 'shuffle': not args.no_shuffle, \
+                      'chunksizes': chunks, 'pack_precip': args.pack, 'nb_type': args.nb_type}
     writeOutputPP(args.date, args.inputdir, args.outputdir, args.prefix, args.suffix, \
-                   args.restart_dir)
+                   args.restart_dir, args.cache_size or None, args.processes, output_options)